@@ -1,18 +1,36 @@
-from chalice import Chalice
+from chalice import Chalice, NotFoundError, Response
 import os, sys
 import json
-from chalicelib.race_registrations import process_race_registrations, get_registration_stats
-from chalicelib.wa_utils import WaUtils
-import chalicelib.emailer as emailer
 import logging
+from chalicelib.metrics import instrumented
+
+# chalicelib modules pull in boto3, smart_open, requests and the Google API client, and WaUtils() logs in to
+# WildApricot.  They are imported and created by the routes that use them, so a cold start only pays for
+# what the first request needs.
+#
+# Routes that do real work are @instrumented: their stage timers and counters are logged in CloudWatch EMF and
+# the latest run of each is served by /metrics.  Add ?profile=1 to such a request to sample it with the profiler.
 
 app = Chalice(app_name='aarcweeklyforward')
 app.api.cors = True
 
-wa_client = WaUtils()
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
-logger.info('wa_client initialized')
+
+_wa_client = None
+
+
+def wa_client():
+    global _wa_client
+    if _wa_client is None:
+        from chalicelib.wa_utils import WaUtils
+        _wa_client = WaUtils()
+        logger.info('wa_client initialized')
+    return _wa_client
+
+
+def profile_requested():
+    return (app.current_request.query_params or {}).get('profile') == '1'
 
 @app.route('/')
 def index():
@@ -46,48 +64,150 @@ def index():
 # See the README documentation for more examples.
 #
 
+# The admin page's three stats sections from one precomputed snapshot.  The browser revalidates it with
+# If-None-Match (Cache-Control: no-cache) and gets a 304 with no body while nothing changed.
+@app.route('/dashboard')
+def get_dashboard():
+    from chalicelib.dashboard import read_dashboard, etag_matches
+    dashboard = read_dashboard()
+    headers = {'ETag': dashboard['etag'], 'Cache-Control': 'no-cache'}
+    if etag_matches(app.current_request.headers.get('if-none-match'), dashboard['etag']):
+        return Response(body='', status_code=304, headers=headers)
+    return Response(body=dict(dashboard['sections'], updated=dashboard['updated']), status_code=200, headers=headers)
+
+
 @app.route('/club-contacts')
 def club_contacts():
-    response = wa_client.get_aarc_stats()
+    response = wa_client().get_aarc_stats()
     return response
 
 @app.route('/club-contacts/refresh', methods=['POST'])
+@instrumented('club-contacts-refresh', profile=profile_requested)
 def post_club_contacts():
     print('Updating club contacts')
-    return wa_client.refresh_aarc_stats()
+    return wa_client().refresh_aarc_stats()
 
 @app.route('/race-reg-contacts')
 def race_reg_contacts():
-    return json.dumps(get_registration_stats())
+    from chalicelib.race_registrations import get_registration_stats
+    return get_registration_stats() or {}
+
+@app.route('/race-reg-contacts/analytics')
+def race_reg_analytics():
+    from chalicelib.race_registrations import get_registration_analytics
+    return get_registration_analytics() or {}
 
 @app.route('/race-reg-contacts/refresh', methods=['POST'])
+@instrumented('race-reg-refresh', profile=profile_requested)
 def post_race_reg_contacts():
     print('Updating race reg contacts')
+    from chalicelib.race_registrations import process_race_registrations
     return process_race_registrations()
 
+# Email counters come from the send log's aggregates, which every relayed chunk updates as it is logged.
 @app.route('/emails')
 def emails():
-    return {'relayed': '10',
-    'last-date': '12-April-2020',
-    'last-relayed': '11-May-2020',
-    'total-sent' : 5010
-    }
+    from chalicelib.send_log import email_stats
+    return email_stats()
 
 
 @app.route('/emails/refresh', methods=['POST'])
 def post_emails():
     print('Updating email stats')
-#    wa_client.get_email_body()
-    return {'email-status' : 'Success'}
+    from chalicelib.send_log import email_stats, fold
+    return dict(email_stats(fold()), **{'email-status': 'Success'})
+
+
+@app.route('/emails/recipients/refresh', methods=['POST'])
+@instrumented('recipients-refresh', profile=profile_requested)
+def post_email_recipients():
+    print('Updating email recipients')
+    from chalicelib.audience import refresh_audience
+    return refresh_audience(wa_client())
+
+
+# Unsubscribe replies and bounces in the relay mailbox since the last sync go to the opt-out list.
+@app.route('/emails/mailbox/sync', methods=['POST'])
+@instrumented('mailbox-sync', profile=profile_requested)
+def mailbox_sync():
+    print('Syncing relay mailbox')
+    from chalicelib.mailbox import sync_mailbox
+    return sync_mailbox()
+
+
+# Unsubscribe links in the weekly email.  GET only shows a confirmation page with a button, so mail scanners that
+# follow links don't unsubscribe anyone; the button, and one-click unsubscribe from mail clients (RFC 8058), POST.
+UNSUBSCRIBE_PAGE = ('<!DOCTYPE html><html><head><meta name="viewport" content="width=device-width, initial-scale=1">'
+                    '<title>AARC weekly email</title></head><body style="font-family:sans-serif;text-align:center">'
+                    '{}</body></html>')
+
+
+def unsubscribe_page(content, status_code=200):
+    return Response(body=UNSUBSCRIBE_PAGE.format(content), status_code=status_code,
+                    headers={'Content-Type': 'text/html; charset=utf-8', 'Cache-Control': 'no-store'})
+
+
+@app.route('/unsubscribe', methods=['GET', 'POST'],
+           content_types=['application/x-www-form-urlencoded', 'multipart/form-data', 'application/json', 'text/plain'])
+def unsubscribe():
+    import html
+    from chalicelib.unsubscribe import unsubscribe as opt_out, verify_token
+    token = (app.current_request.query_params or {}).get('t')
+    if app.current_request.method == 'GET':
+        email = verify_token(token)
+        if email is None:
+            return unsubscribe_page('<p>This unsubscribe link is not valid.</p>', 400)
+        return unsubscribe_page(f'<p>Stop sending the AARC weekly email to {html.escape(email)}?</p>'
+                                f'<form method="post" action="?t={html.escape(token)}"><button type="submit">Unsubscribe</button></form>')
+    email = opt_out(token)
+    if email is None:
+        return unsubscribe_page('<p>This unsubscribe link is not valid.</p>', 400)
+    return unsubscribe_page(f'<p>{html.escape(email)} will not receive the AARC weekly email any more.</p>')
 
 
 @app.route('/emails/relay', methods=['POST'])
+@instrumented('relay-submit', profile=profile_requested)
 def relay_emails():
     print('Initiating email relay')
-    return {'email-status' : emailer.relay_email(wa_client)}
+    import chalicelib.emailer as emailer
+    job_id = emailer.relay_email(wa_client())
+    return {'email-status': 'Submitted' if job_id else 'No email', 'job-id': job_id}
+
+
+@app.route('/emails/relay/{job_id}')
+def relay_status(job_id):
+    from chalicelib.relay_jobs import job_status
+    status = job_status(job_id)
+    if status is None:
+        raise NotFoundError(f'No relay job {job_id}')
+    return status
+
+
+@app.route('/emails/relay/{job_id}/resume', methods=['POST'])
+def relay_resume(job_id):
+    from chalicelib.relay_jobs import resume_job
+    return {'job-id': job_id, 'resumed-chunks': resume_job(job_id)}
+
+
+# Relay worker: one invocation per chunk of a relay job.  A message with "profile": true is profiled.  A chunk
+# that another worker is processing raises ChunkBusy, so SQS delivers the message again after its visibility timeout.
+@app.on_sqs_message(queue='aarc-weekly-relay', batch_size=1)
+def relay_worker(event):
+    from chalicelib.relay_jobs import process_chunk
+    for record in event:
+        message = json.loads(record.body)
+        profile = message.pop('profile', False)
+        instrumented('relay-worker', profile=lambda: profile)(process_chunk)(**message)
+
+
+@app.route('/metrics')
+def get_metrics():
+    from chalicelib.metrics import latest_runs
+    return latest_runs()
 
 
 @app.route('/emails/send-test', methods=['POST'])
 def send_test():
     print('Sending Test email')
+    import chalicelib.emailer as emailer
     return {"status" : emailer.send_test_email()}
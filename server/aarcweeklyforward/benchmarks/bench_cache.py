@@ -0,0 +1,118 @@
+# Two tier cache check: runs chalicelib.cache.TwoTierCache against an S3 bucket mocked with moto, and checks that
+#    a miss reads S3 once and keeps the file in /tmp, and a read within the TTL doesn't go to S3
+#    after the TTL an unchanged file is revalidated with its ETag (a 304, no download) and a changed file is
+#    downloaded again
+#    within the stale window the old copy is returned right away and refreshed by a background revalidation
+#    a file deleted from S3 is dropped from /tmp on its next revalidation
+#    put writes both tiers, with the ETag S3 returned
+# Also times cached, revalidated and downloaded reads.  Exits with status 1 if a check fails.
+#
+# Needs moto (pip install moto).
+#
+# Run from server/aarcweeklyforward:  python benchmarks/bench_cache.py
+import os, shutil, sys, tempfile, time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(BENCH_DIR, '..'), BENCH_DIR]
+os.environ.update({'AWS_ACCESS_KEY_ID': 'benchmark', 'AWS_SECRET_ACCESS_KEY': 'benchmark', 'AWS_DEFAULT_REGION': 'us-east-1'})
+os.environ.pop('AWS_REGION', None)
+
+import boto3
+from moto import mock_aws
+
+BUCKET = 'aarclub-files'
+ROOT = f's3://{BUCKET}/weekly-emails/'
+KEY = 'aarc_stats.json'
+READS = 200
+
+
+def check(problems, name, condition):
+    if not condition:
+        problems.append(name)
+
+
+def changed(cache, before):
+    """The stats counters that changed since before."""
+    return {name: count - before.get(name, 0) for name, count in cache.stats.items() if count != before.get(name, 0)}
+
+
+def wait_for_revalidation(cache, key, timeout=5):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        with cache._lock:
+            if key not in cache._revalidating:
+                return True
+        time.sleep(0.01)
+    return False
+
+
+def timed(func, count=READS):
+    start = time.perf_counter()
+    for i in range(count):
+        func()
+    return (time.perf_counter() - start) / count * 1000
+
+
+@mock_aws
+def run(local_dir):
+    from chalicelib.cache import TwoTierCache
+    s3 = boto3.client('s3')
+    s3.create_bucket(Bucket=BUCKET)
+    put = lambda data: s3.put_object(Bucket=BUCKET, Key=f'weekly-emails/{KEY}', Body=data)['ETag']
+    cache = TwoTierCache(ROOT, local_dir=local_dir, s3_client=s3)
+    problems = []
+
+    put(b'{"members": 1}')
+    before = dict(cache.stats)
+    check(problems, 'miss returns the S3 copy', cache.get(KEY, ttl=60) == b'{"members": 1}')
+    check(problems, 'miss reads S3 once', changed(cache, before) == {'misses': 1, 'remote_reads': 1})
+    before = dict(cache.stats)
+    check(problems, 'read within the TTL returns the /tmp copy', cache.get(KEY, ttl=60) == b'{"members": 1}')
+    check(problems, 'read within the TTL does not go to S3', changed(cache, before) == {'hits': 1})
+
+    before = dict(cache.stats)
+    check(problems, 'revalidation of an unchanged file returns it', cache.get(KEY, ttl=0) == b'{"members": 1}')
+    check(problems, 'unchanged file is revalidated with a 304', changed(cache, before) == {'remote_reads': 1, 'revalidated': 1})
+
+    put(b'{"members": 2}')
+    before = dict(cache.stats)
+    check(problems, 'revalidation of a changed file downloads it', cache.get(KEY, ttl=0) == b'{"members": 2}')
+    check(problems, 'changed file is not counted as revalidated', changed(cache, before) == {'remote_reads': 1})
+    check(problems, 'downloaded file replaces the /tmp copy', cache.get(KEY, ttl=60) == b'{"members": 2}')
+
+    put(b'{"members": 3}')
+    before = dict(cache.stats)
+    check(problems, 'stale read returns the old copy', cache.get(KEY, ttl=0, stale_ttl=60) == b'{"members": 2}')
+    check(problems, 'background revalidation finishes', wait_for_revalidation(cache, KEY))
+    check(problems, 'stale read revalidates in the background', changed(cache, before) == {'stale_hits': 1, 'remote_reads': 1})
+    check(problems, 'background revalidation updates /tmp', cache.get(KEY, ttl=60) == b'{"members": 3}')
+
+    s3.delete_object(Bucket=BUCKET, Key=f'weekly-emails/{KEY}')
+    check(problems, 'revalidation of a deleted file returns None', cache.get(KEY, ttl=0) is None)
+    check(problems, 'deleted file is dropped from /tmp', cache._read_local(KEY) == (None, None))
+
+    cache.put_json(KEY, {'members': 4})
+    etag = s3.head_object(Bucket=BUCKET, Key=f'weekly-emails/{KEY}')['ETag']
+    check(problems, 'put writes S3', cache.get_json(KEY, ttl=60) == {'members': 4})
+    check(problems, 'put keeps the S3 ETag in /tmp', cache._read_local(KEY)[1]['etag'] == etag)
+    before = dict(cache.stats)
+    cache.get(KEY, ttl=0)
+    check(problems, 'file written by put revalidates with a 304', changed(cache, before) == {'remote_reads': 1, 'revalidated': 1})
+
+    hit = timed(lambda: cache.get(KEY, ttl=60))
+    revalidated = timed(lambda: cache.get(KEY, ttl=0))
+    downloaded = timed(lambda: (cache.invalidate(KEY), cache.get(KEY, ttl=60)))
+    print(f'per read: cached {hit:.2f} ms, revalidated {revalidated:.2f} ms, downloaded {downloaded:.2f} ms (moto, no network)')
+    return problems
+
+
+if __name__ == '__main__':
+    local_dir = tempfile.mkdtemp(prefix='aarc-cache-')
+    try:
+        problems = run(local_dir)
+    finally:
+        shutil.rmtree(local_dir, ignore_errors=True)
+    for problem in problems:
+        print(f'FAILED: {problem}')
+    print('All checks passed' if not problems else f'{len(problems)} checks failed')
+    sys.exit(1 if problems else 0)
@@ -0,0 +1,81 @@
+# Startup benchmark: time from a fresh interpreter importing app.py to the first response of each route.
+# Every route runs in its own process so each one sees a cold start, like a new Lambda container.
+# Routes that use WildApricot run in a fresh working directory against the fake WildApricot of synthetic.py,
+# with WA_CONTACTS contacts, so they need no credentials and start with a cold cache.
+#
+# Run from server/aarcweeklyforward:  python benchmarks/bench_cold_start.py [route ...]
+import os, sys, json, shutil, subprocess, tempfile
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.join(BENCH_DIR, '..')
+
+# Route -> view function in app.py
+ROUTES = {
+    '/': 'index',
+    '/club-contacts': 'club_contacts',
+    '/race-reg-contacts': 'race_reg_contacts',
+    '/emails': 'emails',
+}
+WA_ROUTES = {'/club-contacts'}
+WA_CONTACTS = 1000
+
+PROBE = '''
+import json, sys, time
+start = time.perf_counter()
+sys.path[:0] = [sys.argv[2], sys.argv[2] + '/vendor']
+import app
+imported = time.perf_counter()
+if len(sys.argv) > 3:
+    # The view imports wa_api anyway, so pointing it at the fake WildApricot adds nothing to the first response.
+    from chalicelib.wa_api import WaApiClient
+    WaApiClient.api_endpoint = sys.argv[3]
+    WaApiClient.auth_endpoint = sys.argv[3] + '/auth/token'
+error = None
+try:
+    getattr(app, sys.argv[1])()
+except Exception as exc:
+    error = repr(exc)
+done = time.perf_counter()
+print(json.dumps({'import': imported - start, 'first_response': done - start, 'error': error,
+                  'modules': len(sys.modules)}))
+'''
+
+
+def measure(route, view, wa=None):
+    args = [sys.executable, '-c', PROBE, view, os.path.abspath(APP_DIR)]
+    cwd, env = APP_DIR, None
+    if wa is not None:
+        args.append(wa.url)
+        cwd = tempfile.mkdtemp(prefix='aarc-cold-start-')
+        env = {key: value for key, value in os.environ.items() if not key.startswith('AWS_')}
+        env['TMPDIR'] = cwd # No cached WildApricot token either.
+        with open(os.path.join(cwd, 'wa_credentials.json'), 'w') as f:
+            json.dump({'client_id': 'benchmark', 'client_secret': 'benchmark', 'administrator_username': 'admin@example.com',
+                       'administrator_password': 'benchmark'}, f)
+    try:
+        result = subprocess.run(args, cwd=cwd, env=env, capture_output=True, text=True)
+    finally:
+        if wa is not None:
+            shutil.rmtree(cwd, ignore_errors=True)
+    try:
+        timing = json.loads(result.stdout.strip().splitlines()[-1])
+    except (IndexError, ValueError):
+        print(f'{route:<20} failed: {result.stderr.strip().splitlines()[-1:]}')
+        return
+    line = f'{route:<20} import {timing["import"] * 1000:7.0f} ms   first response {timing["first_response"] * 1000:7.0f} ms   {timing["modules"]} modules'
+    if timing['error']:
+        line += f'   error: {timing["error"]}'
+    print(line)
+
+
+if __name__ == '__main__':
+    routes = sys.argv[1:] or list(ROUTES)
+    wa = None
+    if WA_ROUTES.intersection(routes):
+        sys.path.insert(0, BENCH_DIR)
+        import synthetic
+        wa = synthetic.FakeWildApricot(WA_CONTACTS)
+    for route in routes:
+        measure(route, ROUTES[route], wa if route in WA_ROUTES else None)
+    if wa is not None:
+        wa.close()
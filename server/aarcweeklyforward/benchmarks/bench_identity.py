@@ -0,0 +1,70 @@
+# Identity resolution benchmark: time and accuracy of chalicelib.identity.resolve_identities on a synthetic
+# recipient index.  Runners register with several addresses (see synthetic.runner_email), and the synthetic
+# names are unique per runner, so the true person of every address is known.
+#   recall:     share of true same-person address pairs that were merged
+#   precision:  share of merged address pairs that belong to the same runner
+#
+# Run from server/aarcweeklyforward:  python benchmarks/bench_identity.py [registrations]
+import os, random, sys, time, tracemalloc
+from itertools import combinations
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(BENCH_DIR, '..'), BENCH_DIR]
+
+import synthetic
+from chalicelib.email_recipient import EmailRecipient, normalize_email, registration_date
+from chalicelib.identity import resolve_identities
+
+REGISTRATIONS = 300000
+
+
+def synthetic_index(registrations, seed=1):
+    """{email: EmailRecipient} for registrations spread over ten years, and {email: runner}."""
+    rng = random.Random(seed)
+    index = {}
+    truth = {}
+    runners = 0
+    for i in range(registrations):
+        year = 2014 + i * 10 // registrations
+        if runners and rng.random() < synthetic.RETURNING_RATE:
+            runner = rng.randrange(runners)
+        else:
+            runner = runners
+            runners += 1
+        row = synthetic.registration_row(rng, runner, year, 0)
+        email = normalize_email(row[8])
+        date = registration_date(row[38])
+        if email not in index:
+            index[email] = EmailRecipient(first_name=row[0], last_name=row[1], address=row[2], city=row[4], state=row[5],
+                                          zip=row[6], email=email, sex=row[9], birthdate=row[10], age=int(row[11]),
+                                          most_recent_contact=date, number_of_contacts=1)
+            truth[email] = runner
+        else:
+            index[email].number_of_contacts += 1
+            index[email].most_recent_contact = max(index[email].most_recent_contact, date)
+    return index, truth
+
+
+def pairs(groups):
+    return {pair for group in groups for pair in combinations(sorted(group), 2)}
+
+
+if __name__ == '__main__':
+    registrations = int(sys.argv[1]) if len(sys.argv) > 1 else REGISTRATIONS
+    index, truth = synthetic_index(registrations)
+    tracemalloc.start()
+    start = time.perf_counter()
+    persons, aliases = resolve_identities(index)
+    elapsed = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    found, expected = {}, {}
+    for email, primary in aliases.items():
+        found.setdefault(primary, []).append(email)
+        expected.setdefault(truth[email], []).append(email)
+    found_pairs, expected_pairs = pairs(found.values()), pairs(expected.values())
+    correct = len(found_pairs & expected_pairs)
+    print(f'{registrations} registrations, {len(index)} addresses, {len(expected)} runners, {len(persons)} persons found')
+    print(f'resolved in {elapsed:.2f}s ({len(index) / elapsed:,.0f} addresses/s), peak {peak / 1024 / 1024:.0f} MB traced')
+    print(f'recall {correct / max(len(expected_pairs), 1):.3f}  precision {correct / max(len(found_pairs), 1):.3f}')
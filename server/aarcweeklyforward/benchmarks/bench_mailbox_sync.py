@@ -0,0 +1,154 @@
+# Mailbox sync check: runs chalicelib.mailbox.sync_mailbox against the fake Gmail's inbox, seeded with ordinary
+# replies, unsubscribe replies from Gmail, Outlook and Yahoo, bounces and delay notices, and checks that
+#    the first sync backfills from a search and finds every unsubscribe and permanent bounce, and nothing else:
+#    not replies that only quote the weekly email's Unsubscribe footer, not messages that are not replies, not
+#    addresses a bounce mentions besides the failed recipient
+#    a later sync reads users.history.list and fetches only the messages delivered since
+#    a sync whose history ID has expired falls back to the search
+# Also times the first sync and counts the messages whose full body it had to fetch.  Exits with status 1 if a
+# check fails.
+#
+# Run from server/aarcweeklyforward:  python benchmarks/bench_mailbox_sync.py [messages]
+import datetime, os, pickle, random, shutil, sys, tempfile, time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(BENCH_DIR, '..'), os.path.join(BENCH_DIR, '..', 'vendor'), BENCH_DIR]
+os.environ.pop('AWS_REGION', None)
+
+import synthetic
+
+MESSAGES = 2000
+RELAY = 'AARC <ambler.area.running.club@gmail.com>'
+SUBJECT = 'AARC Weekly Update'
+REPLY = {'In-Reply-To': '<CAE1weekly@mail.gmail.com>', 'References': '<CAE1weekly@mail.gmail.com>'}
+WEEKLY_EMAIL = 'Join us Saturday for the club run.\nYou are receiving this because you registered for an AARC race. Unsubscribe\n'
+GMAIL_QUOTE = (f'\n\nOn Mon, May 11, 2020 at 10:00 AM {RELAY} wrote:\n'
+               + ''.join(f'> {line}\n' for line in WEEKLY_EMAIL.splitlines()))
+YAHOO_QUOTE = f'\n\n    On Monday, May 11, 2020, 10:00:00 AM EDT, {RELAY} wrote:\n\n{WEEKLY_EMAIL}'
+OUTLOOK_QUOTE = (f'\n\n________________________________\nFrom: {RELAY}\nSent: Monday, May 11, 2020 10:00 AM\n'
+                 f'To: runner@example.com\nSubject: {SUBJECT}\n\n{WEEKLY_EMAIL}')
+OUTLOOK_ORIGINAL = (f'\n\n-----Original Message-----\nFrom: {RELAY}\nSent: Monday, May 11, 2020 10:00 AM\n'
+                    f'Subject: {SUBJECT}\n\n{WEEKLY_EMAIL}')
+
+
+def dsn(runner, action, status):
+    """The message/delivery-status part of a delivery status notification for runner."""
+    return (f'Reporting-MTA: dns; mx.example.net\n\nFinal-Recipient: rfc822; {runner}\n'
+            f'Original-Recipient: rfc822;{runner}\nAction: {action}\nStatus: {status}\n')
+
+
+def returned_headers(runner):
+    return f'From: {RELAY}\nTo: {runner}\nSubject: {SUBJECT}\n'
+
+
+def seed(gmail, count, start=0, seed=1):
+    """Deliver count messages.  Returns the addresses that should end up on the opt-out list."""
+    rng = random.Random(seed + start)
+    expected = set()
+    for i in range(start, start + count):
+        runner = f'runner{i}@example.com'
+        kind = rng.random()
+        if kind < 0.1:
+            gmail.deliver(f'Runner {i} <{runner}>', f'Re: {SUBJECT}', 'Please unsubscribe me.' + GMAIL_QUOTE, REPLY)
+            expected.add(runner)
+        elif kind < 0.15:
+            gmail.deliver(f'{runner}', f'RE: {SUBJECT}', 'Please remove me from this list.' + OUTLOOK_QUOTE, REPLY)
+            expected.add(runner)
+        elif kind < 0.25:
+            gmail.deliver('Mail Delivery Subsystem <mailer-daemon@googlemail.com>', 'Delivery Status Notification (Failure)',
+                          f"Address not found\n\nYour message wasn't delivered to {runner} because the address couldn't be found.",
+                          {'X-Failed-Recipients': runner})
+            expected.add(runner)
+        elif kind < 0.3:
+            gmail.deliver('MAILER-DAEMON@mx.example.net', 'Undelivered Mail Returned to Sender',
+                          f'<{runner}>: host mx.example.net said: 550 5.1.1 User unknown. Contact postmaster@example.net.',
+                          parts=[('message/delivery-status', dsn(runner, 'failed', '5.1.1')),
+                                 ('text/rfc822-headers', returned_headers(runner))])
+            expected.add(runner)
+        elif kind < 0.35:
+            gmail.deliver('Mail Delivery Subsystem <mailer-daemon@googlemail.com>', 'Delivery Status Notification (Delay)',
+                          f'Delivery to {runner} has been delayed. Gmail will retry for 46 more hours.',
+                          parts=[('message/delivery-status', dsn(runner, 'delayed', '4.4.1'))])
+        elif kind < 0.38:
+            # Longer than a snippet, so only the body shows the request.
+            gmail.deliver(f'Runner {i} <{runner}>', f'Re: {SUBJECT}',
+                          'Thanks for all the updates over the years. ' * 6 + 'I moved away, please take me off the list.' + GMAIL_QUOTE,
+                          REPLY)
+            expected.add(runner)
+        elif kind < 0.4:
+            # No delivery status report, only the returned message's headers.
+            gmail.deliver('MAILER-DAEMON@mx.example.net', 'Undelivered Mail Returned to Sender',
+                          'This is the mail system at host mx.example.net. ' * 5 +
+                          '\n\nPlease contact postmaster@example.net.\n\n550 5.1.1 User unknown',
+                          parts=[('text/rfc822-headers', returned_headers(runner))])
+            expected.add(runner)
+        elif kind < 0.44:
+            # Only the quoted weekly email says Unsubscribe.
+            gmail.deliver(f'Runner {i} <{runner}>', f'Re: {SUBJECT}', 'See you Saturday!' + YAHOO_QUOTE, REPLY)
+        elif kind < 0.48:
+            gmail.deliver(f'Runner {i} <{runner}>', f'RE: {SUBJECT}', 'Count me in for the 8 AM group.' + OUTLOOK_ORIGINAL, REPLY)
+        elif kind < 0.5:
+            gmail.deliver(f'Running News <news@{i}.example.org>', 'Unsubscribe from our race alerts anytime', 'New races near you.')
+        else:
+            gmail.deliver(f'Runner {i} <{runner}>', f'Re: {SUBJECT}', 'See you Saturday!' + GMAIL_QUOTE, REPLY)
+    return expected
+
+
+def check(name, condition, problems):
+    print(f'{"ok  " if condition else "FAIL"} {name}')
+    if not condition:
+        problems.append(name)
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else MESSAGES
+    workdir = tempfile.mkdtemp(prefix='aarc-mailbox-')
+    os.environ['TMPDIR'] = os.path.join(workdir, 'tmp')
+    os.makedirs(os.environ['TMPDIR'])
+    tempfile.tempdir = None
+    os.chdir(workdir)
+    gmail = synthetic.FakeGmail(page_size=100)
+    problems = []
+    try:
+        import ezgmail
+        from google.oauth2.credentials import Credentials
+        from chalicelib import mailbox
+        from chalicelib.audience import read_opt_outs
+        credentials = Credentials('benchmark-token', expiry=datetime.datetime.utcnow() + datetime.timedelta(hours=1))
+        with open(ezgmail.TOKEN_FILE, 'wb') as f:
+            pickle.dump(credentials, f)
+        with open(ezgmail.DISCOVERY_FILE, 'r') as f:
+            ezgmail.DISCOVERY_DOCUMENT = gmail.discovery_document(f.read())
+
+        # The relayed subjects come from the send log.
+        from chalicelib import send_log
+        send_log.append_segment({'id': 'benchmark', 'email_key': 'benchmark', 'subject': SUBJECT}, 0, [],
+                                {'runner@example.com': 'benchmark'})
+
+        expected = seed(gmail, count)
+        start = time.perf_counter()
+        result = mailbox.sync_mailbox()
+        elapsed = time.perf_counter() - start
+        print(f'first sync: {count} messages in {elapsed:.2f}s ({count / elapsed:,.0f} messages/s), {gmail.batches} batches, '
+              f'{gmail.gets - gmail.metadata_gets} full message fetches')
+        check('backfill finds every unsubscribe and bounce', read_opt_outs() == expected, problems)
+
+        gets = gmail.metadata_gets
+        expected |= seed(gmail, 250, start=count)
+        result = mailbox.sync_mailbox()
+        check('history sync fetches only the new messages', gmail.metadata_gets - gets == 250 and result['messages'] == 250, problems)
+        check('history sync adds the new opt-outs', read_opt_outs() == expected, problems)
+
+        result = mailbox.sync_mailbox()
+        check('sync with nothing new fetches nothing', result['messages'] == 0, problems)
+
+        gmail.expire_history()
+        expected |= seed(gmail, 10, start=count + 250)
+        result = mailbox.sync_mailbox()
+        check('expired history falls back to the search', result['messages'] == count + 260, problems)
+        check('opt-outs after the fallback', read_opt_outs() == expected, problems)
+    finally:
+        gmail.close()
+        os.chdir(BENCH_DIR)
+        shutil.rmtree(workdir, ignore_errors=True)
+    sys.exit(1 if problems else 0)
@@ -0,0 +1,111 @@
+# Parallel registration ingest: checks that process_race_registrations gives the same recipient index with
+# one worker and with a thread pool, and that both match a reference built by reading every opted-in row
+# in registration date order.  Also times both runs.  Then checks that refreshing again, with the manifest
+# deleted or from an older MANIFEST_VERSION but the recipient index still saved, gives the same index instead of
+# merging every file into it a second time.  Exits with status 1 if the indexes differ.
+#
+# The files are synthetic (see synthetic.py) and local, so the timing shows parsing overlap only; on S3 the
+# parallel run also overlaps the round trips.
+#
+# Run from server/aarcweeklyforward:  python benchmarks/bench_parallel_ingest.py [rows]
+import csv, json, os, shutil, sys, tempfile, time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(BENCH_DIR, '..'), BENCH_DIR]
+os.environ.pop('AWS_REGION', None)
+
+import synthetic
+
+ROWS = 100000
+FIELDS = ('email', 'first_name', 'last_name', 'address', 'city', 'state', 'zip', 'sex', 'age', 'birthdate',
+          'number_of_contacts', 'most_recent_contact')
+
+
+def reference_index(directory, filenames):
+    """The recipient index built the slow, obvious way: all opted-in rows, stably sorted by registration date,
+    applied one at a time."""
+    from chalicelib.email_recipient import registration_date, registration_age, normalize_email
+    rows = []
+    for filename in filenames:
+        with open(os.path.join(directory, filename), newline='') as f:
+            for row in csv.DictReader(f):
+                if row.get('Mailing List') == 'Yes' and normalize_email(row['Email']):
+                    rows.append((registration_date(row['Registration Created']), row))
+    rows.sort(key=lambda item: item[0])
+    index = {}
+    for date, row in rows:
+        email = normalize_email(row['Email'])
+        details = {'email': email, 'first_name': row['First Name'], 'last_name': row['Last Name'],
+                   'address': row['Address'], 'city': row['City'], 'state': row['State'], 'zip': row['Zip'],
+                   'sex': row['Sex'], 'age': registration_age(row['Age']), 'birthdate': row['Birthdate'],
+                   'most_recent_contact': date}
+        if email not in index:
+            index[email] = dict(details, number_of_contacts=1)
+        elif date > index[email]['most_recent_contact']:
+            index[email] = dict(details, number_of_contacts=index[email]['number_of_contacts'] + 1)
+        else:
+            index[email]['number_of_contacts'] += 1
+    return index
+
+
+def snapshot(index):
+    return {email: {field: getattr(recipient, field) for field in FIELDS} for email, recipient in index.items()}
+
+
+def run(race_registrations, workers):
+    for name in (race_registrations.MANIFEST_FILENAME, race_registrations.INDEX_FILENAME):
+        if os.path.exists(f'race-regs/{name}'):
+            os.remove(f'race-regs/{name}')
+    shutil.rmtree(f'race-regs/{race_registrations.PARTIAL_INDEX_DIR}', ignore_errors=True)
+    start = time.perf_counter()
+    race_registrations.process_race_registrations(workers=workers)
+    elapsed = time.perf_counter() - start
+    return snapshot(race_registrations.read_recipient_index()[1]), elapsed
+
+
+def refresh_without_manifest(race_registrations, how):
+    """Refresh again over the saved indexes after deleting the manifest, or after marking it as written by the
+    previous MANIFEST_VERSION."""
+    path = f'race-regs/{race_registrations.MANIFEST_FILENAME}'
+    if how == 'missing':
+        os.remove(path)
+    else:
+        with open(path, 'r') as f:
+            manifest = json.load(f)
+        manifest['version'] = race_registrations.MANIFEST_VERSION - 1
+        with open(path, 'w') as f:
+            json.dump(manifest, f)
+    race_registrations.process_race_registrations()
+    return snapshot(race_registrations.read_recipient_index()[1])
+
+
+def differences(name, index, expected):
+    problems = [f'{name}: {len(index)} recipients, expected {len(expected)}'] if len(index) != len(expected) else []
+    for email in sorted(expected):
+        if index.get(email) != expected[email]:
+            problems.append(f'{name}: {email} is {index.get(email)}, expected {expected[email]}')
+    return problems
+
+
+if __name__ == '__main__':
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else ROWS
+    workdir = tempfile.mkdtemp(prefix='aarc-ingest-')
+    os.chdir(workdir)
+    try:
+        filenames = synthetic.write_registration_files('race-regs', rows)
+        from chalicelib import race_registrations
+        sequential, sequential_time = run(race_registrations, 1)
+        parallel, parallel_time = run(race_registrations, race_registrations.FETCH_WORKERS)
+        expected = reference_index('race-regs', filenames)
+        problems = differences('sequential', sequential, expected) + differences('parallel', parallel, expected)
+        for how in ('missing', 'old version'):
+            problems += differences(f'manifest {how}', refresh_without_manifest(race_registrations, how), expected)
+        print(f'{rows} rows, {len(expected)} recipients')
+        print(f'sequential {sequential_time:.2f}s  parallel ({race_registrations.FETCH_WORKERS} workers) {parallel_time:.2f}s')
+        for problem in problems[:20]:
+            print(problem)
+        print('Indexes match' if not problems else f'{len(problems)} differences')
+    finally:
+        os.chdir(BENCH_DIR)
+        shutil.rmtree(workdir, ignore_errors=True)
+    sys.exit(1 if problems else 0)
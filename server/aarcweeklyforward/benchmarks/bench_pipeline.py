@@ -0,0 +1,196 @@
+# End to end benchmark of the weekly email pipeline on synthetic data (see synthetic.py):
+#   race_registrations: process_race_registrations() over RTD .csv files with `rows` rows in total
+#   aarc_stats:         WaUtils().refresh_aarc_stats() against a fake WildApricot with rows / 10 contacts; the
+#                       paged counts must match the fake's contacts and active members
+#   email_body:         WaUtils().get_email_body() against the fake WildApricot's SentEmails, from a cold cache
+#   relay:              emailer.relay_email() to rows / 100 recipients through a fake Gmail batch endpoint
+# Each run happens in a fresh process and a fresh working directory (the local, non-S3 mode of the app), so
+# caches start cold and the peak RSS belongs to that run.  The fake services run in this process.  Every
+# scenario is run --repeat times and the fastest run is reported.
+#
+# Results are compared with benchmarks/baselines.json, and a run that is slower or uses more memory than its
+# baseline by more than the tolerance is reported as a regression (exit status 1).  Baselines are machine
+# specific; refresh them with --update-baselines after a deliberate change or on a new machine.
+#
+# Run from server/aarcweeklyforward:
+#   python benchmarks/bench_pipeline.py [--rows 10000 100000 1000000] [--scenario relay ...] [--update-baselines]
+import argparse, json, os, resource, shutil, subprocess, sys, tempfile, time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.join(BENCH_DIR, '..')
+BASELINES_FILE = os.path.join(BENCH_DIR, 'baselines.json')
+SCENARIOS = ['race_registrations', 'aarc_stats', 'email_body', 'relay']
+DEFAULT_ROWS = [10000, 100000]
+TOLERANCE = 0.25
+NOISE_SECONDS = 0.1 # Slowdowns smaller than this are timer and scheduling noise, whatever the percentage.
+REPEAT = 3 # Runs per scenario and size; the fastest is reported, to keep timer noise out of the comparison.
+SENT_EMAILS = 500
+
+
+def scenario_size(scenario, rows):
+    return {'race_registrations': rows, 'aarc_stats': max(rows // 10, 1000), 'email_body': 1,
+            'relay': max(rows // 100, 100)}[scenario]
+
+
+# Child process: set up the working directory for one scenario and time it.
+
+def run(scenario, size, wa_url, gmail_url):
+    sys.path[:0] = [APP_DIR, os.path.join(APP_DIR, 'vendor')]
+    from chalicelib.wa_api import WaApiClient
+    WaApiClient.api_endpoint = wa_url
+    WaApiClient.auth_endpoint = f'{wa_url}/auth/token'
+    with open('wa_credentials.json', 'w') as f:
+        json.dump({'client_id': 'benchmark', 'client_secret': 'benchmark', 'administrator_username': 'admin@example.com',
+                   'administrator_password': 'benchmark'}, f)
+
+    if scenario == 'race_registrations':
+        from chalicelib.race_registrations import process_race_registrations
+        func = process_race_registrations
+    elif scenario == 'aarc_stats':
+        from chalicelib.wa_utils import WaUtils
+        func = lambda: WaUtils().refresh_aarc_stats()
+    elif scenario == 'email_body':
+        from chalicelib.wa_utils import WaUtils
+        func = lambda: WaUtils().get_email_body()
+    else:
+        import datetime, pickle
+        import ezgmail
+        from google.oauth2.credentials import Credentials
+        from chalicelib import emailer
+        from chalicelib.audience import write_audience
+        from chalicelib.wa_utils import WaUtils
+        credentials = Credentials('benchmark-token', expiry=datetime.datetime.utcnow() + datetime.timedelta(hours=1))
+        with open(ezgmail.TOKEN_FILE, 'wb') as f:
+            pickle.dump(credentials, f)
+        with open(ezgmail.DISCOVERY_FILE, 'r') as f:
+            ezgmail.DISCOVERY_DOCUMENT = f.read().replace('https://gmail.googleapis.com/', f'{gmail_url}/')
+        write_audience({f'runner{i}@example.com' for i in range(size)})
+        func = lambda: emailer.relay_email(WaUtils())
+
+    start = time.perf_counter()
+    result = func()
+    seconds = time.perf_counter() - start
+    print(json.dumps({'seconds': seconds, 'peak_mb': peak_rss_mb(), 'result': result if scenario == 'aarc_stats' else None}))
+
+
+def peak_rss_mb():
+    # ru_maxrss survives exec, so in a child of a large parent it can report the parent's size.  VmHWM starts
+    # over with the new address space.
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except FileNotFoundError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+# Parent process
+
+def measure(scenario, rows, fakes):
+    import synthetic
+    size = scenario_size(scenario, rows)
+    workdir = tempfile.mkdtemp(prefix='aarc-bench-')
+    try:
+        if scenario == 'race_registrations':
+            synthetic.write_registration_files(os.path.join(workdir, 'race-regs'), size)
+        wa = synthetic.FakeWildApricot(size if scenario == 'aarc_stats' else 0, SENT_EMAILS)
+        gmail = fakes['gmail']
+        sent_before = len(gmail.sent)
+        os.makedirs(os.path.join(workdir, 'tmp'))
+        env = {key: value for key, value in os.environ.items() if not key.startswith('AWS_')}
+        env['TMPDIR'] = os.path.join(workdir, 'tmp')
+        result = subprocess.run([sys.executable, os.path.abspath(__file__), '--run', scenario, '--size', str(size),
+                                 '--wa-url', wa.url, '--gmail-url', gmail.url],
+                                cwd=workdir, env=env, capture_output=True, text=True)
+        wa.close()
+        try:
+            timing = json.loads(result.stdout.strip().splitlines()[-1])
+        except (IndexError, ValueError):
+            print(f'{scenario:<20} {size:>9,} failed: {result.stderr.strip().splitlines()[-1:]}')
+            return None
+        stats = timing.pop('result')
+        if scenario == 'aarc_stats':
+            expected = {'contacts': len(wa.contacts), 'members': sum(contact['Status'] == 'Active' for contact in wa.contacts)}
+            counted = {key: stats[key] for key in expected}
+            if counted != expected:
+                print(f'{scenario:<20} {size:>9,} counted {counted}, the fake WildApricot has {expected}')
+                return None
+        if scenario == 'relay' and len(gmail.sent) - sent_before != size:
+            print(f'{scenario:<20} fake Gmail received {len(gmail.sent) - sent_before} of {size} messages')
+        timing['items'] = size
+        timing['throughput'] = size / timing['seconds']
+        return timing
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def compare(timing, baseline, tolerance):
+    """Returns a list of regressions of timing against baseline."""
+    if baseline is None:
+        return []
+    regressions = []
+    slowdown = timing['seconds'] - timing['items'] / baseline['throughput']
+    if timing['throughput'] < baseline['throughput'] * (1 - tolerance) and slowdown > NOISE_SECONDS:
+        regressions.append(f'throughput {timing["throughput"] / baseline["throughput"] - 1:+.0%}')
+    if timing['peak_mb'] > baseline['peak_mb'] * (1 + tolerance):
+        regressions.append(f'peak memory {timing["peak_mb"] / baseline["peak_mb"] - 1:+.0%}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the weekly email pipeline on synthetic data.')
+    parser.add_argument('--rows', type=int, nargs='+', default=DEFAULT_ROWS, help='RTD registration rows (other sizes scale with it)')
+    parser.add_argument('--scenario', nargs='+', choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument('--repeat', type=int, default=REPEAT, help='runs per scenario, the fastest is reported')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE, help='allowed slowdown or memory growth, e.g. 0.25')
+    parser.add_argument('--update-baselines', action='store_true', help='save these results as the baselines')
+    parser.add_argument('--run', choices=SCENARIOS, help=argparse.SUPPRESS)
+    parser.add_argument('--size', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--wa-url', help=argparse.SUPPRESS)
+    parser.add_argument('--gmail-url', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.run:
+        return run(args.run, args.size, args.wa_url, args.gmail_url)
+
+    sys.path.insert(0, BENCH_DIR)
+    import synthetic
+    try:
+        with open(BASELINES_FILE, 'r') as f:
+            baselines = json.load(f)
+    except FileNotFoundError:
+        baselines = {}
+
+    fakes = {'gmail': synthetic.FakeGmail()}
+    failed = False
+    for rows in args.rows:
+        for scenario in args.scenario:
+            timings = [measure(scenario, rows, fakes) for i in range(args.repeat)]
+            timing = None if None in timings else min(timings, key=lambda timing: timing['seconds'])
+            if timing is None:
+                failed = True
+                continue
+            key = f'{scenario}/{rows}'
+            regressions = compare(timing, baselines.get(key), args.tolerance)
+            line = (f'{scenario:<20} {timing["items"]:>9,} items {timing["seconds"]:8.2f}s '
+                    f'{timing["throughput"]:>12,.0f}/s  peak {timing["peak_mb"]:7.1f} MB')
+            if regressions:
+                line += '   REGRESSION: ' + ', '.join(regressions)
+                failed = True
+            elif key not in baselines:
+                line += '   (no baseline)'
+            print(line)
+            if args.update_baselines:
+                baselines[key] = {'throughput': round(timing['throughput'], 1), 'peak_mb': round(timing['peak_mb'], 1)}
+    fakes['gmail'].close()
+
+    if args.update_baselines:
+        with open(BASELINES_FILE, 'w') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+        print(f'Saved baselines to {BASELINES_FILE}')
+    return 1 if failed and not args.update_baselines else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
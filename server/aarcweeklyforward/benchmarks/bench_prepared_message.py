@@ -0,0 +1,94 @@
+# Microbenchmark for building the relayed weekly email.
+#   before: a new MIMEText per recipient, serialized and base64 encoded by ezgmail._createMessage()
+#   after:  one ezgmail.PreparedMessage, with only the To header encoded per recipient
+# and for personalized copies, each with its own unsubscribe link in the body and a List-Unsubscribe header:
+#   personalized before:  the link put in with str.replace and a new MIMEText per recipient
+#   personalized after:   one ezgmail.PreparedTemplate, with only the headers and the link encoded per recipient
+# The personalized copies are checked by parsing one back.
+#
+# Run from server/aarcweeklyforward:  python benchmarks/bench_prepared_message.py
+import base64, email, os, sys, time
+from email import policy
+from email.mime.text import MIMEText
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'vendor'))
+import ezgmail
+
+BODY_SIZE = 50 * 1024
+MESSAGES = 2000
+SENDER = 'ambler.area.running.club@gmail.com'
+SUBJECT = 'AARC Weekly Update'
+FOOTER = '<p><a href="{{unsubscribe_url}}">Unsubscribe</a></p>'
+
+
+def weekly_body(size, footer=''):
+    paragraph = '<p>Join us Saturday at 8:00 AM for the club run from Ambler Park. All paces welcome!</p>\n'
+    return ('<html><body>' + paragraph * (size // len(paragraph) + 1))[:size] + footer + '</body></html>'
+
+
+def unsubscribe_url(address):
+    return 'https://api.example.com/unsubscribe?t=' + base64.urlsafe_b64encode(address.encode()).decode() + '.' + 'M' * 22
+
+
+def personalized_before(body, addresses):
+    for address in addresses:
+        url = unsubscribe_url(address)
+        message = MIMEText(body.replace('{{unsubscribe_url}}', url), 'html', 'utf-8')
+        message['List-Unsubscribe'] = f'<{url}>'
+        ezgmail._createMessage(SENDER, address, SUBJECT, message)
+
+
+def personalized_after(body, addresses):
+    template = ezgmail.PreparedTemplate(SENDER, SUBJECT, body)
+    for address in addresses:
+        url = unsubscribe_url(address)
+        template.create(address, {'List-Unsubscribe': f'<{url}>'}, {'unsubscribe_url': url})
+
+
+def check_personalized(body, address):
+    url = unsubscribe_url(address)
+    raw = ezgmail.PreparedTemplate(SENDER, SUBJECT, body).create(address, {'List-Unsubscribe': f'<{url}>'}, {'unsubscribe_url': url})['raw']
+    message = email.message_from_bytes(base64.urlsafe_b64decode(raw), policy=policy.default)
+    return (message.get_content() == body.replace('{{unsubscribe_url}}', url) and message['To'] == address
+            and message['List-Unsubscribe'].strip() == f'<{url}>')
+
+
+def recipients(count):
+    return [f'runner{i}@example.com' for i in range(count)]
+
+
+def before(body, addresses):
+    for address in addresses:
+        ezgmail._createMessage(SENDER, address, SUBJECT, MIMEText(body, 'html', 'utf-8'))
+
+
+def after(body, addresses):
+    prepared = ezgmail.PreparedMessage(SENDER, SUBJECT, MIMEText(body, 'html', 'utf-8'))
+    for address in addresses:
+        prepared.create(address)
+
+
+def measure(name, func, body, addresses):
+    start = time.perf_counter()
+    func(body, addresses)
+    elapsed = time.perf_counter() - start
+    rate = len(addresses) / elapsed
+    print(f'{name:<20} {len(addresses)} messages in {elapsed:.2f}s  {rate:,.0f} messages/s')
+    return rate
+
+
+if __name__ == '__main__':
+    body = weekly_body(BODY_SIZE)
+    addresses = recipients(MESSAGES)
+    print(f'Body size: {len(body)} chars')
+    before_rate = measure('before', before, body, addresses)
+    after_rate = measure('after', after, body, addresses)
+    print(f'Speedup: {after_rate / before_rate:.1f}x')
+
+    body = weekly_body(BODY_SIZE, FOOTER)
+    before_rate = measure('personalized before', personalized_before, body, addresses)
+    after_rate = measure('personalized after', personalized_after, body, addresses)
+    print(f'Speedup: {after_rate / before_rate:.1f}x')
+    if not all(check_personalized(body, address) for address in addresses[:3] + ['Rénée <renee@example.com>']):
+        print('FAIL personalized copy does not parse back to the body with its link')
+        sys.exit(1)
@@ -0,0 +1,86 @@
+# Memory benchmark for 100k race registration recipients.
+#   before: the original EmailRecipient, with class level defaults and a per-instance __dict__
+#   after:  chalicelib.email_recipient.EmailRecipient, with __slots__, interned strings and int dates
+#
+# Run from server/aarcweeklyforward:  python benchmarks/bench_recipient_memory.py
+import os, sys, random, tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from chalicelib.email_recipient import EmailRecipient, registration_date, registration_age
+
+RECIPIENTS = 100000
+
+CITIES = [('Ambler', 'PA'), ('Blue Bell', 'PA'), ('Fort Washington', 'PA'), ('Horsham', 'PA'), ('Lansdale', 'PA'),
+          ('North Wales', 'PA'), ('Philadelphia', 'PA'), ('Mt Laurel', 'NJ'), ('Wilmington', 'DE')]
+MONTHS = ['January', 'February', 'March', 'April', 'May', 'June']
+
+
+class DictEmailRecipient:
+    """EmailRecipient as it was before __slots__."""
+    first_name = ''
+    last_name = ''
+    address = ''
+    address2 = ''
+    city = ''
+    state = ''
+    zip = ''
+    email = ''
+    sex = ''
+    age = 0
+    mailing_list = False
+    aarc_member = False
+    number_of_contacts = 0
+    most_recent_contact = ''
+    emails_sent = 0
+    emails_opened = 0
+    opted_out = False
+    opt_out_date = ''
+
+
+def registration_rows(count):
+    # Each row's strings are built separately, as csv.reader does, so equal values are not shared objects.
+    rng = random.Random(1)
+    for i in range(count):
+        city, state = rng.choice(CITIES)
+        yield {'first_name': f'First{i}', 'last_name': f'Last{i}', 'address': f'{rng.randint(1, 9999)} Main St',
+               'address2': '', 'city': ''.join(city), 'state': ''.join(state), 'zip': f'{rng.randint(19000, 19499)}',
+               'email': f'runner{i}@example.com', 'sex': ''.join(rng.choice(['Male', 'Female'])),
+               'age': str(rng.randint(10, 80)), 'mailing_list': 'Yes',
+               'most_recent_contact': f'{rng.choice(MONTHS)} {rng.randint(1, 28)}, 2019 - {rng.randint(1, 12)}:{rng.randint(0, 59):02} PM'}
+
+
+def before(rows):
+    recipients = {}
+    for row in rows:
+        recipient = DictEmailRecipient()
+        for attribute, value in row.items():
+            setattr(recipient, attribute, value)
+        recipient.number_of_contacts = 1
+        recipients[recipient.email] = recipient
+    return recipients
+
+
+def after(rows):
+    recipients = {}
+    for row in rows:
+        recipient = EmailRecipient(**row)
+        recipient.age = registration_age(recipient.age)
+        recipient.most_recent_contact = registration_date(recipient.most_recent_contact)
+        recipient.number_of_contacts = 1
+        recipients[recipient.email] = recipient
+    return recipients
+
+
+def measure(name, func):
+    tracemalloc.start()
+    recipients = func(registration_rows(RECIPIENTS))
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f'{name:<8} {len(recipients)} recipients  {current / 1024 / 1024:.1f} MB retained')
+    return current
+
+
+if __name__ == '__main__':
+    before_bytes = measure('before', before)
+    after_bytes = measure('after', after)
+    print(f'Reduction: {100 * (1 - after_bytes / before_bytes):.0f}%')
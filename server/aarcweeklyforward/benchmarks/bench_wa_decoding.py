@@ -0,0 +1,88 @@
+# Benchmark for decoding a multi-MB WildApricot Contacts response and counting active members,
+# the way WaUtils.refresh_aarc_stats uses it.
+#   eager: the original ApiObject, which wraps every nested dict and list item up front
+#   lazy:  chalicelib.wa_api.ApiObject, which wraps nested values when they are first read
+#   raw:   plain decoded JSON, as returned by execute_request(..., raw=True)
+#
+# Run from server/aarcweeklyforward:  python benchmarks/bench_wa_decoding.py
+import os, sys, json, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from chalicelib.wa_api import ApiObject
+
+CONTACTS = 10000
+ROUNDS = 5
+
+
+class EagerApiObject(object):
+    """ApiObject as it was before lazy wrapping."""
+
+    def __init__(self, state):
+        self.__dict__ = state
+        for key, value in vars(self).items():
+            if isinstance(value, dict):
+                self.__dict__[key] = EagerApiObject(value)
+            elif isinstance(value, list):
+                new_list = []
+                for list_item in value:
+                    if isinstance(list_item, dict):
+                        new_list.append(EagerApiObject(list_item))
+                    else:
+                        new_list.append(list_item)
+                self.__dict__[key] = new_list
+
+
+def contacts_payload(count):
+    contacts = []
+    for i in range(count):
+        contacts.append({
+            'Id': 10000 + i,
+            'Url': f'https://api.wildapricot.org/v2.2/accounts/30507/Contacts/{10000 + i}',
+            'FirstName': f'First{i}', 'LastName': f'Last{i}', 'Email': f'runner{i}@example.com',
+            'DisplayName': f'Last{i}, First{i}', 'Organization': '',
+            'ProfileLastUpdated': '2020-05-01T12:00:00-04:00',
+            'MembershipLevel': {'Id': 1207614, 'Url': 'https://api.wildapricot.org/v2.2/accounts/30507/MembershipLevels/1207614', 'Name': 'Individual'},
+            'MembershipEnabled': True,
+            'Status': 'Active' if i % 3 else 'Lapsed',
+            'IsAccountAdministrator': False,
+            'TermsOfUseAccepted': True,
+            'FieldValues': [{'FieldName': f'Field {n}', 'Value': {'Id': n, 'Label': f'Value {n}'}, 'SystemCode': f'custom-{n}'}
+                            for n in range(8)],
+        })
+    return json.dumps({'Contacts': contacts}).encode()
+
+
+def eager(payload):
+    response = EagerApiObject(json.loads(payload))
+    contacts = [contact.__dict__ for contact in response.__dict__['Contacts']]
+    return sum(1 for contact in contacts if contact.get('Status') == 'Active')
+
+
+def lazy(payload):
+    response = ApiObject(json.loads(payload))
+    return sum(1 for contact in response.Contacts if contact.Status == 'Active')
+
+
+def raw(payload):
+    response = json.loads(payload)
+    return sum(1 for contact in response['Contacts'] if contact.get('Status') == 'Active')
+
+
+def measure(name, func, payload):
+    best = None
+    for i in range(ROUNDS):
+        start = time.perf_counter()
+        members = func(payload)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print(f'{name:<6} {members} active members  {best * 1000:.0f} ms')
+    return best
+
+
+if __name__ == '__main__':
+    payload = contacts_payload(CONTACTS)
+    print(f'Payload: {CONTACTS} contacts, {len(payload) / 1024 / 1024:.1f} MB')
+    eager_time = measure('eager', eager, payload)
+    lazy_time = measure('lazy', lazy, payload)
+    raw_time = measure('raw', raw, payload)
+    print(f'lazy is {eager_time / lazy_time:.1f}x and raw is {eager_time / raw_time:.1f}x faster than eager')
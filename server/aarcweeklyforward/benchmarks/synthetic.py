@@ -0,0 +1,351 @@
+# Synthetic data and fake services for the benchmarks.
+#   RTD registration .csv files with the Phil's and FB header layouts
+#   WildApricot Contacts and SentEmails payloads, served with an OAuth token endpoint by a local fake WildApricot
+#   a local fake Gmail that accepts batched users.messages.send requests and serves an inbox for the mailbox sync
+# Everything is generated from a seed, so runs with the same sizes see the same data.
+import base64, csv, datetime, html, json, os, random, re, threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from email.parser import BytesParser
+from email import policy
+
+# Header rows of the 2019 RTD exports.  The FB (5-Miler) export has two club questions at the end, the Phil's
+# export has one race question, and both end with empty columns.
+COMMON_HEADER = ['First Name', 'Last Name', 'Address', 'Address2', 'City', 'State', 'Zip', 'Phone', 'Email', 'Sex',
+                 'Birthdate', 'Age', 'Emergency Name', 'Emergency Phone', 'Manual Entry', 'Manual Entry Notes',
+                 'Registration Type', 'Registration Type Name', 'Event', 'Shirt Type', 'Shirt Size', 'Target Time',
+                 'Projected Pace', 'Club', 'Waiver', 'Total Price', 'Event Price', 'Race Fee', 'T-Shirt Price',
+                 'Merchandise', 'Merchandise Size', 'Merchandise Price', 'Donation Amount', 'Donation Fee',
+                 'Coupon Code', 'Coupon Savings', '# Raffle Tickets', 'Mailing List', 'Registration Created',
+                 'Registration Paid']
+PHILS_HEADER = COMMON_HEADER + ['Have you run the Phils Tavern Quarter Marathon before?  If so, how many times?', '', '', '', '']
+FB_HEADER = COMMON_HEADER + ['Would you like more information about the Ambler Area Running Club?',
+                             "Would you like to join or learn more about AARC's USATF team?", '', '', '']
+LAYOUTS = {'phils': PHILS_HEADER, 'fb': FB_HEADER}
+
+CITIES = [('Ambler', 'PA', '19002'), ('Blue Bell', 'PA', '19422'), ('Fort Washington', 'PA', '19034'),
+          ('Horsham', 'PA', '19044'), ('Lansdale', 'PA', '19446'), ('North Wales', 'PA', '19454'),
+          ('Philadelphia', 'PA', '19128'), ('Mt Laurel', 'NJ', '08054'), ('Wilmington', 'DE', '19801')]
+MONTHS = ['January', 'February', 'March', 'April', 'May', 'June', 'July', 'August', 'September', 'October',
+          'November', 'December']
+OPT_IN_RATE = 0.7
+RETURNING_RATE = 0.4 # Share of registrations by runners seen in an earlier file
+ALIAS_RATE = 0.03 # Share of registrations with another address for the runner, and again with odd case and spaces
+
+WA_ACCOUNT = 30507
+WEEKLY_EMAIL_SUBJECT = 'AARC Weekly Update'
+
+
+def registration_files(rows, files=10, first_year=2014):
+    """Returns [(filename, layout, year, rows)] splitting rows over files, alternating Phil's and FB races."""
+    plan = []
+    for n in range(files):
+        layout = 'phils' if n % 2 == 0 else 'fb'
+        year = first_year + n // 2
+        plan.append((f'{year}_{layout}_registrations.csv', layout, year, rows // files + (1 if n < rows % files else 0)))
+    return plan
+
+
+def write_registration_files(directory, rows, files=10, seed=1):
+    """Write RTD registration files with rows rows in total and a reg_files.json listing them.  Returns the filenames."""
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+    runners = 0
+    filenames = []
+    for filename, layout, year, count in registration_files(rows, files):
+        header = LAYOUTS[layout]
+        with open(os.path.join(directory, filename), 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            for i in range(count):
+                if runners and rng.random() < RETURNING_RATE:
+                    runner = rng.randrange(runners)
+                else:
+                    runner = runners
+                    runners += 1
+                writer.writerow(registration_row(rng, runner, year, len(header)))
+        filenames.append(filename)
+    with open(os.path.join(directory, 'reg_files.json'), 'w') as f:
+        json.dump({'reg_files': filenames}, f)
+    return filenames
+
+
+def runner_email(rng, runner, year):
+    """Most registrations use the runner's usual address.  Some type it with different case or spaces, and some
+    use another address, so identity resolution has something to do."""
+    draw = rng.random()
+    if draw < ALIAS_RATE:
+        return f'runner{runner}.{year}@example.org'
+    if draw < 2 * ALIAS_RATE:
+        return f' Runner{runner}@Example.com '
+    return f'runner{runner}@example.com'
+
+
+def name_suffix(runner):
+    """The runner number spelled in letters (12 -> 'bc'): names are unique per runner and, like real names,
+    have no digits, which identity resolution strips."""
+    return ''.join('abcdefghij'[int(digit)] for digit in str(runner))
+
+
+def registration_row(rng, runner, year, width):
+    city, state, zip_code = CITIES[runner % len(CITIES)]
+    birth_year = 1945 + runner % 60
+    hour = rng.randint(1, 12)
+    created = f'{MONTHS[rng.randrange(12)]} {rng.randint(1, 28)}, {year} - {hour}:{rng.randint(0, 59):02} {"AM" if runner % 2 else "PM"}'
+    row = [f'First{name_suffix(runner)}', f'Last{name_suffix(runner)}', f'{100 + runner % 9900} Main St', '', city, state, zip_code,
+           f'215555{runner % 10000:04}', runner_email(rng, runner, year), 'Female' if runner % 2 else 'Male',
+           f'{1 + runner % 12}-{1 + runner % 28}-{birth_year}', str(year - birth_year), '', '', 'N', '', 'Individual',
+           'Registration', '5-Miler', '', 'None', '0:0', '', '', 'Y', '40.00', '40.00', '0', '0', '', '', '0', '0', '0',
+           '', '0', '', 'Yes' if rng.random() < OPT_IN_RATE else 'No', created, created]
+    return row + [''] * (width - len(row))
+
+
+def contacts(count, seed=1, base_url='https://api.wildapricot.org'):
+    """WildApricot Contacts entries with the fields returned for $select='e-Mail','Membership status'."""
+    rng = random.Random(seed)
+    return [{'Id': 10000 + i, 'Url': f'{base_url}/v2.2/accounts/{WA_ACCOUNT}/Contacts/{10000 + i}',
+             'FirstName': f'First{i}', 'LastName': f'Last{i}', 'Email': f'runner{i * 7}@example.com',
+             'DisplayName': f'Last{i}, First{i}', 'Organization': '', 'ProfileLastUpdated': '2020-05-01T12:00:00-04:00',
+             'MembershipEnabled': True, 'Status': 'Active' if rng.random() < 0.6 else 'Lapsed',
+             'IsAccountAdministrator': False, 'TermsOfUseAccepted': True,
+             'FieldValues': [{'FieldName': 'Membership status', 'Value': {'Id': 1, 'Label': 'Active'}, 'SystemCode': 'Status'}]}
+            for i in range(count)]
+
+
+def sent_emails(count, weekly_every=7, base_url='https://api.wildapricot.org'):
+    """SentEmails entries, newest first, with a weekly email every weekly_every entries."""
+    emails = []
+    newest = datetime.datetime(2020, 12, 31, 8)
+    for i in range(count):
+        email_id = 900000 + count - i
+        weekly = i % weekly_every == weekly_every - 1
+        emails.append({'Id': email_id, 'Url': f'{base_url}/v2/Accounts/{WA_ACCOUNT}/SentEmails/{email_id}',
+                       'Type': 'EmailBlast_Members' if weekly else 'EventRegistration',
+                       'Subject': f'{WEEKLY_EMAIL_SUBJECT} #{email_id}' if weekly else f'Registration confirmation {email_id}',
+                       'SentDate': (newest - datetime.timedelta(hours=12 * i)).strftime('%Y-%m-%dT%H:%M:%S-05:00'),
+                       'IsScheduled': False, 'RecipientCount': 1200})
+    return emails
+
+
+def weekly_body(size=50 * 1024):
+    paragraph = '<p>Join us Saturday at 8:00 AM for the club run from Ambler Park. All paces welcome!</p>\n'
+    return ('<html><body>' + paragraph * (size // len(paragraph) + 1))[:size] + '</body></html>'
+
+
+def _start(handler):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}'
+
+
+class FakeWildApricot(object):
+    """Local WildApricot with the token endpoint, paged Contacts and SentEmails.  url is the api_endpoint and
+    url + '/auth/token' the auth_endpoint to give WaApiClient."""
+
+    def __init__(self, contact_count, sent_email_count=500, body_size=50 * 1024):
+        self.contacts = []
+        self.sent_emails = []
+        self.body = weekly_body(body_size)
+        self.requests = 0
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, payload):
+                data = json.dumps(payload).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                fake.requests += 1
+                self._reply({'access_token': 'benchmark-token', 'token_type': 'Bearer', 'expires_in': 1800,
+                             'refresh_token': 'benchmark-refresh', 'Permissions': [{'AccountId': WA_ACCOUNT}]})
+
+            def do_GET(self):
+                fake.requests += 1
+                url = urlparse(self.path)
+                query = {key: values[0] for key, values in parse_qs(url.query).items()}
+                if url.path.endswith('/Contacts'):
+                    skip, top = int(query.get('$skip', 0)), int(query.get('$top', len(fake.contacts)))
+                    self._reply({'Contacts': fake.contacts[skip:skip + top]})
+                elif url.path.endswith('/SentEmails'):
+                    emails = fake.sent_emails
+                    if 'StartDate' in query:
+                        emails = [email for email in emails if email['SentDate'][:10] >= query['StartDate']]
+                    self._reply({'Emails': emails[:int(query.get('$top', len(emails)))]})
+                else:
+                    email_id = int(re.search(r'/SentEmails/(\d+)', url.path).group(1))
+                    email = next(email for email in fake.sent_emails if email['Id'] == email_id)
+                    self._reply(dict(email, Body=fake.body))
+
+        self.server, self.url = _start(Handler)
+        self.contacts = contacts(contact_count, base_url=self.url)
+        self.sent_emails = sent_emails(sent_email_count, base_url=self.url)
+
+    def close(self):
+        self.server.shutdown()
+
+
+class FakeGmail(object):
+    """Local Gmail API.  Every users.messages.send in a batch succeeds, except that a fail_rate share of first
+    attempts get a 429.  sent holds the raw message of every accepted send.
+
+    It also has an inbox for the mailbox sync: deliver() adds a message, and users.getProfile, users.history.list,
+    users.messages.list and users.messages.get (also in batches) answer from it, page_size items per page.
+    expire_history() makes older history IDs return 404 like Gmail does after about a week."""
+
+    BOUNDARY = 'batch_response'
+
+    def __init__(self, fail_rate=0.0, seed=1, page_size=100):
+        self.sent = []
+        self.batches = 0
+        self.messages = {}
+        self.history = [] # [(history id, message id)], oldest first
+        self.history_id = 1000
+        self.oldest_history_id = 0
+        self.page_size = page_size
+        self.gets = 0
+        self.metadata_gets = 0
+        rng = random.Random(seed)
+        failed = set()
+        lock = threading.Lock()
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, status, payload):
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                self._reply(*fake.get(self.path))
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                request = BytesParser(policy=policy.HTTP).parsebytes(
+                    b'Content-Type: ' + self.headers['Content-Type'].encode() + b'\r\n\r\n' + body)
+                parts = []
+                with lock:
+                    fake.batches += 1
+                for part in request.iter_parts():
+                    inner = part.get_content()
+                    if isinstance(inner, bytes):
+                        inner = inner.decode()
+                    method, path = inner.split(' ', 2)[:2]
+                    if method == 'GET':
+                        status, payload = fake.get(path)
+                    else:
+                        raw = json.loads(re.split(r'\r?\n\r?\n', inner, 1)[1])['raw']
+                        with lock:
+                            if raw not in failed and rng.random() < fail_rate:
+                                failed.add(raw)
+                                status, payload = 429, {'error': {'code': 429, 'message': 'Rate limit exceeded'}}
+                            else:
+                                status, payload = 200, {'id': f'm{len(fake.sent)}', 'labelIds': ['SENT']}
+                                fake.sent.append(raw)
+                    data = json.dumps(payload)
+                    parts.append(f'--{fake.BOUNDARY}\r\nContent-Type: application/http\r\n'
+                                 f'Content-ID: <response-{part["Content-ID"][1:-1]}>\r\n\r\n'
+                                 f'HTTP/1.1 {status} X\r\nContent-Type: application/json\r\nContent-Length: {len(data)}\r\n\r\n{data}\r\n')
+                data = (''.join(parts) + f'--{fake.BOUNDARY}--\r\n').encode()
+                self.send_response(200)
+                self.send_header('Content-Type', f'multipart/mixed; boundary={fake.BOUNDARY}')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self.server, self.url = _start(Handler)
+
+    def deliver(self, sender, subject, body, headers=None, parts=None):
+        """Add a plain text message to the inbox, or with parts, a list of (MIME type, text) parts that follow the
+        text, a multipart/report such as a delivery status notification.  Returns its id.  Like Gmail's, the
+        snippet is the start of the text with whitespace collapsed and HTML escaped."""
+        self.history_id += 1
+        message_id = f'{self.history_id:x}'
+        content_type = 'multipart/report; report-type=delivery-status' if parts else 'text/plain; charset="UTF-8"'
+        headers = dict({'From': sender, 'To': 'ambler.area.running.club@gmail.com', 'Subject': subject,
+                        'Content-Type': content_type}, **(headers or {}))
+        headers = [{'name': name, 'value': value} for name, value in headers.items()]
+        text = {'partId': '', 'mimeType': 'text/plain', 'filename': '', 'headers': headers,
+                'body': {'size': len(body), 'data': base64.urlsafe_b64encode(body.encode()).decode()}}
+        if parts:
+            parts = [('text/plain', body)] + list(parts)
+            payload = {'partId': '', 'mimeType': 'multipart/report', 'filename': '', 'headers': headers, 'body': {'size': 0},
+                       'parts': [{'partId': str(i), 'mimeType': mime_type, 'filename': '',
+                                  'headers': [{'name': 'Content-Type', 'value': mime_type}],
+                                  'body': {'size': len(part), 'data': base64.urlsafe_b64encode(part.encode()).decode()}}
+                                 for i, (mime_type, part) in enumerate(parts)]}
+        else:
+            payload = text
+        self.messages[message_id] = {
+            'id': message_id, 'threadId': message_id, 'labelIds': ['INBOX', 'UNREAD'],
+            'snippet': html.escape(' '.join(body.split())[:200]),
+            'historyId': str(self.history_id), 'internalDate': str(1590000000000 + self.history_id * 1000),
+            'sizeEstimate': len(body),
+            'payload': payload}
+        self.history.append((self.history_id, message_id))
+        return message_id
+
+    def expire_history(self):
+        self.oldest_history_id = self.history_id + 1
+
+    def _page(self, items, query):
+        start = int(query.get('pageToken') or 0)
+        size = min(int(query.get('maxResults', self.page_size)), self.page_size)
+        page = items[start:start + size]
+        return page, (str(start + size) if start + size < len(items) else None)
+
+    def get(self, path):
+        """Returns (status, payload) for a GET request of the Gmail API."""
+        url = urlparse(path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        resource = url.path.split('/users/', 1)[1].split('/', 1)[1]
+        if resource == 'profile':
+            return 200, {'emailAddress': 'ambler.area.running.club@gmail.com', 'historyId': str(self.history_id)}
+        if resource == 'history':
+            start = int(query['startHistoryId'])
+            if start < self.oldest_history_id:
+                return 404, {'error': {'code': 404, 'message': 'Requested entity was not found.'}}
+            records = [{'id': str(history_id), 'messagesAdded': [{'message': {'id': message_id, 'threadId': message_id}}]}
+                       for history_id, message_id in self.history if history_id > start]
+            page, token = self._page(records, query)
+            return 200, dict({'history': page, 'historyId': str(self.history_id)}, **({'nextPageToken': token} if token else {}))
+        if resource == 'messages':
+            listed = [{'id': message_id, 'threadId': message_id} for history_id, message_id in reversed(self.history)]
+            page, token = self._page(listed, query)
+            return 200, dict({'messages': page, 'resultSizeEstimate': len(listed)}, **({'nextPageToken': token} if token else {}))
+        message_id = resource.split('/')[-1]
+        self.gets += 1
+        if message_id not in self.messages:
+            return 404, {'error': {'code': 404, 'message': 'Requested entity was not found.'}}
+        message = self.messages[message_id]
+        if query.get('format') == 'metadata':
+            self.metadata_gets += 1
+            wanted = {name.lower() for name in parse_qs(url.query).get('metadataHeaders', [])}
+            headers = [header for header in message['payload']['headers'] if not wanted or header['name'].lower() in wanted]
+            message = dict(message, payload={'mimeType': message['payload']['mimeType'], 'headers': headers})
+        return 200, message
+
+    def discovery_document(self, document):
+        """The Gmail discovery document with its root URL pointed at this server."""
+        return document.replace('https://gmail.googleapis.com/', f'{self.url}/')
+
+    def close(self):
+        self.server.shutdown()
@@ -0,0 +1,123 @@
+import datetime
+from chalicelib.object_store import ObjectStore
+from chalicelib.email_recipient import normalize_email
+
+# Weekly email audience
+# The addresses the weekly email is relayed to:
+#    race registrants who answered Yes to "Okay to send emails", one address per person (the race_registrations person index)
+#    minus AARC members, who already receive the email directly from the club
+#    minus runners who opted out
+# Every source is reduced to a set of normalized addresses and the audience is computed with set differences,
+# so each refresh is linear in the size of the lists.  The audience is saved with a delta against the previous
+# one (addresses added and removed), so later steps can work on the changes instead of the whole list.
+#
+#    audience/current.json            {'created', 'emails': [sorted addresses]}
+#    audience/delta-<YYYYMMDDHHMM>.json  {'created', 'previous', 'added', 'removed'}
+#    audience/latest_delta.json       copy of the newest delta
+#    opt_outs.json                    [addresses], written by the unsubscribe handling
+#
+# Unsubscribe requests and mailbox syncs add opt-outs at the same time, so opt_outs.json is only ever updated
+# with a conditional put (ObjectStore.update_json), and an addition that loses a race is made again on the newer list.
+
+AUDIENCE_PREFIX = 'audience/'
+CURRENT_FILENAME = f'{AUDIENCE_PREFIX}current.json'
+LATEST_DELTA_FILENAME = f'{AUDIENCE_PREFIX}latest_delta.json'
+DELTA_FILENAME = AUDIENCE_PREFIX + 'delta-{}.json'
+OPT_OUTS_FILENAME = 'opt_outs.json'
+
+store = ObjectStore()
+
+
+def normalize_emails(emails):
+    """Returns the set of normalized addresses in emails, dropping anything that is not an address."""
+    normalized = set(map(normalize_email, emails))
+    normalized.discard(None)
+    return normalized
+
+
+def build_audience(registrants, members, opt_outs):
+    return normalize_emails(registrants) - normalize_emails(members) - normalize_emails(opt_outs)
+
+
+def audience_delta(previous, current):
+    """Returns (added, removed) as sorted lists."""
+    return sorted(current - previous), sorted(previous - current)
+
+
+def read_audience():
+    """Returns the current audience as a set of addresses, empty if it has never been built."""
+    audience = store.get_json(CURRENT_FILENAME)
+    return set(audience['emails']) if audience else set()
+
+
+def read_latest_delta():
+    return store.get_json(LATEST_DELTA_FILENAME)
+
+
+def read_opt_outs():
+    return normalize_emails(store.get_json(OPT_OUTS_FILENAME) or [])
+
+
+def add_opt_outs(emails):
+    """Add addresses to the opt-out list.  Returns the addresses that were not already on it."""
+    emails = normalize_emails(emails)
+    new = set()
+
+    def add(saved):
+        opt_outs = normalize_emails(saved or [])
+        new.clear()
+        new.update(emails - opt_outs)
+        return sorted(opt_outs | new) if new else None
+
+    if emails:
+        store.update_json(OPT_OUTS_FILENAME, add)
+    return new
+
+
+def write_audience(audience):
+    """Save the audience and its delta against the previous one.  Returns the delta."""
+    previous = store.get_json(CURRENT_FILENAME)
+    added, removed = audience_delta(set(previous['emails']) if previous else set(), audience)
+    created = datetime.datetime.utcnow()
+    delta = {
+        'created': created.isoformat(),
+        'previous': previous['created'] if previous else None,
+        'added': added,
+        'removed': removed,
+    }
+    store.put_json(DELTA_FILENAME.format(created.strftime('%Y%m%d%H%M')), delta)
+    store.put_json(LATEST_DELTA_FILENAME, delta)
+    store.put_json(CURRENT_FILENAME, {'created': delta['created'], 'emails': sorted(audience)})
+    return delta
+
+
+def refresh_audience(wa_client):
+    """Rebuild the audience from the person index, the WildApricot members and the opt-outs, save it with its
+    delta, and add the recipients that are new to the recipient store.
+    A person is left out if any of their addresses belongs to a member or has opted out, and gets the email at
+    their primary address only."""
+    from chalicelib.race_registrations import read_person_index
+    from chalicelib.emailer import open_recipient_store
+
+    recipients, aliases = read_person_index()
+    members = normalize_emails(wa_client.iter_member_emails())
+    recipient_store = open_recipient_store()
+    opt_outs = read_opt_outs() | normalize_emails(recipient_store.emails('opted_out'))
+    members = {aliases.get(email, email) for email in members}
+    opt_outs = {aliases.get(email, email) for email in opt_outs}
+
+    audience = build_audience(recipients, members, opt_outs)
+    delta = write_audience(audience)
+
+    # Only the additions touch the recipient store.  Removed recipients keep their records and counters.
+    new_recipients = []
+    for email in delta['added']:
+        if email not in recipient_store:
+            new_recipients.append(recipients[email])
+    if new_recipients:
+        recipient_store.upsert(new_recipients)
+    recipient_store.close()
+
+    print(f'Audience: {len(audience)} of {len(recipients)} registrants, {len(delta["added"])} added, {len(delta["removed"])} removed')
+    return {'registrants': len(recipients), 'members': len(members), 'opt-outs': len(opt_outs),
+            'recipients': len(audience), 'added': len(delta['added']), 'removed': len(delta['removed'])}
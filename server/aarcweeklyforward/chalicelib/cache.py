@@ -0,0 +1,180 @@
+import hashlib, json, os, tempfile, threading, time
+
+DIR_PREFIX = "s3://aarclub-files/weekly-emails/" if 'AWS_REGION' in os.environ else ""
+
+# Two tier cache
+# Files such as stats documents and tokens are kept in /tmp (tier 1) and in S3 or the local directory (tier 2).
+# A /tmp copy younger than its TTL is used as is.  An older copy is revalidated with its ETag (If-None-Match on
+# S3), so an unchanged file is not downloaded again.  Within the stale window after the TTL the old copy is
+# returned right away and revalidated in a background thread.
+#
+# root is a prefix like DIR_PREFIX: 's3://bucket/path/' for S3, otherwise a local directory prefix.
+
+DEFAULT_TTL = 300
+DEFAULT_STALE_TTL = 0
+NOT_MODIFIED = object()
+
+
+class TwoTierCache(object):
+
+    def __init__(self, root=DIR_PREFIX, ttls=None, default_ttl=DEFAULT_TTL, stale_ttl=DEFAULT_STALE_TTL,
+                 local_dir=None, s3_client=None):
+        self.root = root
+        self.ttls = ttls or {}
+        self.default_ttl = default_ttl
+        self.stale_ttl = stale_ttl
+        self.local_dir = os.path.join(local_dir or tempfile.gettempdir(), 'cache',
+                                      hashlib.md5(root.encode()).hexdigest()[:8])
+        self._s3 = s3_client
+        if root.startswith('s3://'):
+            self.bucket, self.prefix = root[len('s3://'):].split('/', 1)
+        else:
+            self.bucket, self.prefix = None, root
+        self.stats = {'hits': 0, 'stale_hits': 0, 'revalidated': 0, 'misses': 0, 'remote_reads': 0, 'remote_writes': 0}
+        self._revalidating = set()
+        self._lock = threading.Lock()
+
+    @property
+    def s3(self):
+        if self._s3 is None:
+            import boto3
+            self._s3 = boto3.client('s3')
+        return self._s3
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    # Tier 1: /tmp
+
+    def _local_path(self, key):
+        return os.path.join(self.local_dir, key.replace('/', '__'))
+
+    def _read_local(self, key):
+        try:
+            with open(self._local_path(key) + '.meta', 'r') as f:
+                meta = json.load(f)
+            with open(self._local_path(key), 'rb') as f:
+                return f.read(), meta
+        except (FileNotFoundError, ValueError):
+            return None, None
+
+    def _write_local(self, key, data, etag):
+        os.makedirs(self.local_dir, exist_ok=True)
+        path = self._local_path(key)
+        with open(path, 'wb') as f:
+            f.write(data)
+        self._write_meta(key, etag)
+
+    def _write_meta(self, key, etag):
+        with open(self._local_path(key) + '.meta', 'w') as f:
+            json.dump({'etag': etag, 'fetched_at': time.time()}, f)
+
+    # Tier 2: S3 or the local directory
+
+    def _read_remote(self, key, etag=None):
+        """Returns (data, etag), NOT_MODIFIED if the remote copy still has etag, or None if there is no remote copy."""
+        self._count('remote_reads')
+        if self.bucket is None:
+            try:
+                with open(f'{self.prefix}{key}', 'rb') as f:
+                    data = f.read()
+            except FileNotFoundError:
+                return None
+            remote_etag = hashlib.md5(data).hexdigest()
+            return NOT_MODIFIED if remote_etag == etag else (data, remote_etag)
+
+        from botocore.exceptions import ClientError
+        params = {'Bucket': self.bucket, 'Key': f'{self.prefix}{key}'}
+        if etag:
+            params['IfNoneMatch'] = etag
+        try:
+            response = self.s3.get_object(**params)
+        except ClientError as error:
+            code = error.response.get('Error', {}).get('Code')
+            if code in ('304', 'NotModified'):
+                return NOT_MODIFIED
+            if code in ('404', 'NoSuchKey'):
+                return None
+            raise
+        return response['Body'].read(), response['ETag']
+
+    def _write_remote(self, key, data):
+        self._count('remote_writes')
+        if self.bucket is None:
+            with open(f'{self.prefix}{key}', 'wb') as f:
+                f.write(data)
+            return hashlib.md5(data).hexdigest()
+        return self.s3.put_object(Bucket=self.bucket, Key=f'{self.prefix}{key}', Body=data)['ETag']
+
+    # Cache
+
+    def _revalidate(self, key, data, etag):
+        """Check the remote copy and update /tmp.  Returns the current data, or None if the remote copy is gone."""
+        remote = self._read_remote(key, etag)
+        if remote is NOT_MODIFIED:
+            self._count('revalidated')
+            self._write_meta(key, etag)
+            return data
+        if remote is None:
+            return None
+        data, etag = remote
+        self._write_local(key, data, etag)
+        return data
+
+    def _background_revalidate(self, key, data, etag):
+        try:
+            self._revalidate(key, data, etag)
+        except Exception as exc:
+            print(f'Background revalidation of {key} failed: {exc}')
+        finally:
+            with self._lock:
+                self._revalidating.discard(key)
+
+    def get(self, key, ttl=None, stale_ttl=None):
+        """Returns the bytes cached for key, or None if neither tier has it."""
+        ttl = self.ttls.get(key, self.default_ttl) if ttl is None else ttl
+        stale_ttl = self.stale_ttl if stale_ttl is None else stale_ttl
+        data, meta = self._read_local(key)
+        if data is not None:
+            age = time.time() - meta['fetched_at']
+            if age < ttl:
+                self._count('hits')
+                return data
+            if age < ttl + stale_ttl:
+                self._count('stale_hits')
+                with self._lock:
+                    start = key not in self._revalidating
+                    self._revalidating.add(key)
+                if start:
+                    threading.Thread(target=self._background_revalidate, args=(key, data, meta['etag']), daemon=True).start()
+                return data
+            data = self._revalidate(key, data, meta['etag'])
+            if data is None:
+                self.invalidate(key)
+            return data
+        self._count('misses')
+        remote = self._read_remote(key)
+        if remote is None:
+            return None
+        data, etag = remote
+        self._write_local(key, data, etag)
+        return data
+
+    def put(self, key, data):
+        """Store bytes for key in both tiers."""
+        etag = self._write_remote(key, data)
+        self._write_local(key, data, etag)
+
+    def get_json(self, key, ttl=None, stale_ttl=None):
+        data = self.get(key, ttl, stale_ttl)
+        return None if data is None else json.loads(data)
+
+    def put_json(self, key, value):
+        self.put(key, json.dumps(value, indent=2).encode())
+
+    def invalidate(self, key):
+        """Drop the /tmp copy so the next get goes to S3."""
+        for path in (self._local_path(key), self._local_path(key) + '.meta'):
+            if os.path.exists(path):
+                os.remove(path)
@@ -0,0 +1,70 @@
+import datetime, hashlib, json, os
+from chalicelib.cache import TwoTierCache
+
+DIR_PREFIX = "s3://aarclub-files/weekly-emails/" if 'AWS_REGION' in os.environ else ""
+
+# Dashboard
+# The admin page shows three sections: club contacts, race registrations and the email log.  Each refresh that
+# changes a section writes it into one snapshot, dashboard.json, so /dashboard answers with a single cache read
+# instead of reading three stats files.  The snapshot's ETag is a hash of its sections; the browser sends it back
+# in If-None-Match and gets a 304 while nothing changed.
+#
+#    dashboard.json    {'etag', 'updated', 'sections': {'club-contacts', 'race-reg-contacts', 'emails'}}
+#
+# Sections missing from the snapshot (e.g. before the first refresh after this was deployed) are read from their
+# own stats files once and saved.  Two refreshes of different sections at the same moment can overwrite each
+# other's update; the lost section is current again after its next refresh.
+
+DASHBOARD_FILENAME = 'dashboard.json'
+SECTIONS = ('club-contacts', 'race-reg-contacts', 'emails')
+DASHBOARD_TTL = 60 # Seconds the /tmp copy is served before it is revalidated against S3.
+
+cache = TwoTierCache(DIR_PREFIX, ttls={DASHBOARD_FILENAME: DASHBOARD_TTL})
+
+
+def snapshot_etag(sections):
+    return '"' + hashlib.sha1(json.dumps(sections, sort_keys=True).encode()).hexdigest()[:20] + '"'
+
+
+def save(sections):
+    dashboard = {'etag': snapshot_etag(sections), 'updated': datetime.datetime.utcnow().isoformat(),
+                 'sections': sections}
+    cache.put_json(DASHBOARD_FILENAME, dashboard)
+    return dashboard
+
+
+def update_section(name, value):
+    """Replace one section of the snapshot, if it changed."""
+    dashboard = cache.get_json(DASHBOARD_FILENAME, ttl=0) or {'sections': {}}
+    if dashboard['sections'].get(name) == value:
+        return dashboard
+    return save(dict(dashboard['sections'], **{name: value}))
+
+
+def read_section(name):
+    """A section from its own stats file, for a snapshot that doesn't have it yet."""
+    if name == 'club-contacts':
+        from chalicelib import wa_utils
+        return wa_utils.cache.get_json(wa_utils.STATS_FILENAME) or {}
+    if name == 'race-reg-contacts':
+        from chalicelib.race_registrations import get_registration_stats
+        return get_registration_stats() or {}
+    from chalicelib.send_log import email_stats
+    return email_stats()
+
+
+def read_dashboard():
+    """Returns the snapshot: {'etag', 'updated', 'sections'}."""
+    dashboard = cache.get_json(DASHBOARD_FILENAME) or {'sections': {}}
+    missing = [name for name in SECTIONS if name not in dashboard['sections']]
+    if missing:
+        dashboard = save(dict(dashboard['sections'], **{name: read_section(name) for name in missing}))
+    return dashboard
+
+
+def etag_matches(if_none_match, etag):
+    """True if an If-None-Match header value names etag (weak or strong) or is *."""
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in tags or etag in (tag[2:] if tag.startswith('W/') else tag for tag in tags)
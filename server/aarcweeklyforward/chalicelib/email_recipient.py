@@ -1,26 +1,87 @@
+from sys import intern
+from datetime import datetime
+from functools import lru_cache
+
+
+@lru_cache(maxsize=4096)
+def registration_date(text):
+    """Convert an RTD registration timestamp such as 'February 20, 2019 - 5:51 PM' to an int YYYYMMDDHHMM, or 0 if it can't be parsed."""
+    try:
+        return int(datetime.strptime(text.strip(), '%B %d, %Y - %I:%M %p').strftime('%Y%m%d%H%M'))
+    except ValueError:
+        return 0
+
+
+def registration_year(text):
+    """The year of an RTD registration timestamp, taken from after the comma without parsing the rest, or 0."""
+    year = text.partition(', ')[2][:4]
+    return int(year) if year.isdigit() else 0
+
+
+def normalize_email(email):
+    """Returns the lower case address without surrounding whitespace, or None if it is not an email address."""
+    if not email:
+        return None
+    email = email.strip().lower()
+    return email if '@' in email else None
+
+
+def registration_age(text):
+    try:
+        return int(text)
+    except ValueError:
+        return 0
+
+
 class EmailRecipient:
 
-    first_name = ''
-    last_name = ''
-    address = ''
-    address2 = ''
-    city = ''
-    state = ''
-    zip = ''
-    email = ''
-    sex = ''
-    age = 0
-    mailing_list = False
-    aarc_member = False
-    number_of_contacts = 0
-    most_recent_contact = ''
-    emails_sent = 0
-    emails_opened = 0
-    opted_out = False
-    opt_out_date = ''
-
-    def __init__(self):
-        pass
+    # One recipient is kept for every opted-in registrant, so attributes live in slots rather than a per-instance
+    # __dict__.  city, state and sex repeat across thousands of recipients and are interned.  age is an int and
+    # most_recent_contact is the registration date as an int of the form YYYYMMDDHHMM (0 if unknown).
+    __slots__ = ('first_name', 'last_name', 'address', 'address2', 'city', 'state', 'zip', 'email', 'sex',
+                 'age', 'birthdate', 'mailing_list', 'aarc_member', 'number_of_contacts', 'most_recent_contact',
+                 'emails_sent', 'emails_opened', 'opted_out', 'opt_out_date')
+
+    _defaults = {
+        'first_name': '',
+        'last_name': '',
+        'address': '',
+        'address2': '',
+        'city': '',
+        'state': '',
+        'zip': '',
+        'email': '',
+        'sex': '',
+        'age': 0,
+        'birthdate': '',
+        'mailing_list': False,
+        'aarc_member': False,
+        'number_of_contacts': 0,
+        'most_recent_contact': 0,
+        'emails_sent': 0,
+        'emails_opened': 0,
+        'opted_out': False,
+        'opt_out_date': '',
+    }
+
+    def __init__(self, **fields):
+        for attribute, value in self._defaults.items():
+            setattr(self, attribute, fields.get(attribute, value))
+        self.city = intern(self.city)
+        self.state = intern(self.state)
+        self.sex = intern(self.sex)
+
+    def __getstate__(self):
+        return {attribute: getattr(self, attribute) for attribute in self.__slots__}
+
+    def __setstate__(self, state):
+        # Pickles written before __slots__ was added hold the instance __dict__, which only has the attributes that were set,
+        # and kept age and most_recent_contact as the strings read from the registration file.
+        self.__init__(**state)
+        if isinstance(self.age, str):
+            self.age = registration_age(self.age)
+        if isinstance(self.most_recent_contact, str):
+            self.most_recent_contact = registration_date(self.most_recent_contact)
 
     def __repr__(self):
         class_name = self.__class__.__name__
@@ -28,4 +89,3 @@ class EmailRecipient:
 
     def __str__(self):
         return str(self.email)
-
@@ -1,79 +1,124 @@
-from chalicelib.email_recipient import EmailRecipient
+from chalicelib.recipient_store import RecipientStore
+from chalicelib.cache import TwoTierCache
+from chalicelib import metrics
 import pickle, os
-from chalicelib.wa_api import WaApiClient
 import ezgmail, urllib
 from urllib.parse import urlencode
-from email.mime.text import MIMEText
-import tempfile, boto3
+import tempfile
+from smart_open import open as smart_open
 
 DIR_PREFIX = "s3://aarclub-files/weekly-emails/" if 'AWS_REGION' in os.environ else ""
 
+# The Gmail token is read through the same /tmp + S3 cache as the stats files.  It only changes when it is refreshed,
+# so the /tmp copy is trusted for an hour and then revalidated against S3.
+TOKEN_TTL = 3600
+ezgmail.TOKEN_CACHE = TwoTierCache(DIR_PREFIX, default_ttl=TOKEN_TTL)
+
 # Mailing list management
-# email_recipients contains the list of email addresses to relay messages.  It is created from:
+# The relay audience is built by chalicelib.audience from:
 #    race_registrants: runners who registered for AARC races on Run The Day and answered Yes to "Okay to send emails"
 #    aarc_members: runners to exclude since they already receive emails from directly from AARC
 #    opt_outs: runners who unsubscribed earlier
-#
-race_registrants = []
-aarc_members = []
-opt_outs = []
-email_recipients = {}
-
-# Short list for testing
-email_recipients = { 'aarcky.penguin@yahoo.com': EmailRecipient(),
-                     'hcohe1u@yahoo.com': EmailRecipient(),
-                     'hcohe1u@gmail.com': EmailRecipient(),
-                     'howard.cohen@email.com': EmailRecipient(), }
-
-# Pickled dictionary containing email recipient addresses and tracking info
+
+# Pickled dictionary containing email recipient addresses and tracking info.
+# Replaced by the RecipientStore database, and only read to migrate it.
 RECIPIENT_FILENAME = f'{DIR_PREFIX}weekly_email_recipients.p'
 
 
 def read_email_recipient_file():
-    if os.path.exists(RECIPIENT_FILENAME):
-        return pickle.load(open(RECIPIENT_FILENAME, 'rb'))
-    else:
+    try:
+        return pickle.load(smart_open(RECIPIENT_FILENAME, 'rb'))
+    except (FileNotFoundError, OSError, ValueError):
         return None
 
 
-def write_email_recipient_file(recipient_dict):
-    pickle.dump(recipient_dict, open(RECIPIENT_FILENAME, 'wb'))
-
+def open_recipient_store():
+    """Open the recipient store, migrating the old pickled recipient dict into it the first time."""
+    store = RecipientStore()
+    if len(store) == 0:
+        recipient_dict = read_email_recipient_file()
+        if recipient_dict:
+            store.migrate_from_dict(recipient_dict)
+    return store
 
-def filter_aarc_members(recipient_dict, member_dict):
-    filtered = 0
-    for runner_email in member_dict.keys():
-        if runner_email in recipient_dict:
-            recipient_dict.pop(runner_email)
-            filtered += 1
-    return filtered
 
+RELAY_SENDER = 'ambler.area.running.club@gmail.com'
 
-def do_some_analytics(recipient_dict):
-    hist = {}
-    for runner in recipient_dict.values():
-        if runner.number_of_contacts in hist:
-            hist[runner.number_of_contacts] += 1
-        else:
-            hist[runner.number_of_contacts] = 1
-    return
-    
 
 def send_test_email():
-    s3 = boto3.client('s3')
-    ezgmail.init(userId='ambler.area.running.club@gmail.com')
+    ezgmail.init(userId=RELAY_SENDER)
     print(f'Ezgmail initialized for {ezgmail.EMAIL_ADDRESS}')
     ezgmail.send('hcohe1u@gmail.com', 'Hello from AARC', 'Pop, pop, popsicle, Ice, ice, icecycle, Test, test, testing one two three')
     return True
 
 
-def relay_email(wa_client):
-    s3 = boto3.client('s3')
-    ezgmail.init(userId='ambler.area.running.club@gmail.com')
-    subject, body = wa_client.get_email_body()
-    if subject is not None and body is not None:
-        for email in email_recipients.keys():
-            print(f'Sending {len(body)} chars to {email}')
-            ezgmail.send(email, subject, MIMEText(body, 'html', 'utf-8'))
-    return True
-
+# Each recipient's copy has their own unsubscribe link, in UNSUBSCRIBE_FOOTER and the List-Unsubscribe headers.
+# The body is split at the link once per chunk (an ezgmail.PreparedTemplate) and the links are made in bulk, so a
+# copy costs a join of the encoded pieces and the encoding of its link, not an encoding of the whole body.
+UNSUBSCRIBE_FOOTER = ('<p style="font-size:small;text-align:center">You are receiving this because you registered for '
+                      'an AARC race. <a href="{{unsubscribe_url}}">Unsubscribe</a></p>')
+
+
+def add_unsubscribe_footer(body):
+    """The body with UNSUBSCRIBE_FOOTER at the end of its <body>, or at the end if it has none."""
+    end = body.lower().rfind('</body>')
+    return body + UNSUBSCRIBE_FOOTER if end < 0 else body[:end] + UNSUBSCRIBE_FOOTER + body[end:]
+
+
+def send_weekly_email(subject, body, recipients, on_batch=None):
+    """Send the weekly email to each of recipients.  Returns the list of addresses it was sent to and a dict of failures.
+    on_batch is optionally called with the addresses each Gmail batch request sent to, as soon as it completes."""
+    from chalicelib.unsubscribe import unsubscribe_urls
+    with metrics.stage('gmail.init'):
+        ezgmail.init(userId=RELAY_SENDER)
+    print(f'Sending {len(body)} chars to {len(recipients)} recipients')
+    with metrics.stage('gmail.prepare'):
+        template = ezgmail.PreparedTemplate(ezgmail.EMAIL_ADDRESS, subject, add_unsubscribe_footer(body))
+        urls = unsubscribe_urls(recipients)
+        headers = {email: {'List-Unsubscribe': f'<{url}>', 'List-Unsubscribe-Post': 'List-Unsubscribe=One-Click'}
+                   for email, url in urls.items()}
+        values = {email: {'unsubscribe_url': url} for email, url in urls.items()}
+    if on_batch is not None:
+        report = lambda results: on_batch([email for email, result in results.items() if not isinstance(result, Exception)])
+    else:
+        report = None
+    with metrics.stage('gmail.send'):
+        results = ezgmail.send_many(recipients, subject, template, recipientHeaders=headers, recipientValues=values,
+                                    onBatch=report)
+    sent = [email for email, result in results.items() if not isinstance(result, Exception)]
+    failed = {email: str(result) for email, result in results.items() if isinstance(result, Exception)}
+    for email, error in failed.items():
+        print(f'Unable to send to {email}: {error}')
+    print(f'Sent {len(sent)} emails, {len(failed)} failed')
+    metrics.count('messages.sent', len(sent))
+    metrics.count('messages.failed', len(failed))
+    return sent, failed
+
+
+def record_sent(segments):
+    """Count one more email for each address sent to in segments, {send log segment key: [email]}.  Called by the
+    send log fold; a segment that was counted before, e.g. by a concurrent fold, is not counted again."""
+    segments = {key: sent for key, sent in segments.items() if sent}
+    if segments:
+        with metrics.stage('recipients.update'):
+            store = open_recipient_store()
+            for key, sent in segments.items():
+                store.increment_once(key, sent)
+            store.close()
+
+
+def relay_email(wa_client, queue=None):
+    """Submit a relay job for the newest weekly email, if it was sent after the last one relayed.  Returns the job
+    id, or None if there is no new email to relay."""
+    from chalicelib.relay_jobs import submit_job
+    from chalicelib.audience import read_audience, read_opt_outs
+    email = wa_client.find_new_weekly_email(wa_client.read_email_cursor())
+    if email is None:
+        print('No new weekly email to relay')
+        return None
+    weekly_email = wa_client.get_weekly_email(email)
+    # Opt-outs found by the mailbox sync since the audience was last refreshed are left out as well.
+    recipients = sorted(read_audience() - read_opt_outs())
+    job_id = submit_job(weekly_email['Subject'], weekly_email['Body'], recipients, queue=queue, email_date=email['SentDate'])
+    wa_client.write_email_cursor({'Id': email['Id'], 'SentDate': email['SentDate'], 'Url': email['Url']})
+    return job_id
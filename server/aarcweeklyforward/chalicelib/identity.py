@@ -0,0 +1,107 @@
+import copy, re
+
+# Identity resolution
+# The recipient index has one entry per (normalized) email address, but a runner who changed addresses, or
+# typed a different one for another race, shows up under several.  Registrations are grouped into persons:
+#
+#    blocking:   every registration is filed under a few blocking keys, and only registrations that share a
+#                key are compared, so the work grows with the number of registrations rather than its square
+#                   last name + zip
+#                   first name + birthdate
+#    matching:   two registrations are the same person when the first names agree and either
+#                   the birthdates agree and the last names or zips agree, or
+#                   the last names, zips and street addresses agree
+#    merging:    matched registrations are joined with union-find; a person's contact history is the sum of
+#                their registrations, and their details and primary email come from the latest registration
+#
+# Blocks bigger than MAX_BLOCK (e.g. an empty name in a large zip) are too unspecific to be worth comparing
+# and are skipped, which keeps the worst case linear.
+
+MAX_BLOCK = 50
+
+_not_letters = re.compile(r'[^a-z]')
+_not_alphanumeric = re.compile(r'[^a-z0-9]')
+
+
+def _name(text):
+    return _not_letters.sub('', text.lower())
+
+
+def _address(text):
+    return _not_alphanumeric.sub('', text.lower())
+
+
+class _Identity(object):
+    __slots__ = ('first', 'last', 'zip', 'birthdate', 'address')
+
+    def __init__(self, recipient):
+        self.first = _name(recipient.first_name)
+        self.last = _name(recipient.last_name)
+        self.zip = recipient.zip.strip()[:5]
+        self.birthdate = recipient.birthdate.strip()
+        self.address = _address(recipient.address)
+
+    def blocking_keys(self):
+        if self.last and self.zip:
+            yield ('last_zip', self.last, self.zip)
+        if self.first and self.birthdate:
+            yield ('first_birthdate', self.first, self.birthdate)
+
+
+def same_person(a, b):
+    if not a.first or a.first != b.first:
+        return False
+    if a.birthdate and a.birthdate == b.birthdate:
+        return a.last == b.last or (a.zip and a.zip == b.zip)
+    return a.last == b.last and a.zip and a.zip == b.zip and a.address and a.address == b.address
+
+
+def _find(parents, i):
+    while parents[i] != i:
+        parents[i] = parents[parents[i]]
+        i = parents[i]
+    return i
+
+
+def resolve_identities(index):
+    """Group the recipients in index ({email: EmailRecipient}) into persons.
+    Returns (persons, aliases): persons maps each person's primary email to an EmailRecipient with their merged
+    contact history, and aliases maps every email in index to its person's primary email."""
+    emails = list(index)
+    identities = [_Identity(index[email]) for email in emails]
+    blocks = {}
+    for i, identity in enumerate(identities):
+        for key in identity.blocking_keys():
+            blocks.setdefault(key, []).append(i)
+
+    parents = list(range(len(emails)))
+    for members in blocks.values():
+        if len(members) < 2 or len(members) > MAX_BLOCK:
+            continue
+        for n, i in enumerate(members):
+            for j in members[n + 1:]:
+                if same_person(identities[i], identities[j]):
+                    root_i, root_j = _find(parents, i), _find(parents, j)
+                    if root_i != root_j:
+                        parents[max(root_i, root_j)] = min(root_i, root_j)
+
+    groups = {}
+    for i in range(len(emails)):
+        groups.setdefault(_find(parents, i), []).append(emails[i])
+
+    persons = {}
+    aliases = {}
+    for group in groups.values():
+        if len(group) == 1:
+            # Most persons have a single email; they share the index's recipient rather than a copy.
+            persons[group[0]] = index[group[0]]
+            aliases[group[0]] = group[0]
+            continue
+        # The latest registration wins; on a tie, the earliest email in the index does.
+        latest = max(group, key=lambda email: index[email].most_recent_contact)
+        person = copy.copy(index[latest])
+        person.number_of_contacts = sum(index[email].number_of_contacts for email in group)
+        persons[latest] = person
+        for email in group:
+            aliases[email] = latest
+    return persons, aliases
@@ -0,0 +1,204 @@
+import datetime, html, re
+from email.parser import HeaderParser
+from email.utils import getaddresses, parseaddr
+import ezgmail
+from chalicelib.object_store import ObjectStore
+from chalicelib.audience import add_opt_outs, normalize_emails
+from chalicelib.email_recipient import normalize_email
+from chalicelib import metrics
+
+# Relay mailbox sync
+# Runners unsubscribe by replying to the relay mailbox, and undeliverable addresses come back to it as bounce
+# notifications.  Both are picked up by syncing the inbox incrementally:
+#    the first sync, or one whose history ID Gmail no longer keeps, searches the last BACKFILL_DAYS of the inbox
+#    later syncs ask users.history.list for the messages added since the saved history ID
+# The new messages are fetched in Gmail batch requests and classified, and the addresses of unsubscribe requests
+# and permanent bounces are added to the opt-out list (see audience.py), which every relay leaves out.
+#
+# An unsubscribe request is a reply to a relayed weekly email (it has In-Reply-To or References, and its subject
+# is a relayed subject, see send_log.py, after the Re: prefixes) that asks to be removed in its own text, not in
+# the email it quotes, since the weekly email's footer says Unsubscribe.  Quoted text is lines starting with > and
+# everything after a quote header: "On <date>, <name> wrote:" (Gmail, Yahoo, Apple Mail), Outlook's "Original
+# Message" line or From:/Sent: block, or a forwarded message header.
+#
+# A bounce only opts out the addresses it says permanently failed: X-Failed-Recipients (Gmail's bounces), the
+# failed Final-Recipient / Original-Recipient fields of its delivery status report (RFC 3464), or, with neither,
+# the To: of the returned relay message if the text says the failure is permanent.  Other addresses in its text,
+# e.g. the reporting server's postmaster, are left alone.
+#
+# Only the headers classification needs are fetched (format='metadata').  Most messages are decided by their
+# headers and the snippet, the first SNIPPET_LENGTH characters of the text.  The rest (a bounce without
+# X-Failed-Recipients, or a reply whose snippet ends before the quoted email starts) have their full message
+# fetched in a second round of batches.
+#
+#    mailbox/sync.json    {'historyId', 'synced', 'messages', 'unsubscribes', 'bounces'} of the last sync
+
+SYNC_FILENAME = 'mailbox/sync.json'
+SYNC_LABEL = 'INBOX'
+BACKFILL_DAYS = 30
+METADATA_HEADERS = ['From', 'Subject', 'X-Failed-Recipients', 'In-Reply-To', 'References']
+SNIPPET_LENGTH = 200
+
+BOUNCE_SENDER = re.compile(r'mailer-daemon|postmaster', re.IGNORECASE)
+PERMANENT_FAILURE = re.compile(r"permanent|does not exist|doesn't exist|couldn't be found|no such user|"
+                               r'unknown user|user unknown|address rejected|\b550\b', re.IGNORECASE)
+UNSUBSCRIBE_REQUEST = re.compile(r'\b(unsubscribe|remove me|take me off|opt[ -]?out)\b', re.IGNORECASE)
+REPLY_PREFIX = re.compile(r'^\s*(?:(?:re|aw|sv|antw|fwd?|wg)\s*(?:\[\d+\])?\s*:\s*)+', re.IGNORECASE)
+# Searched without line anchors, so it also finds quote headers in snippets, where Gmail has joined the lines.
+QUOTE_HEADER = re.compile(r'\bOn\b[^\n]{0,200}(?:\n[^\n]{0,200})?\bwrote:'
+                          r'|-{2,} ?(?i:original message) ?-{2,}'
+                          r'|_{10,}'
+                          r'|\bFrom: [^\n]{0,200}(?:\n\s*)?\b(?:Sent|Date): '
+                          r'|-{2,} ?(?i:forwarded message) ?-{2,}|\bBegin forwarded message:')
+QUOTED_LINE = re.compile(r'^[ \t]*>.*(?:\n|$)', re.MULTILINE)
+SNIPPET_QUOTE = re.compile(r'(?:^|\s)>\s') # A quoted line in a snippet, whose line breaks are gone.
+DSN_RECIPIENT = re.compile(r'^(?:Final|Original)-Recipient:[ \t]*(?:rfc822[ \t]*;)?[ \t]*<?([^>\s]+)>?',
+                           re.IGNORECASE | re.MULTILINE)
+DSN_ACTION = re.compile(r'^Action:[ \t]*(\w+)', re.IGNORECASE | re.MULTILINE)
+DSN_STATUS = re.compile(r'^Status:[ \t]*(\d)', re.IGNORECASE | re.MULTILINE)
+
+store = ObjectStore()
+
+
+def classify(message, relay_address, relayed_subjects):
+    """Returns ('bounce', addresses that permanently failed), ('unsubscribe', [the sender]) or (None, [])."""
+    sender = normalize_email(parseaddr(message.sender or '')[1])
+    if message.header('X-Failed-Recipients') or BOUNCE_SENDER.search(message.sender or ''):
+        return 'bounce', sorted(normalize_emails(bounced_addresses(message)) - {sender, relay_address})
+    if sender and sender != relay_address and is_relay_reply(message, relayed_subjects):
+        if UNSUBSCRIBE_REQUEST.search(message_text(message, reply=True)):
+            return 'unsubscribe', [sender]
+    return None, []
+
+
+def normalize_subject(subject):
+    return ' '.join(REPLY_PREFIX.sub('', subject or '').split()).lower()
+
+
+def relayed_subjects():
+    """The normalized subjects of the weekly emails relayed so far."""
+    from chalicelib.send_log import read_aggregates
+    return {normalize_subject(email['subject']) for email in read_aggregates()['emails'].values()}
+
+
+def is_relay_reply(message, relayed_subjects):
+    return bool(message.header('In-Reply-To') or message.header('References')) and \
+        normalize_subject(message.subject) in relayed_subjects
+
+
+def bounced_addresses(message):
+    """The addresses a bounce says permanently failed."""
+    failed_recipients = message.header('X-Failed-Recipients')
+    if failed_recipients:
+        return [address for name, address in getaddresses([failed_recipients])]
+    report = message.partText('message/delivery-status')
+    if report is not None:
+        return dsn_failed_recipients(report)
+    returned = message.partText('text/rfc822-headers') or message.partText('message/rfc822')
+    if returned is None or not PERMANENT_FAILURE.search(message_text(message)):
+        return [] # e.g. a "delivery delayed" notice, the server is still trying.
+    return [address for name, address in getaddresses(HeaderParser().parsestr(returned).get_all('To', []))]
+
+
+def dsn_failed_recipients(report):
+    """The recipients of a delivery status report whose delivery failed (Action: failed or a 5.x.x Status).
+    The report has a block of fields for the message, then one for each recipient, separated by blank lines."""
+    failed = []
+    for block in re.split(r'\n[ \t]*\n', report.replace('\r\n', '\n')):
+        recipients = DSN_RECIPIENT.findall(block)
+        action = DSN_ACTION.search(block)
+        status = DSN_STATUS.search(block)
+        if recipients and ((action and action.group(1).lower() == 'failed') or (status and status.group(1) == '5')):
+            failed.append(recipients[0]) # Final-Recipient comes first; Original-Recipient is the same runner.
+    return failed
+
+
+def strip_quoted(text):
+    """The text of a reply without the email it quotes."""
+    text = QUOTED_LINE.sub('', text)
+    match = QUOTE_HEADER.search(text)
+    return text[:match.start()] if match else text
+
+
+def snippet_text(message, reply=False):
+    """The text (or with reply, the text up to the quoted email) from the snippet, or None if it may not all be there."""
+    snippet = html.unescape(message.snippet)
+    if not reply:
+        return snippet if len(snippet) < SNIPPET_LENGTH else None
+    text = strip_quoted(snippet)
+    quote = SNIPPET_QUOTE.search(text)
+    if quote:
+        text = text[:quote.start()]
+    return text if text != snippet or len(snippet) < SNIPPET_LENGTH else None
+
+
+def message_text(message, reply=False):
+    text = snippet_text(message, reply)
+    if text is None:
+        text = message.originalBody or ''
+        if reply:
+            text = strip_quoted(text)
+    return text
+
+
+def needs_body(message, relayed_subjects):
+    """True if classify() has to look at the body of the message, not just its headers and snippet."""
+    if message.header('X-Failed-Recipients'):
+        return False
+    if BOUNCE_SENDER.search(message.sender or ''):
+        return True # The delivery status report is a part of its own.
+    return is_relay_reply(message, relayed_subjects) and snippet_text(message, reply=True) is None
+
+
+def new_message_ids(state):
+    """Returns the IDs of the messages to look at, oldest first, and the history ID to sync from next time."""
+    if state:
+        try:
+            return ezgmail.history(state['historyId'], labelId=SYNC_LABEL)
+        except ezgmail.HistoryExpired as exc:
+            print(f'{exc}, searching the inbox instead')
+    # Take the history ID before searching, so messages that arrive during the search are picked up next time.
+    history_id = ezgmail.currentHistoryId()
+    message_ids = ezgmail.searchMessageIds(f'in:{SYNC_LABEL.lower()} newer_than:{BACKFILL_DAYS}d')
+    return list(reversed(message_ids)), history_id
+
+
+def sync_mailbox():
+    """Pick up unsubscribe requests and bounces that arrived since the last sync and add them to the opt-out list."""
+    from chalicelib.emailer import RELAY_SENDER
+    with metrics.stage('gmail.init'):
+        ezgmail.init(userId=RELAY_SENDER)
+    state = store.get_json(SYNC_FILENAME)
+    with metrics.stage('mailbox.list'):
+        message_ids, history_id = new_message_ids(state)
+    with metrics.stage('mailbox.fetch'):
+        messages = ezgmail.getMessages(message_ids, format='metadata', metadataHeaders=METADATA_HEADERS)
+
+    subjects = relayed_subjects()
+    with metrics.stage('mailbox.fetch_bodies'):
+        undecided = [message for message in messages if needs_body(message, subjects)]
+        ezgmail.loadBodies(undecided)
+
+    found = {'unsubscribe': set(), 'bounce': set()}
+    with metrics.stage('mailbox.classify'):
+        for message in messages:
+            kind, addresses = classify(message, normalize_email(RELAY_SENDER), subjects)
+            if kind is not None:
+                found[kind].update(addresses)
+    new_opt_outs = add_opt_outs(found['unsubscribe'] | found['bounce'])
+
+    store.put_json(SYNC_FILENAME, {
+        'historyId': history_id,
+        'synced': datetime.datetime.utcnow().isoformat(),
+        'messages': len(messages),
+        'unsubscribes': sorted(found['unsubscribe']),
+        'bounces': sorted(found['bounce']),
+    })
+    metrics.count('mailbox.messages', len(messages))
+    metrics.count('mailbox.bodies', len(undecided))
+    metrics.count('mailbox.unsubscribes', len(found['unsubscribe']))
+    metrics.count('mailbox.bounces', len(found['bounce']))
+    print(f'Mailbox sync: {len(messages)} new messages, {len(found["unsubscribe"])} unsubscribes, '
+          f'{len(found["bounce"])} bounces, {len(new_opt_outs)} new opt-outs')
+    return {'messages': len(messages), 'unsubscribes': len(found['unsubscribe']), 'bounces': len(found['bounce']),
+            'new-opt-outs': len(new_opt_outs)}
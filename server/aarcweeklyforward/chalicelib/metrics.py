@@ -0,0 +1,152 @@
+import functools, json, threading, time
+from contextlib import contextmanager
+
+# Metrics
+# Counters and timers for the stages of a run (one route or worker invocation): bytes read, rows parsed,
+# WildApricot calls and latency, messages sent and failed, and the time spent in each stage.  At the end of the
+# run they are printed as one CloudWatch Embedded Metric Format (EMF) log line, which CloudWatch turns into
+# metrics in the AARCWeeklyForward namespace, and saved so /metrics can show the latest run of each kind.
+# Each kind of run has its own object, metrics/latest/<name>.json, so runs that end at the same time (e.g.
+# relay workers) each write their own document instead of racing on a shared one.
+#
+# Code that records metrics does not need to know whether a run is active; outside a run (e.g. in the
+# benchmarks or a notebook) count(), observe() and stage() do nothing.
+
+NAMESPACE = 'AARCWeeklyForward'
+METRICS_PREFIX = 'metrics/latest/'
+MAX_EMF_METRICS = 100 # CloudWatch limit per metric directive
+
+_run = None
+
+
+class Run(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.started = time.time()
+        self.counters = {}
+        self.timers = {}
+        self.units = {}
+        self.profile = None
+        self.lock = threading.Lock()
+
+    def count(self, name, value, unit):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+            self.units[name] = unit
+
+    def observe(self, name, milliseconds):
+        with self.lock:
+            timer = self.timers.setdefault(name, {'count': 0, 'total': 0.0, 'max': 0.0})
+            timer['count'] += 1
+            timer['total'] += milliseconds
+            timer['max'] = max(timer['max'], milliseconds)
+
+    def document(self):
+        return {
+            'run': self.name,
+            'started': self.started,
+            'seconds': round(time.time() - self.started, 3),
+            'counters': self.counters,
+            'timers': {name: {'count': timer['count'], 'total_ms': round(timer['total'], 1),
+                              'avg_ms': round(timer['total'] / timer['count'], 1), 'max_ms': round(timer['max'], 1)}
+                       for name, timer in self.timers.items()},
+            'profile': self.profile,
+        }
+
+    def emf(self):
+        """The run as an Embedded Metric Format log record, with a Run dimension."""
+        record = {'Run': self.name}
+        definitions = []
+        for name, value in self.counters.items():
+            record[name] = value
+            definitions.append({'Name': name, 'Unit': self.units[name]})
+        for name, timer in self.timers.items():
+            record[f'{name}.time'] = round(timer['total'], 1)
+            record[f'{name}.calls'] = timer['count']
+            definitions.append({'Name': f'{name}.time', 'Unit': 'Milliseconds'})
+            definitions.append({'Name': f'{name}.calls', 'Unit': 'Count'})
+        record['_aws'] = {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{'Namespace': NAMESPACE, 'Dimensions': [['Run']],
+                                   'Metrics': definitions[i:i + MAX_EMF_METRICS]}
+                                  for i in range(0, len(definitions), MAX_EMF_METRICS)],
+        }
+        return record
+
+
+def start_run(name):
+    global _run
+    _run = Run(name)
+    return _run
+
+
+def end_run(save=True):
+    """Print the run's EMF record, save it as the latest run of its kind and return its document."""
+    global _run
+    run, _run = _run, None
+    if run is None:
+        return None
+    print(json.dumps(run.emf()))
+    document = run.document()
+    if save:
+        try:
+            from chalicelib.object_store import ObjectStore
+            ObjectStore().put_json(f'{METRICS_PREFIX}{run.name}.json', document)
+        except Exception as exc:
+            print(f'Unable to save metrics: {exc}')
+    return document
+
+
+def latest_runs():
+    """Returns {run name: document of its latest run}."""
+    from chalicelib.object_store import ObjectStore
+    store = ObjectStore()
+    runs = {}
+    for key in store.list(METRICS_PREFIX):
+        document = store.get_json(key)
+        if document is not None:
+            runs[document['run']] = document
+    return runs
+
+
+def count(name, value=1, unit='Count'):
+    if _run is not None:
+        _run.count(name, value, unit)
+
+
+def observe(name, milliseconds):
+    if _run is not None:
+        _run.observe(name, milliseconds)
+
+
+@contextmanager
+def stage(name):
+    """Time the block as one observation of the timer name."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, (time.perf_counter() - start) * 1000)
+
+
+def instrumented(name, profile=None):
+    """Decorator that runs the function as a metrics run.  profile is an optional callable that returns True
+    when this invocation should also be sampled by the profiler."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            run = start_run(name)
+            profiler = None
+            if profile is not None and profile():
+                from chalicelib.profiler import SamplingProfiler
+                profiler = SamplingProfiler().start()
+            try:
+                with stage('total'):
+                    return func(*args, **kwargs)
+            finally:
+                if profiler is not None:
+                    run.profile = profiler.stop().report()
+                end_run()
+        return wrapper
+    return decorator
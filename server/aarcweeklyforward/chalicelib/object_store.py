@@ -0,0 +1,156 @@
+import hashlib, json, os, threading
+
+DIR_PREFIX = "s3://aarclub-files/weekly-emails/" if 'AWS_REGION' in os.environ else ""
+
+# Object store
+# Small keyed objects (job state, log segments) in S3, or in a local directory when root is not an s3:// prefix.
+# Unlike smart_open it can list keys under a prefix, which the relay jobs and send log need.
+#
+# Objects written by more than one worker at a time (the opt-out list, the recipient store) are updated with
+# conditional puts: put_if() only writes if the object still has the ETag it was read with (S3 If-Match), or, with
+# no ETag, only if there is no object yet (If-None-Match: *).  The loser of a race re-reads and tries again, see
+# update_json().  Locally the ETag is the MD5 of the file, like S3's for a single part upload, and a lock makes
+# the check and the write atomic between the threads of one process.
+
+UPDATE_ATTEMPTS = 10
+_local_lock = threading.Lock()
+
+
+def local_etag(data):
+    return '"' + hashlib.md5(data).hexdigest() + '"'
+
+
+class ObjectStore(object):
+
+    def __init__(self, root=DIR_PREFIX, s3_client=None):
+        self.root = root
+        self._s3 = s3_client
+        if root.startswith('s3://'):
+            self.bucket, self.prefix = root[len('s3://'):].split('/', 1)
+        else:
+            self.bucket, self.prefix = None, root
+
+    @property
+    def s3(self):
+        if self._s3 is None:
+            import boto3
+            self._s3 = boto3.client('s3')
+        return self._s3
+
+    def get(self, key):
+        """Returns the bytes stored at key, or None if there is no such object."""
+        if self.bucket is None:
+            try:
+                with open(f'{self.prefix}{key}', 'rb') as f:
+                    return f.read()
+            except FileNotFoundError:
+                return None
+        try:
+            return self.s3.get_object(Bucket=self.bucket, Key=f'{self.prefix}{key}')['Body'].read()
+        except self.s3.exceptions.NoSuchKey:
+            return None
+
+    def put(self, key, data):
+        if self.bucket is None:
+            path = f'{self.prefix}{key}'
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(data)
+            return
+        self.s3.put_object(Bucket=self.bucket, Key=f'{self.prefix}{key}', Body=data)
+
+    def delete(self, key):
+        """Remove the object at key, if there is one."""
+        if self.bucket is None:
+            try:
+                os.remove(f'{self.prefix}{key}')
+            except FileNotFoundError:
+                pass
+            return
+        self.s3.delete_object(Bucket=self.bucket, Key=f'{self.prefix}{key}')
+
+    def get_versioned(self, key):
+        """Returns the bytes stored at key and their ETag, or (None, None) if there is no such object."""
+        if self.bucket is None:
+            data = self.get(key)
+            return data, None if data is None else local_etag(data)
+        try:
+            response = self.s3.get_object(Bucket=self.bucket, Key=f'{self.prefix}{key}')
+        except self.s3.exceptions.NoSuchKey:
+            return None, None
+        return response['Body'].read(), response['ETag']
+
+    def etag(self, key):
+        """Returns the ETag of the object at key, or None if there is no such object."""
+        if self.bucket is None:
+            return self.get_versioned(key)[1]
+        from botocore.exceptions import ClientError
+        try:
+            return self.s3.head_object(Bucket=self.bucket, Key=f'{self.prefix}{key}')['ETag']
+        except ClientError as exc:
+            if exc.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
+
+    def put_if(self, key, data, etag=None):
+        """Write data only if the object at key still has etag, or with no etag, only if there is no object at key.
+        Returns the new ETag, or None if the object was written by someone else in the meantime."""
+        if self.bucket is None:
+            with _local_lock:
+                if self.get_versioned(key)[1] != etag:
+                    return None
+                path = f'{self.prefix}{key}'
+                self.put(f'{key}.partial', data)
+                os.replace(f'{path}.partial', path)
+                return local_etag(data)
+        from botocore.exceptions import ClientError
+        condition = {'IfMatch': etag} if etag else {'IfNoneMatch': '*'}
+        try:
+            return self.s3.put_object(Bucket=self.bucket, Key=f'{self.prefix}{key}', Body=data, **condition)['ETag']
+        except ClientError as exc:
+            if exc.response['Error']['Code'] in ('PreconditionFailed', 'ConditionalRequestConflict'):
+                return None
+            raise
+
+    def update_json(self, key, update, attempts=UPDATE_ATTEMPTS):
+        """Read, modify and write the JSON object at key without losing concurrent updates.  update is called with
+        the current value (None if there is none) and returns the new value, or None to leave the object as it is;
+        it is called again with the newer value if another writer got there first.  Returns the value written."""
+        for attempt in range(attempts):
+            data, etag = self.get_versioned(key)
+            value = update(None if data is None else json.loads(data))
+            if value is None or self.put_if(key, json.dumps(value).encode(), etag):
+                return value
+        raise RuntimeError(f'{key} changed under {attempts} attempts to update it')
+
+    def create_json(self, key, value):
+        """Write value at key unless there is an object there already.  Returns the value at key afterwards."""
+        if self.put_if(key, json.dumps(value).encode()):
+            return value
+        return self.get_json(key)
+
+    def list(self, prefix, start_after=''):
+        """Returns the keys that start with prefix, in sorted order, optionally only those after start_after.
+        Locally only files directly in the prefix's directory are listed."""
+        if self.bucket is None:
+            directory, start = os.path.split(f'{self.prefix}{prefix}')
+            try:
+                names = os.listdir(directory or '.')
+            except FileNotFoundError:
+                return []
+            base = prefix[:len(prefix) - len(start)]
+            return sorted(base + name for name in names if name.startswith(start) and base + name > start_after)
+        keys = []
+        paginator = self.s3.get_paginator('list_objects_v2')
+        options = {'StartAfter': f'{self.prefix}{start_after}'} if start_after else {}
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=f'{self.prefix}{prefix}', **options):
+            keys.extend(item['Key'][len(self.prefix):] for item in page.get('Contents', []))
+        return sorted(keys)
+
+    def get_json(self, key):
+        data = self.get(key)
+        return None if data is None else json.loads(data)
+
+    def put_json(self, key, value):
+        self.put(key, json.dumps(value).encode())
@@ -0,0 +1,76 @@
+import sys, threading, time
+
+# Sampling profiler
+# A background thread looks at the profiled thread's stack every interval seconds and counts the functions it
+# finds, so a slow invocation can be broken down by where it spent its time without the overhead of cProfile
+# on every call.  Off by default; metrics.instrumented() starts it for one invocation when asked to (?profile=1
+# on a route, "profile": true in a relay worker message).
+
+DEFAULT_INTERVAL = 0.005
+TOP_FUNCTIONS = 25
+TOP_STACKS = 10
+STACK_DEPTH = 8
+
+
+class SamplingProfiler(object):
+
+    def __init__(self, interval=DEFAULT_INTERVAL, thread_id=None):
+        self.interval = interval
+        self.thread_id = thread_id or threading.get_ident()
+        self.samples = 0
+        self.functions = {} # 'file:function' -> samples with the function anywhere on the stack
+        self.leaves = {} # 'file:function:line' -> samples with the line executing
+        self.stacks = {} # innermost STACK_DEPTH frames -> samples
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self.started = time.perf_counter()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.seconds = time.perf_counter() - self.started
+        return self
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            self.samples += 1
+            code = frame.f_code
+            leaf = f'{code.co_filename}:{code.co_name}:{frame.f_lineno}'
+            self.leaves[leaf] = self.leaves.get(leaf, 0) + 1
+            seen = set()
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                function = f'{code.co_filename}:{code.co_name}'
+                if function not in seen:
+                    seen.add(function)
+                    self.functions[function] = self.functions.get(function, 0) + 1
+                if len(stack) < STACK_DEPTH:
+                    stack.append(f'{code.co_name}:{frame.f_lineno}')
+                frame = frame.f_back
+            stack = ';'.join(reversed(stack))
+            self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+    def report(self):
+        """The most sampled functions, lines and stacks, with their share of the samples."""
+        def top(counts, n):
+            return [{'name': name, 'samples': samples, 'share': round(samples / self.samples, 3)}
+                    for name, samples in sorted(counts.items(), key=lambda item: -item[1])[:n]]
+        if not self.samples:
+            return {'seconds': round(self.seconds, 3), 'samples': 0}
+        return {
+            'seconds': round(self.seconds, 3),
+            'interval': self.interval,
+            'samples': self.samples,
+            'functions': top(self.functions, TOP_FUNCTIONS),
+            'lines': top(self.leaves, TOP_FUNCTIONS),
+            'stacks': top(self.stacks, TOP_STACKS),
+        }
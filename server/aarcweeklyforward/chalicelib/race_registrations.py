@@ -1,26 +1,72 @@
-import csv, json
-from chalicelib.email_recipient import EmailRecipient
+import csv, io, json, os, threading
+from operator import itemgetter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import copy, hashlib, pickle
+from chalicelib.email_recipient import EmailRecipient, registration_date, registration_year, registration_age, normalize_email
+from chalicelib.cache import TwoTierCache
+from chalicelib.identity import resolve_identities
+from chalicelib import dashboard, metrics
 from smart_open import open as smart_open
 import boto3
 import tempfile
 
 recipient_dict = {}
 
-# Offsets into RTD's race registration .csv files.
-FIRST_NAME_FIELD = 0
-LAST_NAME_FIELD = 1
-ADDRESS_FIELD = 2
-ADDRESS2_FIELD = 3
-CITY_FIELD = 4
-STATE_FIELD = 5
-ZIP_FIELD = 6
-EMAIL_FIELD = 8
-SEX_FIELD = 9
-AGE_FIELD = 11
-MAILING_LIST_FIELD = 37
-REGISTRATION_DATE_FIELD = 38
-
-FILE_PREFIX = 's3://aarclub-files/weekly-emails/race-regs/'
+# Columns read from RTD's race registration .csv files, mapped to the EmailRecipient attribute each one fills.
+# Column positions differ between exports (the Phil's and FB races add their own questions), so they are
+# looked up by name in each file's header row.
+RTD_COLUMNS = {
+    'first_name': 'First Name',
+    'last_name': 'Last Name',
+    'address': 'Address',
+    'address2': 'Address2',
+    'city': 'City',
+    'state': 'State',
+    'zip': 'Zip',
+    'email': 'Email',
+    'sex': 'Sex',
+    'age': 'Age',
+    'birthdate': 'Birthdate',
+    'mailing_list': 'Mailing List',
+    'most_recent_contact': 'Registration Created',
+}
+
+# Column positions for each header layout seen so far, keyed by the header row.
+rtd_schemas = {}
+
+READ_BUFFER_SIZE = 256 * 1024
+
+# Registration files are fetched and parsed by a pool of FETCH_WORKERS threads, so S3 round trips overlap.
+# FETCH_MEMORY_CAP bounds the total size of the files being parsed at once (a file larger than the cap is
+# parsed on its own).
+FETCH_WORKERS = 8
+FETCH_MEMORY_CAP = 128 * 1024 * 1024
+
+DIR_PREFIX = "s3://aarclub-files/weekly-emails/" if 'AWS_REGION' in os.environ else ""
+FILE_PREFIX = f'{DIR_PREFIX}race-regs/'
+
+# Incremental ingestion state.  The manifest records the ETag (or content hash) and row count of each
+# registration file already parsed, and its rows and opt-ins per registration year (for the analytics).  Each
+# file's parsed registrations are saved as a partial index, and the merged recipient index is saved too, so a
+# refresh only has to parse new or changed files.  The recipient index is saved with the files merged into it,
+# {'files': [filename], 'recipients': {email: EmailRecipient}}, so it is only added to when it holds exactly
+# the files of the manifest.
+MANIFEST_FILENAME = 'ingest_manifest.json'
+# Bumped when the partial index format, the manifest entries or the merge rules change, so files are parsed again.
+MANIFEST_VERSION = 4
+INDEX_FILENAME = 'recipient_index.p'
+PARTIAL_INDEX_DIR = 'index/'
+# Recipients grouped into persons (see identity.py): {'persons': {primary email: EmailRecipient},
+# 'aliases': {email: primary email}}.  Stats, analytics and the relay audience count persons.
+PERSON_INDEX_FILENAME = 'person_index.p'
+
+STATS_FILENAME = 'stats.json'
+# Registration analytics (see registration_analytics.py), precomputed on every refresh.
+ANALYTICS_FILENAME = 'analytics.json'
+STATS_TTL = 3600
+STATS_STALE_TTL = 86400
+cache = TwoTierCache(FILE_PREFIX, ttls={STATS_FILENAME: STATS_TTL, ANALYTICS_FILENAME: STATS_TTL})
 
 # Version using smart_open.  Unfortunately, Chalice does not create S3 permissions
 # if boto3 is not used to access file.
@@ -55,63 +101,339 @@ def get_registration_files():
         return None
 """
 
-def add_rtd_registrations(filename):
-    race_regs_file = smart_open(f'{FILE_PREFIX}{filename}')
-    race_regs_reader = csv.reader(race_regs_file)
-    race_regs_entries = list(race_regs_reader)
-
-    for row in race_regs_entries[1:]:
-        recipient = EmailRecipient()
-        recipient.first_name = row[FIRST_NAME_FIELD]
-        recipient.last_name = row[LAST_NAME_FIELD]
-        recipient.address = row[ADDRESS_FIELD]
-        recipient.address2 = row[ADDRESS2_FIELD]
-        recipient.city = row[CITY_FIELD]
-        recipient.state = row[STATE_FIELD]
-        recipient.zip = row[ZIP_FIELD]
-        recipient.email = row[EMAIL_FIELD]
-        recipient.sex = row[SEX_FIELD]
-        recipient.age = row[AGE_FIELD]
-        recipient.mailing_list = row[MAILING_LIST_FIELD]
-        recipient.most_recent_contact = row[REGISTRATION_DATE_FIELD]
-        recipient.number_of_contacts = 1
-        if recipient.mailing_list == 'Yes': # Did they opt-in for future emails?
-            if recipient.email not in recipient_dict: # Add new email address or update existing one
-                recipient_dict[recipient.email] = recipient
+def get_rtd_schema(header):
+    """Returns (attributes, getter, mailing_list_position, date_position, width) for a registration file's header row.
+    getter(row) returns the values of the RTD_COLUMNS fields in the order of attributes."""
+    signature = tuple(header)
+    if signature not in rtd_schemas:
+        positions = {}
+        for position, column in enumerate(header):
+            positions.setdefault(column.strip(), position) # First column wins if a name repeats.
+        missing = [column for column in RTD_COLUMNS.values() if column not in positions]
+        if missing:
+            raise ValueError(f'Registration file is missing columns {missing}')
+        attributes = tuple(RTD_COLUMNS)
+        columns = [positions[RTD_COLUMNS[attribute]] for attribute in attributes]
+        rtd_schemas[signature] = (attributes, itemgetter(*columns), positions['Mailing List'],
+                                  positions[RTD_COLUMNS['most_recent_contact']], max(columns) + 1)
+    return rtd_schemas[signature]
+
+
+def read_rtd_registrations(filename):
+    """Parse one RTD registration file.  Returns a dict of opted-in recipients keyed by email, the number of rows read
+    and {year: [rows, opt-ins]} for the rows by the year of their registration date.
+    Rows are streamed from the file, so only the current row and the opted-in recipients are held in memory."""
+    with metrics.stage('ingest.parse'):
+        registrations, rows, years = _read_rtd_registrations(filename)
+    metrics.count('ingest.files')
+    metrics.count('ingest.rows', rows)
+    metrics.count('ingest.opt_ins', len(registrations))
+    return registrations, rows, years
+
+
+def _read_rtd_registrations(filename):
+    registrations = {}
+    rows = 0
+    year_rows, year_opt_ins = {}, {} # Keyed by the year's text in the registration date
+    path = f'{FILE_PREFIX}{filename}'
+    transport_params = {'buffer_size': READ_BUFFER_SIZE} if path.startswith('s3://') else None
+    with smart_open(path, 'rb', transport_params=transport_params) as raw_file:
+        race_regs_file = io.TextIOWrapper(raw_file, newline='')
+        race_regs_reader = csv.reader(race_regs_file)
+        header = next(race_regs_reader, None)
+        if header is None:
+            return registrations, rows, years
+        attributes, getter, mailing_list_position, date_position, width = get_rtd_schema(header)
+        email_index = attributes.index('email')
+        date_index = attributes.index('most_recent_contact')
+
+        for row in race_regs_reader:
+            if len(row) < width: # Blank or truncated line
+                continue
+            rows += 1
+            year = row[date_position].partition(', ')[2][:4]
+            year_rows[year] = year_rows.get(year, 0) + 1
+            if row[mailing_list_position] != 'Yes': # Did they opt-in for future emails?
+                continue
+            values = getter(row)
+            email = normalize_email(values[email_index])
+            if email is None:
+                continue
+            year_opt_ins[year] = year_opt_ins.get(year, 0) + 1
+            existing = registrations.get(email)
+            if existing is None: # Add new email address or update existing one
+                recipient = EmailRecipient(**dict(zip(attributes, values)))
+                recipient.email = email
+                recipient.age = registration_age(recipient.age)
+                recipient.most_recent_contact = registration_date(recipient.most_recent_contact)
+                recipient.number_of_contacts = 1
+                registrations[email] = recipient
+            elif registration_date(values[date_index]) > existing.most_recent_contact:
+                recipient = EmailRecipient(**dict(zip(attributes, values))) # Newer registration, newer details
+                recipient.email = email
+                recipient.age = registration_age(recipient.age)
+                recipient.most_recent_contact = registration_date(recipient.most_recent_contact)
+                recipient.number_of_contacts = existing.number_of_contacts + 1
+                registrations[email] = recipient
             else:
-                recipient_dict[recipient.email].number_of_contacts += 1
-                recipient_dict[recipient.email].most_recent_contact = recipient.most_recent_contact
-    return
+                existing.number_of_contacts += 1
+        metrics.count('ingest.bytes', raw_file.tell(), 'Bytes')
+    years = {}
+    for year, count in year_rows.items():
+        counts = years.setdefault(str(registration_year(f', {year}')), [0, 0])
+        counts[0] += count
+        counts[1] += year_opt_ins.get(year, 0)
+    return registrations, rows, years
 
-def process_race_registrations():
-    registration_files = get_registration_files()
 
-    for filename in registration_files:
+def merge_registrations(index, registrations):
+    """Merge one file's registrations into the recipient index.
+    Registrations are ordered by registration date, not by file: number_of_contacts is the total over all files,
+    and most_recent_contact and the runner's details come from the latest registration (the earliest merged one
+    if dates are equal).  So merging files in any order gives the same index as reading every row sequentially
+    in date order, as long as files with equal dates are merged in reg_files.json order."""
+    for email, recipient in registrations.items():
+        existing = index.get(email)
+        if existing is None:
+            index[email] = copy.copy(recipient)
+        elif recipient.most_recent_contact > existing.most_recent_contact:
+            number_of_contacts = existing.number_of_contacts + recipient.number_of_contacts
+            index[email] = copy.copy(recipient)
+            index[email].number_of_contacts = number_of_contacts
+        else:
+            existing.number_of_contacts += recipient.number_of_contacts
+    return index
+
+
+_s3 = None
+_s3_lock = threading.Lock()
+
+
+def s3_client():
+    # boto3 clients are thread safe, but creating them is not, so the fetch threads share one.
+    global _s3
+    with _s3_lock:
+        if _s3 is None:
+            _s3 = boto3.client('s3')
+    return _s3
+
+
+def get_file_info(filename):
+    """Returns (version, size) of a registration file.  The version is the S3 ETag, or an md5 of the contents when it is not on S3."""
+    path = f'{FILE_PREFIX}{filename}'
+    if path.startswith('s3://'):
+        bucket, key = path[len('s3://'):].split('/', 1)
+        with metrics.stage('ingest.head'):
+            head = s3_client().head_object(Bucket=bucket, Key=key)
+        return head['ETag'].strip('"'), head['ContentLength']
+    md5 = hashlib.md5()
+    size = 0
+    with smart_open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            md5.update(chunk)
+            size += len(chunk)
+    return md5.hexdigest(), size
+
+
+class MemoryBudget(object):
+    """Lets threads reserve part of a byte budget, waiting while the rest is reserved."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.condition = threading.Condition()
+
+    @contextmanager
+    def reserve(self, size):
+        size = min(size, self.limit)
+        with self.condition:
+            while self.used and self.used + size > self.limit:
+                self.condition.wait()
+            self.used += size
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.used -= size
+                self.condition.notify_all()
+
+
+def fetch_registrations(filenames, entries, workers=FETCH_WORKERS, memory_cap=FETCH_MEMORY_CAP):
+    """Parse the files in filenames that are new or changed according to the manifest entries, using a pool of
+    workers threads.  Each parsed file is saved as a partial index.
+    Returns [(filename, version, registrations, rows, years)] for the parsed files, in filenames order."""
+    budget = MemoryBudget(memory_cap)
+
+    def fetch(filename):
+        version, size = get_file_info(filename)
+        if filename in entries and entries[filename]['version'] == version:
+            return None
         print(f'Processing file {filename}')
-        add_rtd_registrations(filename)
-        print(f'Total email addresses found: {len(recipient_dict)}')
+        with budget.reserve(size):
+            registrations, rows, years = read_rtd_registrations(filename)
+        write_index(f'{PARTIAL_INDEX_DIR}{filename}.p', registrations)
+        return filename, version, registrations, rows, years
+
+    if workers <= 1:
+        results = map(fetch, filenames)
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(fetch, filenames))
+    return [result for result in results if result is not None]
+
+
+def read_manifest():
+    try:
+        f = smart_open(f'{FILE_PREFIX}{MANIFEST_FILENAME}', 'r')
+        manifest = json.load(f)
+        if manifest.get('version') == MANIFEST_VERSION:
+            return manifest
+    except (FileNotFoundError, ValueError, OSError):
+        pass
+    return {'version': MANIFEST_VERSION, 'files': [], 'entries': {}}
+
+
+def write_manifest(manifest):
+    with smart_open(f'{FILE_PREFIX}{MANIFEST_FILENAME}', 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+
+def read_index(filename):
+    try:
+        with metrics.stage('ingest.index_read'), smart_open(f'{FILE_PREFIX}{filename}', 'rb') as f:
+            return pickle.load(f)
+    except (FileNotFoundError, ValueError, OSError, EOFError, pickle.UnpicklingError):
+        return None
+
+
+def write_index(filename, index):
+    path = f'{FILE_PREFIX}{filename}'
+    if not path.startswith('s3://') and os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    with metrics.stage('ingest.index_write'), smart_open(path, 'wb') as f:
+        pickle.dump(index, f)
+
+
+def read_recipient_index():
+    """Returns the files merged into the saved recipient index and the index, or ([], None) if there is none."""
+    saved = read_index(INDEX_FILENAME)
+    if not isinstance(saved, dict) or set(saved) != {'files', 'recipients'}:
+        return [], None
+    return saved['files'], saved['recipients']
+
+
+def process_race_registrations(workers=FETCH_WORKERS):
+    global recipient_dict
+    registration_files = get_registration_files()
+    manifest = read_manifest()
+    entries = manifest['entries']
+
+    # Parse only the files that are new or whose contents changed since the last refresh.
+    changed = []
+    for filename, version, registrations, rows, years in fetch_registrations(registration_files, entries, workers):
+        entries[filename] = {'version': version, 'rows': rows, 'contacts': len(registrations), 'years': years}
+        changed.append((filename, registrations))
+
+    # With nothing parsed and the same files as last time, the saved person index and analytics are still
+    # current, so the refresh costs the manifest check and one read instead of resolving every runner again.
+    previous_files = manifest['files']
+    if not changed and previous_files == registration_files:
+        persons, aliases = read_person_index()
+        if persons and get_registration_analytics() is not None:
+            recipient_dict = persons
+            print(f'No new or changed files. Total email addresses found: {len(aliases)}, runners: {len(persons)}')
+            return save_registration_stats(registration_files, persons)
+
+    # Merging is ordered by registration date, so new files can be merged into the saved index wherever they
+    # are in reg_files.json.  When a file already in the index changed or was removed, the index is rebuilt
+    # from the saved partial indexes, which still avoids re-reading and re-parsing the unchanged CSV files.
+    # Without a manifest (first run, or a new MANIFEST_VERSION) every file is parsed again, and merging them
+    # into the old index would count their registrations twice, so the index is rebuilt then too.  So it is
+    # when the saved index does not hold exactly the manifest's files, e.g. the manifest failed to save.
+    appended = bool(previous_files) and \
+        all(filename in registration_files for filename in previous_files) and \
+        all(filename not in previous_files for filename, registrations in changed)
+    index = None
+    if appended:
+        indexed_files, index = read_recipient_index()
+        if indexed_files != previous_files:
+            index = None
+    rebuilt = index is None
+    if not rebuilt:
+        with metrics.stage('ingest.merge'):
+            for filename, registrations in changed:
+                merge_registrations(index, registrations)
+    else:
+        print('Rebuilding recipient index')
+        index = {}
+        parsed = dict(changed)
+        for filename in registration_files:
+            registrations = parsed[filename] if filename in parsed else read_index(f'{PARTIAL_INDEX_DIR}{filename}.p')
+            if registrations is None: # Partial index is missing, so fall back to parsing the file.
+                registrations, rows, years = read_rtd_registrations(filename)
+                write_index(f'{PARTIAL_INDEX_DIR}{filename}.p', registrations)
+            with metrics.stage('ingest.merge'):
+                merge_registrations(index, registrations)
+
+    for filename in list(entries):
+        if filename not in registration_files:
+            entries.pop(filename)
+    if changed or rebuilt or previous_files != registration_files:
+        write_index(INDEX_FILENAME, {'files': registration_files, 'recipients': index})
+        manifest['files'] = registration_files
+        write_manifest(manifest)
+    with metrics.stage('ingest.identities'):
+        persons, aliases = resolve_identities(index)
+        write_index(PERSON_INDEX_FILENAME, {'persons': persons, 'aliases': aliases})
+    recipient_dict = persons
+    with metrics.stage('ingest.analytics'):
+        write_registration_analytics(persons, aliases, registration_files, dict(changed), entries)
+    metrics.count('ingest.recipients', len(index))
+    metrics.count('ingest.persons', len(persons))
+    print(f'Parsed {len(changed)} of {len(registration_files)} files. Total email addresses found: {len(index)}, runners: {len(persons)}')
+    return save_registration_stats(registration_files, persons)
+
+
+def save_registration_stats(registration_files, persons):
     response = {}
     response['races'] = len(registration_files)
     response['members'] = 0
-    response['contacts'] = len(recipient_dict)
-    try:
-        f = smart_open(f'{FILE_PREFIX}stats.json', 'w')
-        json.dump(response, f, indent=2)
-    except FileNotFoundError:
-        pass
-    except ValueError:
-        pass
-    return json.dumps(response)
+    response['contacts'] = len(persons)
+    cache.put_json(STATS_FILENAME, response)
+    dashboard.update_section('race-reg-contacts', response)
+    return response
+
+def read_person_index():
+    """Returns (persons, aliases) saved by the last refresh, or two empty dicts."""
+    person_index = read_index(PERSON_INDEX_FILENAME)
+    if person_index is None:
+        return {}, {}
+    return person_index['persons'], person_index['aliases']
+
+
+def write_registration_analytics(index, aliases, registration_files, parsed, entries):
+    from chalicelib.registration_analytics import registration_analytics
+    partials = []
+    for filename in registration_files:
+        registrations = parsed[filename] if filename in parsed else read_index(f'{PARTIAL_INDEX_DIR}{filename}.p')
+        if registrations is not None:
+            partials.append((filename, registrations))
+    file_years = {filename: entries[filename]['years'] for filename in registration_files if filename in entries}
+    analytics = registration_analytics(index, partials, file_years, aliases)
+    cache.put_json(ANALYTICS_FILENAME, analytics)
+    return analytics
 
-#TODO: Create a summary statistics file for read_race_reg_stats()
 
 def get_registration_stats():
     try:
-        f = smart_open(f'{FILE_PREFIX}stats.json', 'r')
-        stats = json.load(f)
-        return stats
-    except FileNotFoundError:
-        return None
+        return cache.get_json(STATS_FILENAME, stale_ttl=STATS_STALE_TTL)
     except ValueError:
         return None
 
+
+
+def get_registration_analytics():
+    try:
+        return cache.get_json(ANALYTICS_FILENAME, stale_ttl=STATS_STALE_TTL)
+    except ValueError:
+        return None
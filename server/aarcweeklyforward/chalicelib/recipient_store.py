@@ -0,0 +1,209 @@
+import os, sqlite3, tempfile
+from chalicelib.email_recipient import EmailRecipient
+from chalicelib.object_store import ObjectStore
+
+DIR_PREFIX = "s3://aarclub-files/weekly-emails/" if 'AWS_REGION' in os.environ else ""
+STORE_FILENAME = 'weekly_email_recipients.db'
+
+# Recipient store
+# Email recipients are kept in a SQLite database keyed by email address, so single recipients can be looked up
+# and updated without reading and rewriting every record like the old pickled dict.  The database file is
+# worked on in /tmp and copied to/from S3 as a single object.
+#
+# Several Lambda containers use the store at once (e.g. relay workers counting emails_sent), so:
+#    opening it checks the /tmp copy's ETag (saved next to it in <file>.etag) against S3 and downloads a newer one
+#    sync() uploads with a conditional put on the ETag the copy was downloaded with; if another container uploaded
+#    in the meantime, the newer database is downloaded, this store's changes since it was opened are applied to it
+#    again (every change is also kept in a journal) and the upload is retried
+# So no container overwrites another's changes.  Counts that may be made more than once, like emails_sent for a
+# send log segment that two folds both read, are made with increment_once(), which records the key of the change
+# in the applied_changes table and skips a key that is there already, also when the journal is applied again.
+
+SYNC_ATTEMPTS = 10
+
+COLUMNS = EmailRecipient.__slots__
+BOOLEAN_COLUMNS = ('mailing_list', 'aarc_member', 'opted_out')
+COUNTER_COLUMNS = ('number_of_contacts', 'emails_sent', 'emails_opened')
+
+
+class RecipientStore(object):
+
+    def __init__(self, filename=STORE_FILENAME, local_dir=None, object_store=None):
+        self.filename = filename
+        self.remote_path = f'{DIR_PREFIX}{filename}'
+        self.local_path = os.path.join(local_dir or tempfile.gettempdir(), filename)
+        self.store = object_store or ObjectStore(DIR_PREFIX)
+        self.remote = self.remote_path != self.local_path
+        self.dirty = False
+        self.journal = [] # (sql, rows) of every change since the store was opened or last uploaded
+        self.etag = None
+        if self.remote:
+            self._refresh()
+        self._connect()
+
+    def _connect(self):
+        self.db = sqlite3.connect(self.local_path)
+        self.db.execute('PRAGMA journal_mode=MEMORY') # The file is synced as a whole, so no rollback journal on disk.
+        columns = ', '.join('email TEXT PRIMARY KEY' if column == 'email' else column for column in COLUMNS)
+        self.db.execute(f'CREATE TABLE IF NOT EXISTS recipients ({columns}) WITHOUT ROWID')
+        self.db.execute('CREATE TABLE IF NOT EXISTS applied_changes (key TEXT PRIMARY KEY) WITHOUT ROWID')
+        # Add columns for EmailRecipient attributes added since the database was created.
+        existing = {row[1] for row in self.db.execute('PRAGMA table_info(recipients)')}
+        for column in COLUMNS:
+            if column not in existing:
+                default = EmailRecipient._defaults[column]
+                self.db.execute(f'ALTER TABLE recipients ADD COLUMN {column} DEFAULT {default!r}')
+                self.dirty = True
+
+    def _read_local_etag(self):
+        try:
+            with open(f'{self.local_path}.etag') as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def _write_local_etag(self, etag):
+        with open(f'{self.local_path}.etag', 'w') as f:
+            f.write(etag or '')
+
+    def _refresh(self):
+        """Make the /tmp copy the current database from S3, downloading it unless the copy is still current."""
+        remote_etag = self.store.etag(self.filename)
+        if remote_etag is not None and remote_etag == self._read_local_etag() and os.path.exists(self.local_path):
+            self.etag = remote_etag
+            return
+        data, self.etag = self.store.get_versioned(self.filename)
+        if data is None:
+            print(f'No recipient store at {self.remote_path}, creating a new one')
+            if os.path.exists(self.local_path):
+                os.remove(self.local_path)
+        else:
+            with open(self.local_path, 'wb') as local:
+                local.write(data)
+            print(f'Downloaded recipient store {self.remote_path}')
+        self._write_local_etag(self.etag)
+
+    def _execute(self, sql, rows):
+        """Apply a change and keep it in the journal, so it can be applied again to a newer database in sync()."""
+        rows = list(rows)
+        self.db.executemany(sql, rows)
+        self.journal.append((sql, rows))
+        self.dirty = True
+
+    def sync(self):
+        """Commit changes and, if anything changed, upload the database file to S3."""
+        if self.dirty and self.remote:
+            self._write_local_etag(None) # Until the upload succeeds the /tmp copy is not any version in S3.
+        self.db.commit()
+        if self.dirty and self.remote:
+            for attempt in range(SYNC_ATTEMPTS):
+                with open(self.local_path, 'rb') as local:
+                    etag = self.store.put_if(self.filename, local.read(), self.etag)
+                if etag is not None:
+                    break
+                # Another container uploaded first: apply this store's changes to its database and try again.
+                print(f'Recipient store {self.remote_path} changed since it was opened, applying '
+                      f'{len(self.journal)} changes to the new version')
+                self.db.close()
+                self._refresh()
+                self._connect()
+                for sql, rows in self.journal:
+                    self.db.executemany(sql, rows)
+                self._write_local_etag(None)
+                self.db.commit()
+            else:
+                raise RuntimeError(f'Unable to upload recipient store {self.remote_path} after {SYNC_ATTEMPTS} attempts')
+            self.etag = etag
+            self._write_local_etag(etag)
+            print(f'Uploaded recipient store {self.remote_path}')
+        self.journal = []
+        self.dirty = False
+
+    def close(self):
+        self.sync()
+        self.db.close()
+
+    @staticmethod
+    def _to_recipient(row):
+        recipient = EmailRecipient(**dict(zip(COLUMNS, row)))
+        for column in BOOLEAN_COLUMNS:
+            setattr(recipient, column, bool(getattr(recipient, column)))
+        return recipient
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM recipients').fetchone()[0]
+
+    def __contains__(self, email):
+        return self.db.execute('SELECT 1 FROM recipients WHERE email = ?', (email,)).fetchone() is not None
+
+    def get(self, email):
+        row = self.db.execute(f'SELECT {", ".join(COLUMNS)} FROM recipients WHERE email = ?', (email,)).fetchone()
+        return None if row is None else self._to_recipient(row)
+
+    def upsert(self, recipients):
+        """Insert or replace one EmailRecipient or an iterable of them."""
+        if isinstance(recipients, EmailRecipient):
+            recipients = [recipients]
+        placeholders = ', '.join('?' for column in COLUMNS)
+        self._execute(f'INSERT OR REPLACE INTO recipients ({", ".join(COLUMNS)}) VALUES ({placeholders})',
+                      ([getattr(recipient, column) for column in COLUMNS] for recipient in recipients))
+
+    def update(self, email, **fields):
+        """Set some attributes of one recipient.  Returns False if there is no recipient with that email."""
+        fields = {column: value for column, value in fields.items() if column in COLUMNS}
+        if not fields:
+            return email in self
+        exists = email in self
+        self._execute(f'UPDATE recipients SET {", ".join(f"{column} = ?" for column in fields)} WHERE email = ?',
+                      [list(fields.values()) + [email]])
+        return exists
+
+    def increment(self, emails, column='emails_sent', amount=1):
+        """Add amount to a counter column for each of emails."""
+        if column not in COUNTER_COLUMNS:
+            raise ValueError(f'{column} is not a counter column')
+        if isinstance(emails, str):
+            emails = [emails]
+        self._execute(f'UPDATE recipients SET {column} = {column} + ? WHERE email = ?', ((amount, email) for email in emails))
+
+    def increment_once(self, key, emails, column='emails_sent', amount=1):
+        """Like increment(), but only if no change with key was made to this database yet, by this store or another
+        container."""
+        if column not in COUNTER_COLUMNS:
+            raise ValueError(f'{column} is not a counter column')
+        if isinstance(emails, str):
+            emails = [emails]
+        self._execute(f'UPDATE recipients SET {column} = {column} + ? WHERE email = ? '
+                      f'AND NOT EXISTS (SELECT 1 FROM applied_changes WHERE key = ?)',
+                      ((amount, email, key) for email in emails))
+        self._execute('INSERT OR IGNORE INTO applied_changes (key) VALUES (?)', [(key,)])
+
+    def delete(self, email):
+        self._execute('DELETE FROM recipients WHERE email = ?', [(email,)])
+
+    def scan(self, where=None, parameters=(), batch_size=1000):
+        """Yield every recipient (or those matching an SQL where clause) in email order, fetching batch_size rows at a time."""
+        query = f'SELECT {", ".join(COLUMNS)} FROM recipients'
+        if where:
+            query += f' WHERE {where}'
+        cursor = self.db.execute(query + ' ORDER BY email', parameters)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                return
+            for row in rows:
+                yield self._to_recipient(row)
+
+    def emails(self, where=None, parameters=()):
+        query = 'SELECT email FROM recipients'
+        if where:
+            query += f' WHERE {where}'
+        return [row[0] for row in self.db.execute(query + ' ORDER BY email', parameters)]
+
+    def migrate_from_dict(self, recipient_dict):
+        """One time import of the old pickled {email: EmailRecipient} dict."""
+        for email, recipient in recipient_dict.items():
+            recipient.email = recipient.email or email
+        self.upsert(recipient_dict.values())
+        self.sync()
+        print(f'Migrated {len(recipient_dict)} recipients to {self.remote_path}')
@@ -0,0 +1,109 @@
+import numpy as np
+
+# Registration analytics
+# Stats for the admin dashboard, computed with NumPy over columns of the recipient index and the per-file partial
+# indexes instead of a Python loop per runner.  The result is a plain dict, saved by race_registrations as a
+# precomputed stats document, so requests only read it.
+#
+#    contacts:  histogram of registrations per opted-in runner
+#    age/sex/zip:  distributions over opted-in runners (age 0 and empty fields are unknown)
+#    last_registration:  runners by the year of their most recent registration
+#    years:  for each registration year, registrations, opt-ins, opt-in rate, runners and the share of them
+#            who registered again the next year (retention).  Registrations and opt-ins are counted per row by
+#            the row's registration date (race_registrations keeps them per file), so the rate is at most 1.
+
+AGE_BINS = [1, 20, 30, 40, 50, 60, 70, 120]
+TOP_ZIPS = 25
+
+
+def _counts(values):
+    """Returns {value: count} for a column, largest counts first."""
+    keys, counts = np.unique(values, return_counts=True)
+    order = np.argsort(-counts, kind='stable')
+    return {str(keys[i]): int(counts[i]) for i in order}
+
+
+def recipient_columns(recipients):
+    """Columns of the fields used by the analytics, one entry per recipient."""
+    recipients = list(recipients)
+    return {
+        'contacts': np.fromiter((r.number_of_contacts for r in recipients), dtype=np.int32, count=len(recipients)),
+        'age': np.fromiter((r.age for r in recipients), dtype=np.int32, count=len(recipients)),
+        'date': np.fromiter((r.most_recent_contact for r in recipients), dtype=np.int64, count=len(recipients)),
+        'sex': np.array([r.sex for r in recipients], dtype=str),
+        'zip': np.array([r.zip[:5] for r in recipients], dtype=str),
+    }
+
+
+def contact_histogram(contacts):
+    """Returns {number of registrations: runners} for an array of registrations per runner."""
+    histogram = np.bincount(contacts) if len(contacts) else np.zeros(0, dtype=np.int64)
+    return {int(n): int(histogram[n]) for n in np.flatnonzero(histogram)}
+
+
+def age_distribution(ages):
+    known = ages[ages > 0]
+    counts, edges = np.histogram(known, bins=AGE_BINS)
+    labels = [f'{int(edges[i])}-{int(edges[i + 1]) - 1}' for i in range(len(counts))]
+    distribution = dict(zip(labels, counts.tolist()))
+    distribution['unknown'] = int(len(ages) - len(known))
+    return distribution
+
+
+def yearly_stats(partials, file_years, aliases=None):
+    """partials is a list of (filename, {email: EmailRecipient}) with each file's opted-in registrations, and
+    file_years maps filename to {year: [rows, opt-ins]} counted per row by its registration date.  A runner counts
+    toward the year of their latest registration in each file.  aliases maps emails to a person's primary email,
+    so runners are counted as persons."""
+    aliases = aliases or {}
+    counts = {}
+    for years in file_years.values():
+        for year, (rows, opt_ins) in years.items():
+            if int(year) > 0:
+                total = counts.setdefault(int(year), [0, 0])
+                total[0] += rows
+                total[1] += opt_ins
+    emails, years = [], []
+    for filename, registrations in partials:
+        emails.extend(aliases.get(email, email) for email in registrations)
+        years.append(np.fromiter((r.most_recent_contact for r in registrations.values()), dtype=np.int64,
+                                 count=len(registrations)) // 100000000)
+    if not emails and not counts:
+        return {}
+    years = np.concatenate(years) if years else np.zeros(0, dtype=np.int64)
+    runner_ids = np.unique(np.array(emails, dtype=str), return_inverse=True)[1]
+    known = years > 0
+    years, runner_ids = years[known], runner_ids[known]
+
+    stats = {}
+    for year in sorted(set(counts) | set(np.unique(years).tolist())):
+        runners = np.unique(runner_ids[years == year])
+        next_year = np.unique(runner_ids[years == year + 1])
+        rows, opt_ins = counts.get(year, (0, 0))
+        year_stats = {
+            'registrations': rows,
+            'opt_ins': opt_ins,
+            'opt_in_rate': round(opt_ins / rows, 3) if rows else None,
+            'runners': len(runners),
+        }
+        if len(runners) and len(next_year): # No retention for the latest year
+            retained = int(np.isin(runners, next_year, assume_unique=True).sum())
+            year_stats['retained_next_year'] = retained
+            year_stats['retention'] = round(retained / len(runners), 3)
+        stats[year] = year_stats
+    return stats
+
+
+def registration_analytics(index, partials, file_years, aliases=None):
+    """Compute the stats document from the merged recipient (or person) index and the per-file partial indexes."""
+    columns = recipient_columns(index.values())
+    return {
+        'runners': int(len(columns['contacts'])),
+        'registrations': int(columns['contacts'].sum()),
+        'contacts': contact_histogram(columns['contacts']),
+        'age': age_distribution(columns['age']),
+        'sex': _counts(columns['sex'][columns['sex'] != '']),
+        'zip': dict(list(_counts(columns['zip'][columns['zip'] != '']).items())[:TOP_ZIPS]),
+        'last_registration': _counts(columns['date'][columns['date'] > 0] // 100000000),
+        'years': yearly_stats(partials, file_years, aliases),
+    }
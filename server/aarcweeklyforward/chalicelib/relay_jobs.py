@@ -0,0 +1,240 @@
+import datetime, hashlib, json, os, time, uuid
+from chalicelib.object_store import ObjectStore
+from chalicelib import metrics, send_log
+
+# Relay jobs
+# A relay is submitted as a job instead of sending every email inside one API Gateway request.  The recipients are
+# split into chunks, and each chunk is a queue message handled by its own worker invocation (an SQS triggered
+# Lambda, see relay_worker in app.py).  Layout in the object store:
+#
+#    relay-jobs/<job id>/job.json            subject, body, number of chunks
+#    relay-jobs/<job id>/chunks/<n>.json     the chunk's recipients and, once processed, its checkpoint
+#    relay-jobs/<job id>/claims/<n>.json     {'claimed', 'worker'} while a worker is processing the chunk
+#    relay-log/<email key>/<job id>-<n>-<worker>-<batch>.json   addresses one Gmail batch request sent the email to
+#    relay-log/<email key>/<job id>-<n>.json                    every address the chunk sent the email to
+#
+# Each processed chunk is also appended to the send log (see send_log.py), which keeps the /emails counters.
+#
+# The relay log is keyed by a hash of the email's subject and body, not by job.  It is written as each batch
+# request of a chunk completes, so a worker that times out or crashes part way through a chunk leaves a log of
+# everyone it sent to, and the redelivered chunk only sends to the rest (at most the batches that were in flight
+# are sent twice).  A worker only reads its own chunk's log, and when the chunk is checkpointed its batch logs are
+# compacted into one log for the chunk.  A job leaves out everyone an earlier job for the same weekly email sent
+# it to, read once when the job is submitted; two jobs for the same email running at the same time don't see
+# each other's sends.
+#
+# A worker claims a chunk before sending, with a conditional put that only succeeds if there is no claim, so two
+# deliveries of the same chunk at the same time can't both send it.  The loser raises ChunkBusy, which leaves the
+# message on the queue to be delivered again later, when the chunk is done.  The claim is removed when the chunk
+# is checkpointed; a claim older than CLAIM_SECONDS belongs to a worker that died and is taken over.
+#
+# Deployment: Chalice creates the relay_worker Lambda and its event source mapping, but not the queue, and with
+# manage_iam_role false it doesn't touch the role either.  Before deploying:
+#    create the SQS standard queue RELAY_QUEUE with a visibility timeout of at least 900 seconds, the relay_worker
+#    timeout in .chalice/config.json (a Lambda's visibility timeout must not be shorter than its timeout), and
+#    optionally a dead letter queue for chunks that keep failing
+#    give the role in .chalice/config.json sqs:GetQueueUrl and sqs:SendMessage (the API submits jobs) and
+#    sqs:ReceiveMessage, sqs:DeleteMessage and sqs:GetQueueAttributes (the worker) on the queue, besides the
+#    S3 permissions on the bucket
+
+JOB_PREFIX = 'relay-jobs/'
+LOG_PREFIX = 'relay-log/'
+CHUNK_SIZE = 200
+CLAIM_SECONDS = 900 # The longest a Lambda invocation can run.
+RELAY_QUEUE = 'aarc-weekly-relay'
+
+store = ObjectStore()
+
+
+class ChunkBusy(Exception):
+    pass
+
+
+class LocalQueue(object):
+    """In-process stand-in for the SQS relay queue.  Messages are processed as soon as they are sent,
+    unless auto_process is False, in which case they wait in messages until process() is called."""
+
+    def __init__(self, auto_process=True):
+        self.auto_process = auto_process
+        self.messages = []
+
+    def send(self, message):
+        self.messages.append(message)
+        if self.auto_process:
+            self.process()
+
+    def process(self):
+        while self.messages:
+            process_chunk(**self.messages.pop(0))
+
+
+class SqsQueue(object):
+
+    def __init__(self, queue_name=RELAY_QUEUE):
+        import boto3
+        self.sqs = boto3.client('sqs')
+        self.queue_url = self.sqs.get_queue_url(QueueName=queue_name)['QueueUrl']
+
+    def send(self, message):
+        self.sqs.send_message(QueueUrl=self.queue_url, MessageBody=json.dumps(message))
+
+
+def default_queue():
+    return SqsQueue() if 'AWS_REGION' in os.environ else LocalQueue()
+
+
+def email_key(subject, body):
+    return hashlib.sha1(f'{subject}\n{body}'.encode()).hexdigest()[:16]
+
+
+def submit_job(subject, body, recipients, queue=None, chunk_size=CHUNK_SIZE, email_date=None):
+    """Create a relay job for recipients and queue its chunks.  email_date is when the weekly email went out
+    from WildApricot.  Returns the job id."""
+    queue = queue or default_queue()
+    job_id = uuid.uuid4().hex
+    key = email_key(subject, body)
+    recipients = list(dict.fromkeys(recipients))
+    with metrics.stage('relay.log_read'):
+        log_keys, already_sent = read_relay_log(f'{LOG_PREFIX}{key}/')
+    todo = [email for email in recipients if email not in already_sent]
+    chunks = [todo[i:i + chunk_size] for i in range(0, len(todo), chunk_size)]
+    store.put_json(f'{JOB_PREFIX}{job_id}/job.json', {
+        'id': job_id,
+        'email_key': key,
+        'subject': subject,
+        'body': body,
+        'email_date': email_date,
+        'recipients': len(recipients),
+        'skipped': len(recipients) - len(todo),
+        'chunks': len(chunks),
+        'created': datetime.datetime.utcnow().isoformat(),
+    })
+    for n, chunk in enumerate(chunks):
+        store.put_json(f'{JOB_PREFIX}{job_id}/chunks/{n:05}.json', {'recipients': chunk, 'status': 'pending'})
+    for n in range(len(chunks)):
+        queue.send({'job_id': job_id, 'chunk': n})
+    print(f'Submitted relay job {job_id}: {len(recipients)} recipients in {len(chunks)} chunks')
+    return job_id
+
+
+def read_relay_log(prefix):
+    """Returns the keys of the relay log objects that start with prefix and every address in them."""
+    log_keys = store.list(prefix)
+    sent = set()
+    for log_key in log_keys:
+        sent.update(store.get_json(log_key) or [])
+    return log_keys, sent
+
+
+def claim_chunk(job_id, chunk, worker):
+    """True if worker now holds the chunk's claim: there was none, or it was older than CLAIM_SECONDS."""
+    claim_key = f'{JOB_PREFIX}{job_id}/claims/{chunk:05}.json'
+    claim = json.dumps({'claimed': time.time(), 'worker': worker}).encode()
+    if store.put_if(claim_key, claim):
+        return True
+    data, etag = store.get_versioned(claim_key)
+    if data is None:
+        return store.put_if(claim_key, claim) is not None # Released in the meantime.
+    held = json.loads(data)
+    if time.time() - held['claimed'] < CLAIM_SECONDS:
+        return False
+    print(f'Taking over relay job {job_id} chunk {chunk} from worker {held["worker"]}')
+    return store.put_if(claim_key, claim, etag) is not None
+
+
+def release_chunk(job_id, chunk):
+    store.delete(f'{JOB_PREFIX}{job_id}/claims/{chunk:05}.json')
+
+
+def process_chunk(job_id, chunk, send=None):
+    """Worker: claim one chunk of a job, send it, skipping recipients in the relay log, then checkpoint it.
+    Raises ChunkBusy if another worker is processing the chunk."""
+    if send is None:
+        from chalicelib.emailer import send_weekly_email as send
+    job = store.get_json(f'{JOB_PREFIX}{job_id}/job.json')
+    chunk_key = f'{JOB_PREFIX}{job_id}/chunks/{chunk:05}.json'
+    state = store.get_json(chunk_key)
+    if job is None or state is None:
+        print(f'Relay job {job_id} chunk {chunk} not found')
+        return
+    if state['status'] == 'done':
+        return # Duplicate delivery of a chunk that already finished.
+
+    worker = uuid.uuid4().hex[:8]
+    if not claim_chunk(job_id, chunk, worker):
+        raise ChunkBusy(f'Relay job {job_id} chunk {chunk} is being processed by another worker')
+    try:
+        state = store.get_json(chunk_key) # It may have been finished by the worker that held the claim.
+        if state['status'] == 'done':
+            return
+
+        # Only earlier attempts at this chunk can have sent to its recipients.
+        chunk_log = f'{LOG_PREFIX}{job["email_key"]}/{job_id}-{chunk:05}'
+        with metrics.stage('relay.log_read'):
+            log_keys, already_sent = read_relay_log(chunk_log)
+        todo = [email for email in state['recipients'] if email not in already_sent]
+
+        def log_batch(sent):
+            if sent:
+                log_keys.append(f'{chunk_log}-{worker}-{len(log_keys):03}.json')
+                store.put_json(log_keys[-1], sent)
+
+        sent, failed = send(job['subject'], job['body'], todo, on_batch=log_batch) if todo else ([], {})
+        if log_keys and log_keys != [f'{chunk_log}.json']:
+            store.put_json(f'{chunk_log}.json', sorted(already_sent.union(sent)))
+            for log_key in log_keys:
+                if log_key != f'{chunk_log}.json':
+                    store.delete(log_key)
+
+        if sent or failed:
+            send_log.append_segment(job, chunk, sent, failed)
+        state.update({
+            'status': 'failed' if failed else 'done',
+            'sent': len(sent),
+            'skipped': len(state['recipients']) - len(todo),
+            'failed': failed,
+            'processed': datetime.datetime.utcnow().isoformat(),
+        })
+        store.put_json(chunk_key, state)
+    finally:
+        release_chunk(job_id, chunk)
+    metrics.count('relay.chunks')
+    metrics.count('relay.skipped', state['skipped'])
+
+
+def job_status(job_id):
+    job = store.get_json(f'{JOB_PREFIX}{job_id}/job.json')
+    if job is None:
+        return None
+    counts = {'pending': 0, 'done': 0, 'failed': 0}
+    sent = failed = 0
+    skipped = job.get('skipped', 0)
+    for chunk_key in store.list(f'{JOB_PREFIX}{job_id}/chunks/'):
+        state = store.get_json(chunk_key)
+        counts[state['status']] += 1
+        sent += state.get('sent', 0)
+        skipped += state.get('skipped', 0)
+        failed += len(state.get('failed', {}))
+    if counts['pending']:
+        status = 'running'
+    else:
+        status = 'failed' if counts['failed'] else 'done'
+    return {'job-id': job_id, 'status': status, 'subject': job['subject'], 'created': job['created'],
+            'recipients': job['recipients'], 'chunks': job['chunks'], 'chunks-done': counts['done'],
+            'chunks-failed': counts['failed'], 'sent': sent, 'skipped': skipped, 'failed': failed}
+
+
+def resume_job(job_id, queue=None):
+    """Queue again every chunk of a job that has not finished, e.g. after a worker timed out or chunks failed.
+    Recipients already in the chunk's relay log are skipped when the chunks are processed again."""
+    queue = queue or default_queue()
+    resumed = 0
+    for chunk_key in store.list(f'{JOB_PREFIX}{job_id}/chunks/'):
+        state = store.get_json(chunk_key)
+        if state['status'] != 'done':
+            if state['status'] == 'failed':
+                state['status'] = 'pending'
+                store.put_json(chunk_key, state)
+            queue.send({'job_id': job_id, 'chunk': int(chunk_key.rsplit('/', 1)[1].split('.')[0])})
+            resumed += 1
+    return resumed
@@ -0,0 +1,131 @@
+import datetime, json, time
+from chalicelib.object_store import ObjectStore
+from chalicelib import dashboard, metrics
+
+# Send log
+# Every processed relay chunk appends one segment to an append-only event log; segments are never rewritten.
+#
+#    send-log/segments/<time>-<job id>-<chunk>.jsonl   a header line (job, email key, subject, email date), then one
+#                                                       {"event": "sent"|"failed", "email": ...} line per message
+#    send-log/aggregates.json                           counters folded from the segments
+#
+# Appending a segment folds the segments that are not in the aggregates yet into them, so /emails reads one small
+# object instead of the history.  Segment keys start with the time they were written, and the aggregates remember
+# the keys folded during the last SETTLE_SECONDS, so a segment from a slow worker that lands after a newer one is
+# still folded exactly once.  Concurrent folds can overwrite each other's aggregates, but each writes a consistent
+# state, and whatever one misses the next fold catches up on.
+#
+# Per-recipient sends go to emails_sent in the recipient store when a segment is folded.  The aggregates are only
+# saved once the recipient store is, so if that fails (the fold raises) the next fold counts the segments again,
+# and the store skips segments it counted already (see RecipientStore.increment_once).
+
+LOG_PREFIX = 'send-log/'
+SEGMENT_PREFIX = f'{LOG_PREFIX}segments/'
+AGGREGATES_FILENAME = f'{LOG_PREFIX}aggregates.json'
+SETTLE_SECONDS = 900
+TIME_FORMAT = '%Y%m%dT%H%M%S%f'
+
+store = ObjectStore()
+
+
+def empty_aggregates():
+    return {'settled': '', 'recent': [], 'segments': 0, 'total-sent': 0, 'total-failed': 0, 'last-key': None,
+            'emails': {}}
+
+
+def segment_key(job_id, chunk, now=None):
+    now = now or datetime.datetime.utcnow()
+    return f'{SEGMENT_PREFIX}{now.strftime(TIME_FORMAT)}-{job_id}-{chunk:05}.jsonl'
+
+
+def append_segment(job, chunk, sent, failed):
+    """Log the outcome of one chunk of a relay job and fold it into the aggregates.  Returns the segment key."""
+    key = segment_key(job['id'], chunk)
+    header = {'job': job['id'], 'chunk': chunk, 'key': job['email_key'], 'subject': job['subject'],
+              'email_date': job.get('email_date'), 'time': time.time()}
+    lines = [json.dumps(header)]
+    lines.extend(json.dumps({'event': 'sent', 'email': email}) for email in sent)
+    lines.extend(json.dumps({'event': 'failed', 'email': email, 'error': error}) for email, error in failed.items())
+    with metrics.stage('sendlog.append'):
+        store.put(key, ('\n'.join(lines) + '\n').encode())
+    fold()
+    return key
+
+
+def read_segment(key):
+    """Returns the header and the events of a segment."""
+    lines = store.get(key).decode().splitlines()
+    return json.loads(lines[0]), [json.loads(line) for line in lines[1:] if line]
+
+
+def apply_segment(aggregates, header, events):
+    sent = sum(1 for event in events if event['event'] == 'sent')
+    failed = len(events) - sent
+    relayed = datetime.datetime.utcfromtimestamp(header['time']).isoformat()
+    email = aggregates['emails'].setdefault(header['key'], {
+        'subject': header['subject'], 'email-date': header.get('email_date'), 'first-relayed': relayed,
+        'last-relayed': relayed, 'sent': 0, 'failed': 0})
+    email['first-relayed'] = min(email['first-relayed'], relayed)
+    email['last-relayed'] = max(email['last-relayed'], relayed)
+    email['sent'] += sent
+    email['failed'] += failed
+    aggregates['segments'] += 1
+    aggregates['total-sent'] += sent
+    aggregates['total-failed'] += failed
+    last = aggregates['emails'].get(aggregates['last-key'])
+    if last is None or email['first-relayed'] >= last['first-relayed']:
+        aggregates['last-key'] = header['key']
+
+
+def read_aggregates():
+    return store.get_json(AGGREGATES_FILENAME) or empty_aggregates()
+
+
+def fold(aggregates=None):
+    """Fold segments that are not in the aggregates yet into them, save them if anything changed and return them."""
+    with metrics.stage('sendlog.fold'):
+        aggregates = aggregates or read_aggregates()
+        recent = set(aggregates['recent'])
+        start_after = f'{SEGMENT_PREFIX}{aggregates["settled"]}'
+        new_keys = [key for key in store.list(SEGMENT_PREFIX, start_after=start_after) if key not in recent]
+        segments = {key: read_segment(key) for key in new_keys}
+        for header, events in segments.values():
+            apply_segment(aggregates, header, events)
+        from chalicelib.emailer import record_sent
+        record_sent({key: [event['email'] for event in events if event['event'] == 'sent']
+                     for key, (header, events) in segments.items()})
+        # Segments written before the settled time are all in; only the keys folded since need remembering.
+        settled = (datetime.datetime.utcnow() - datetime.timedelta(seconds=SETTLE_SECONDS)).strftime(TIME_FORMAT)
+        settled = max(aggregates['settled'], settled)
+        recent = sorted(key for key in recent.union(new_keys) if key > f'{SEGMENT_PREFIX}{settled}')
+        if new_keys or recent != aggregates['recent']:
+            aggregates['settled'] = settled
+            aggregates['recent'] = recent
+            store.put_json(AGGREGATES_FILENAME, aggregates)
+        if new_keys:
+            dashboard.update_section('emails', email_stats(aggregates))
+        metrics.count('sendlog.folded', len(new_keys))
+    return aggregates
+
+
+def rebuild():
+    """Fold the whole log into fresh aggregates, e.g. after segments were removed by hand."""
+    return fold(empty_aggregates())
+
+
+def format_date(timestamp):
+    if not timestamp:
+        return None
+    return datetime.datetime.fromisoformat(timestamp[:19]).strftime('%d-%B-%Y')
+
+
+def email_stats(aggregates=None):
+    """The /emails summary: weekly emails relayed, when the latest was relayed, its date and the total sent."""
+    aggregates = aggregates or read_aggregates()
+    last = aggregates['emails'].get(aggregates['last-key']) or {}
+    return {'relayed': len(aggregates['emails']),
+            'last-date': format_date(last.get('last-relayed')),
+            'last-relayed': format_date(last.get('email-date')),
+            'last-subject': last.get('subject'),
+            'total-sent': aggregates['total-sent'],
+            'total-failed': aggregates['total-failed']}
@@ -0,0 +1,81 @@
+import base64, binascii, hmac, os, secrets
+from hashlib import sha256
+from chalicelib.object_store import ObjectStore
+from chalicelib.audience import add_opt_outs
+from chalicelib.email_recipient import normalize_email
+
+# Unsubscribe links
+# Every relayed weekly email carries a link to /unsubscribe with a token for its recipient, in the footer and in a
+# List-Unsubscribe header (with List-Unsubscribe-Post, so mail clients can unsubscribe in one click, RFC 8058).
+# A token is the address and an HMAC-SHA256 of it, so the route needs no lookup to trust it:
+#
+#    <base64url address>.<base64url first TOKEN_MAC_BYTES of the MAC>
+#
+# The MAC key is made on first use and kept in the object store.  It is only written if there is no key yet, and
+# read back, so workers relaying their first chunks at the same time all sign with the key that was saved.  Tokens
+# are made in bulk for each relayed chunk: the keyed HMAC is set up once and copied for each address.  Deleting
+# the key invalidates every link sent so far.
+#
+#    unsubscribe_key.json    {'key': <hex>}
+
+KEY_FILENAME = 'unsubscribe_key.json'
+TOKEN_MAC_BYTES = 16
+UNSUBSCRIBE_URL = os.environ.get('UNSUBSCRIBE_URL', 'https://api.exemplys.com/weekly-emails/unsubscribe')
+
+store = ObjectStore()
+_key = None
+
+
+def mac_key():
+    global _key
+    if _key is None:
+        saved = store.get_json(KEY_FILENAME)
+        if saved is None:
+            saved = store.create_json(KEY_FILENAME, {'key': secrets.token_hex(32)})
+        _key = bytes.fromhex(saved['key'])
+    return _key
+
+
+def b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def b64decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+def make_tokens(emails):
+    """Returns {email: token} for each address in emails."""
+    keyed = hmac.new(mac_key(), digestmod=sha256)
+    tokens = {}
+    for email in emails:
+        address = email.encode('utf-8')
+        mac = keyed.copy()
+        mac.update(address)
+        tokens[email] = f'{b64encode(address)}.{b64encode(mac.digest()[:TOKEN_MAC_BYTES])}'
+    return tokens
+
+
+def unsubscribe_urls(emails):
+    """Returns {email: unsubscribe link} for each address in emails."""
+    return {email: f'{UNSUBSCRIBE_URL}?t={token}' for email, token in make_tokens(emails).items()}
+
+
+def verify_token(token):
+    """Returns the address a token was made for, or None if it is not a valid token."""
+    try:
+        address, mac = (b64decode(part) for part in (token or '').split('.'))
+        email = address.decode('utf-8')
+    except (ValueError, binascii.Error):
+        return None
+    expected = make_tokens([email])[email].split('.')[1]
+    return email if hmac.compare_digest(b64encode(mac), expected) else None
+
+
+def unsubscribe(token):
+    """Add the address of a valid token to the opt-out list.  Returns the address, or None if the token is not valid."""
+    email = normalize_email(verify_token(token) or '')
+    if email:
+        add_opt_outs([email])
+        print(f'Unsubscribed {email}')
+    return email
@@ -10,13 +10,18 @@ Example:
 """
 
 import datetime
-import urllib.request
-import urllib.response
-import urllib.error
+import threading
+import time
 import urllib.parse
 import json
 import base64
 
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from chalicelib import metrics
+
 
 class WaApiClient(object):
     """Wild apricot API client."""
@@ -25,10 +30,34 @@ class WaApiClient(object):
     _token = None
     client_id = None
     client_secret = None
+    # Transport settings. All requests go through one requests.Session, so connections are kept alive and pooled,
+    # and gzip/deflate responses are decoded by requests.
+    timeout = (5, 60) # (connect, read) seconds
+    max_retries = 3 # for connection errors and 429/5xx responses to idempotent requests
+    pool_size = 10
+    # The access token is refreshed in the background this many seconds before it expires.
+    token_refresh_margin = 300
 
-    def __init__(self, client_id, client_secret):
+    def __init__(self, client_id, client_secret, timeout=None, max_retries=None):
         self.client_id = client_id
         self.client_secret = client_secret
+        if timeout is not None:
+            self.timeout = timeout
+        if max_retries is not None:
+            self.max_retries = max_retries
+        self._session = self._create_session()
+        self._token_lock = threading.Lock()
+        self._refresh_timer = None
+
+    def _create_session(self):
+        session = requests.Session()
+        retry = Retry(total=self.max_retries, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504),
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size, max_retries=retry)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        session.headers.update({"Accept-Encoding": "gzip, deflate"})
+        return session
 
     def authenticate_with_apikey(self, api_key, scope=None):
         """perform authentication by api key and store result for execute_request method
@@ -40,13 +69,8 @@ class WaApiClient(object):
             "grant_type": "client_credentials",
             "scope": scope
         }
-        encoded_data = urllib.parse.urlencode(data).encode()
-        request = urllib.request.Request(self.auth_endpoint, encoded_data, method="POST")
-        request.add_header("ContentType", "application/x-www-form-urlencoded")
-        request.add_header("Authorization", 'Basic ' + base64.standard_b64encode(('APIKEY:' + api_key).encode()).decode())
-        response = urllib.request.urlopen(request)
-        self._token = WaApiClient._parse_response(response)
-        self._token.retrieved_at = datetime.datetime.now()
+        auth_header = base64.standard_b64encode(('APIKEY:' + api_key).encode()).decode()
+        self._set_token(self._request_token(data, auth_header))
 
     def authenticate_with_contact_credentials(self, username, password, scope=None):
         """perform authentication by contact credentials and store result for execute_request method
@@ -61,21 +85,16 @@ class WaApiClient(object):
             "password": password,
             "scope": scope
         }
-        encoded_data = urllib.parse.urlencode(data).encode()
-        request = urllib.request.Request(self.auth_endpoint, encoded_data, method="POST")
-        request.add_header("ContentType", "application/x-www-form-urlencoded")
         auth_header = base64.standard_b64encode((self.client_id + ':' + self.client_secret).encode()).decode()
-        request.add_header("Authorization", 'Basic ' + auth_header)
-        response = urllib.request.urlopen(request)
-        self._token = WaApiClient._parse_response(response)
-        self._token.retrieved_at = datetime.datetime.now()
+        self._set_token(self._request_token(data, auth_header))
 
-    def execute_request(self, api_url, api_request_object=None, method=None):
+    def execute_request(self, api_url, api_request_object=None, method=None, raw=False):
         """
         perform api request and return result as an instance of ApiObject or list of ApiObjects
         api_url -- absolute or relative api resource url
         api_request_object -- any json serializable object to send to API
         method -- HTTP method of api request. Default: GET if api_request_object is None else POST
+        raw -- return the decoded JSON as plain dicts and lists instead of ApiObjects
         """
         if self._token is None:
             raise ApiException("Access token is not abtained. "
@@ -90,46 +109,97 @@ class WaApiClient(object):
             else:
                 method = "POST"
 
-        request = urllib.request.Request(api_url, method=method)
+        data = None
         if api_request_object is not None:
-            request.data = json.dumps(api_request_object, cls=_ApiObjectEncoder).encode()
+            data = json.dumps(api_request_object, cls=_ApiObjectEncoder).encode()
 
-        request.add_header("Content-Type", "application/json")
-        request.add_header("Accept", "application/json")
-        request.add_header("Authorization", "Bearer " + self._get_access_token())
+        headers = {
+            "Content-Type": "application/json",
+            "Accept": "application/json",
+            "Authorization": "Bearer " + self._get_access_token(),
+        }
+        start = time.perf_counter()
+        response = self._session.request(method, api_url, data=data, headers=headers, timeout=self.timeout)
+        metrics.observe('wildapricot.request', (time.perf_counter() - start) * 1000)
+        metrics.count('wildapricot.bytes', len(response.content), 'Bytes')
+        if response.status_code == 400:
+            raise ApiException(response.content)
+        response.raise_for_status()
+        if raw:
+            return response.json()
+        return WaApiClient._parse_response(response)
+
+    def _request_token(self, data, auth_header):
+        headers = {
+            "Content-Type": "application/x-www-form-urlencoded",
+            "Authorization": "Basic " + auth_header,
+        }
+        start = time.perf_counter()
+        response = self._session.post(self.auth_endpoint, data=urllib.parse.urlencode(data), headers=headers,
+                                      timeout=self.timeout)
+        metrics.observe('wildapricot.auth', (time.perf_counter() - start) * 1000)
+        response.raise_for_status()
+        token = WaApiClient._parse_response(response)
+        token.retrieved_at = datetime.datetime.now()
+        return token
 
+    def _set_token(self, token):
+        """Store a new token and schedule its refresh token_refresh_margin seconds before it expires."""
+        self._token = token
+        if self._refresh_timer is not None:
+            self._refresh_timer.cancel()
+        if getattr(token, "refresh_token", None):
+            refresh_at = token.retrieved_at + datetime.timedelta(seconds=token.expires_in - self.token_refresh_margin)
+            delay = max((refresh_at - datetime.datetime.now()).total_seconds(), 0)
+            self._refresh_timer = threading.Timer(delay, self._background_refresh)
+            self._refresh_timer.daemon = True
+            self._refresh_timer.start()
+
+    def _background_refresh(self):
         try:
-            response = urllib.request.urlopen(request)
-            return WaApiClient._parse_response(response)
-        except urllib.error.HTTPError as httpErr:
-            if httpErr.code == 400:
-                raise ApiException(httpErr.read())
-            else:
-                raise
+            self._refresh_auth_token()
+        except Exception as exc:
+            # Leave the current token in place. _get_access_token() refreshes it in the foreground if it expires.
+            print(f'Background token refresh failed: {exc}')
+
+    def export_token(self):
+        """Return the current token as a JSON serializable dict, e.g. to cache it between processes."""
+        if self._token is None:
+            return None
+        return {"access_token": self._token.access_token,
+                "refresh_token": getattr(self._token, "refresh_token", None),
+                "expires_in": self._token.expires_in,
+                "retrieved_at": self._token.retrieved_at.isoformat()}
+
+    def import_token(self, state):
+        """Use a token saved by export_token instead of authenticating. Returns False if it has already expired."""
+        token = ApiObject(dict(state))
+        token.retrieved_at = datetime.datetime.fromisoformat(state["retrieved_at"])
+        expires_at = token.retrieved_at + datetime.timedelta(seconds=token.expires_in - self.token_refresh_margin)
+        if datetime.datetime.now() > expires_at:
+            return False
+        self._set_token(token)
+        return True
 
     def _get_access_token(self):
         expires_at = self._token.retrieved_at + datetime.timedelta(seconds=self._token.expires_in - 100)
         if datetime.datetime.now() > expires_at:
+            # The background refresh did not run in time, e.g. because a Lambda container was frozen.
             self._refresh_auth_token()
         return self._token.access_token
 
     def _refresh_auth_token(self):
-        data = {
-            "grant_type": "refresh_token",
-            "refresh_token": self._token.refresh_token
-        }
-        encoded_data = urllib.parse.urlencode(data).encode()
-        request = urllib.request.Request(self.auth_endpoint, encoded_data, method="POST")
-        request.add_header("ContentType", "application/x-www-form-urlencoded")
-        auth_header = base64.standard_b64encode((self.client_id + ':' + self.client_secret).encode()).decode()
-        request.add_header("Authorization", 'Basic ' + auth_header)
-        response = urllib.request.urlopen(request)
-        self._token = WaApiClient._parse_response(response)
-        self._token.retrieved_at = datetime.datetime.now()
+        with self._token_lock:
+            data = {
+                "grant_type": "refresh_token",
+                "refresh_token": self._token.refresh_token
+            }
+            auth_header = base64.standard_b64encode((self.client_id + ':' + self.client_secret).encode()).decode()
+            self._set_token(self._request_token(data, auth_header))
 
     @staticmethod
     def _parse_response(http_response):
-        decoded = json.loads(http_response.read().decode())
+        decoded = http_response.json()
         if isinstance(decoded, list):
             result = []
             for item in decoded:
@@ -150,32 +220,48 @@ class ApiException(Exception):
 
 
 class ApiObject(object):
-    """Represent any api call input or output object"""
+    """Represent any api call input or output object.
+    Nested dicts, and dicts in lists, are wrapped in ApiObjects the first time the attribute holding them is read,
+    so a large response only pays for the parts that are used.  Reading __dict__ wraps all the attributes, so
+    obj.__dict__['Contacts'] holds ApiObjects, as it did when everything was wrapped up front."""
 
     def __init__(self, state):
         self.__dict__ = state
-        for key, value in vars(self).items():
-            if isinstance(value, dict):
-                self.__dict__[key] = ApiObject(value)
-            elif isinstance(value, list):
-                new_list = []
-                for list_item in value:
-                    if isinstance(list_item, dict):
-                        new_list.append(ApiObject(list_item))
-                    else:
-                        new_list.append(list_item)
-                self.__dict__[key] = new_list
+
+    def __getattribute__(self, name):
+        state = object.__getattribute__(self, '__dict__')
+        if name in state:
+            return _wrap_attribute(state, name)
+        if name == '__dict__':
+            for key in state:
+                _wrap_attribute(state, key)
+            return state
+        return object.__getattribute__(self, name)
 
     def __str__(self):
-        return json.dumps(self.__dict__)
+        return json.dumps(object.__getattribute__(self, '__dict__'), cls=_ApiObjectEncoder)
 
     def __repr__(self):
-        return json.dumps(self.__dict__)
+        return json.dumps(object.__getattribute__(self, '__dict__'), cls=_ApiObjectEncoder)
+
+
+def _wrap_attribute(state, name):
+    value = state[name]
+    if isinstance(value, dict):
+        value = state[name] = ApiObject(value)
+    elif isinstance(value, list) and not isinstance(value, _ApiObjectList):
+        value = state[name] = _ApiObjectList(ApiObject(item) if isinstance(item, dict) else item for item in value)
+    return value
+
+
+class _ApiObjectList(list):
+    """A list whose dict items have already been wrapped in ApiObjects."""
+    pass
 
 
 class _ApiObjectEncoder(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, ApiObject):
-            return obj.__dict__
+            return object.__getattribute__(obj, '__dict__')
         # Let the base class default method raise the TypeError
         return json.JSONEncoder.default(self, obj)
@@ -1,4 +1,6 @@
 from chalicelib.wa_api import WaApiClient
+from chalicelib.cache import TwoTierCache
+from chalicelib import dashboard, metrics
 import json
 import os, pickle
 from smart_open import open
@@ -10,6 +12,24 @@ from inspect import getmembers
 DIR_PREFIX = "s3://aarclub-files/weekly-emails/" if 'AWS_REGION' in os.environ else ""
 PICKLE_FILENAME = "wa_all_contacts.p"
 STATS_FILENAME = "aarc_stats.json"
+# The WildApricot access token is cached in /tmp so a restarted process in a warm container can skip logging in.
+TOKEN_CACHE_FILENAME = "wa_token.json"
+CONTACTS_URL = "/v2.2/accounts/30507/Contacts"
+CONTACTS_PAGE_SIZE = 500
+SENT_EMAILS_URL = "/v2/Accounts/30507/SentEmails"
+WEEKLY_EMAIL_TYPE = "EmailBlast_Members"
+WEEKLY_EMAIL_SUBJECT = "AARC Weekly Update"
+# The newest weekly email relayed so far ({'Id', 'SentDate', 'Url'}), so later checks only ask for newer SentEmails
+# entries.  It is moved by emailer.relay_email() once the email's relay job is submitted.
+EMAIL_CURSOR_FILENAME = "weekly_email_cursor.json"
+# Weekly email bodies ({'Subject', 'Body', 'SentDate'}) are cached by email Id.
+EMAIL_BODY_FILENAME = "weekly_email_{}.json"
+
+# Club stats are served from /tmp for an hour, then for up to a day more while S3 is checked in the background.
+# The cursor is always revalidated, which costs a 304 when it hasn't changed.  Weekly email bodies never change.
+STATS_TTL = 3600
+STATS_STALE_TTL = 86400
+cache = TwoTierCache(DIR_PREFIX, ttls={STATS_FILENAME: STATS_TTL, EMAIL_CURSOR_FILENAME: 0})
 
 
 class WaUtils(object):
@@ -28,73 +48,119 @@ class WaUtils(object):
         cred_file = open(f'{DIR_PREFIX}wa_credentials.json', 'rb')
         credentials = json.load(cred_file)
         api = WaApiClient(credentials['client_id'], credentials['client_secret'])
+        token_cache = f'{tempfile.gettempdir()}/{TOKEN_CACHE_FILENAME}'
+        try:
+            if api.import_token(json.load(open(token_cache, 'r'))):
+                print('Using cached WildApricot token')
+                return api
+        except (FileNotFoundError, ValueError, KeyError):
+            pass
         #api.authenticate_with_apikey(credentials['api_key'])
         api.authenticate_with_contact_credentials(credentials['administrator_username'],
                                                 credentials['administrator_password'])
+        with open(token_cache, 'w') as f:
+            json.dump(api.export_token(), f)
         return api
 
+    def iter_contacts(self, select=None, page_size=CONTACTS_PAGE_SIZE, query_filter=None):
+        """Yield contacts as dicts, requesting one page of page_size contacts at a time with $top/$skip.
+        select is an optional list of field names for $select; WildApricot always returns system fields such as Id and Status.
+        Only one page is held in memory at a time."""
+        params = {'$async': 'false', '$top': page_size}
+        if select:
+            params['$select'] = ','.join(f"'{field}'" for field in select)
+        if query_filter:
+            params['$filter'] = query_filter
+        skip = 0
+        while True:
+            params['$skip'] = skip
+            page = self.wa_api.execute_request(CONTACTS_URL + '?' + urlencode(params), raw=True)['Contacts']
+            metrics.count('wildapricot.contacts', len(page))
+            yield from page
+            if len(page) < page_size:
+                return
+            skip += page_size
+
     def refresh_aarc_stats(self):
-        #if wa_api is None:
-#        wa_api = wild_apricot_api()
-    #    query_str = "/v2.2/accounts/30507/Contacts?$async=false&$filter='Membership+status.Id'+eq+1"
-        query_str = "/v2.2/accounts/30507/Contacts?$async=false"
-    # execute_request() returns a single API object holding list of contacts represented as API objects.
-    # Each contact API object contains a dictionary of attributes
-        contacts = [contact.__dict__ for contact in self.wa_api.execute_request(query_str).__dict__['Contacts']]
-        members = [contact for contact in contacts if "Status" in contact and contact["Status"] == "Active"]
-
-    # Dump to a file for local analysis
-    #    pickle.dump(contacts, open(f'{self.DIR_PREFIX}{self.PICKLE_FILENAME}', "wb"))    
+    # Contacts are counted a page at a time.  Only the Status system field is needed, so $select asks for
+    # just 'Membership status' instead of every contact field.
+        contacts = 0
+        members = 0
+        for contact in self.iter_contacts(select=['Membership status']):
+            contacts += 1
+            if contact.get("Status") == "Active":
+                members += 1
 
         response = {}
         response['entrants'] = 0
-        response['members'] = len(members)
-        response['contacts'] = len(contacts)
-        try:
-            f = open(f'{tempfile.gettempdir()}/{STATS_FILENAME}', 'w')
-            json.dump(response, f, indent=2)
-            f = open(f'{DIR_PREFIX}{STATS_FILENAME}', 'w')
-            json.dump(response, f, indent=2)
-        except ValueError:
-            return {}
+        response['members'] = members
+        response['contacts'] = contacts
+        cache.put_json(STATS_FILENAME, response)
+        dashboard.update_section('club-contacts', response)
         return response
 
 
+    def iter_member_emails(self):
+        """Yield the email address of every active member."""
+        for contact in self.iter_contacts(select=['e-Mail', 'Membership status']):
+            if contact.get("Status") == "Active" and contact.get("Email"):
+                yield contact["Email"]
+
     def get_aarc_stats(self):
+        stats = cache.get_json(STATS_FILENAME, stale_ttl=STATS_STALE_TTL)
+        if stats is None:
+            print('get_aarc_stats creating stats files')
+            return self.refresh_aarc_stats()
+        return stats
+
+    def read_email_cursor(self):
         try:
-            f = open(f'{tempfile.gettempdir()}/{STATS_FILENAME}', 'r')
-            print('get_aarc_stats found local file')
-            return json.load(f)
-        except FileNotFoundError:
-            try:
-                f2 = open(f'{DIR_PREFIX}{STATS_FILENAME}', 'r')
-                print('get_aarc_stats found file on S3')
-                stats = json.load(f2)
-                f3 = open(f'{tempfile.gettempdir()}/{STATS_FILENAME}', 'w')
-                json.dump(stats, f3, indent=2)
-                return stats
-            except FileNotFoundError:
-                print('get_aarc_stats creating stats files')
-                return self.refresh_aarc_stats()
-        return {}
+            return cache.get_json(EMAIL_CURSOR_FILENAME)
+        except ValueError:
+            return None
 
-    def get_email_body(self):
+    def write_email_cursor(self, cursor):
+        cache.put_json(EMAIL_CURSOR_FILENAME, cursor)
+
+    def find_new_weekly_email(self, cursor=None):
+        """Returns the SentEmails entry of the newest weekly email sent after the cursor, or None if there isn't one.
+        The request only asks for entries sent on or after the cursor's date, so a repeat check downloads little or nothing.
+        The Type and Subject are checked here: SentEmails only takes StartDate, EndDate and EventId filters, the
+        $filter query of Contacts is not supported on it."""
         top_email_entries = 500
-        emailLogUrl = "/v2/Accounts/30507/SentEmails"
-        print(f'Retrieving first {top_email_entries} from {emailLogUrl}')
         params = {'$top': top_email_entries,
                 '$async': 'false'}
-        request_url = emailLogUrl + '?' + urlencode(params)
+        if cursor is not None:
+            # StartDate has day granularity, so entries from the cursor's own day come back and are skipped below.
+            params['StartDate'] = cursor['SentDate'][:10]
+        request_url = SENT_EMAILS_URL + '?' + urlencode(params)
         print(request_url)
-        emails = self.wa_api.execute_request(request_url).__dict__["Emails"]
+        emails = self.wa_api.execute_request(request_url, raw=True)["Emails"]
         print(f'emails = {type(emails)} {len(emails)}')
-        for apiobj in emails:
-            email = apiobj.__dict__
-#            print(f'email = {email["Type"]}, {email.keys()}')
-            if email['Type'] == 'EmailBlast_Members':
-                print(f'Found EmailBlast_Members for {email["SentDate"]}')
-                if email['Subject'].startswith('AARC Weekly Update'):
-                    response = self.wa_api.execute_request(email['Url']).__dict__
-                    print(f'Found Weekly Email for {response["SentDate"]} body length: {len(response["Body"])}')
-                    return response['Subject'], response['Body']
-        return None, None
+        for email in emails:
+            if cursor is not None and (email['Id'] == cursor['Id'] or email['SentDate'] <= cursor['SentDate']):
+                break # Entries are newest first, so everything from here on was already seen.
+            if email['Type'] == WEEKLY_EMAIL_TYPE and email['Subject'].startswith(WEEKLY_EMAIL_SUBJECT):
+                print(f'Found Weekly Email for {email["SentDate"]}')
+                return email
+        return None
+
+    def get_weekly_email(self, email):
+        """Returns the Subject, Body and SentDate of a weekly email, from the cache if it was fetched before."""
+        cache_filename = EMAIL_BODY_FILENAME.format(email['Id'])
+        weekly_email = cache.get_json(cache_filename, ttl=float('inf'))
+        if weekly_email is None:
+            response = self.wa_api.execute_request(email['Url'], raw=True)
+            weekly_email = {'Subject': response['Subject'], 'Body': response['Body'], 'SentDate': response['SentDate']}
+            cache.put_json(cache_filename, weekly_email)
+        return weekly_email
+
+    def get_email_body(self):
+        """Returns the Subject and Body of the newest weekly email, relayed or not, or None, None if there isn't one."""
+        cursor = self.read_email_cursor()
+        email = self.find_new_weekly_email(cursor) or cursor
+        if email is None:
+            return None, None
+        weekly_email = self.get_weekly_email(email)
+        print(f'Found Weekly Email for {weekly_email["SentDate"]} body length: {len(weekly_email["Body"])}')
+        return weekly_email['Subject'], weekly_email['Body']
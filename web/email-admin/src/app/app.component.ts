@@ -2,6 +2,7 @@ import { Component, OnInit, AfterViewInit } from '@angular/core';
 import { ClubContacts } from './entities/club-contacts';
 import { RaceRegContacts } from './entities/race-reg-contacts';
 import { Emails } from './entities/emails';
+import { Dashboard } from './entities/dashboard';
 import { FormControl } from '@angular/forms';
 import { EmailManagerService } from './services/email-manager.service';
 import { Observable } from 'rxjs';
@@ -22,14 +23,22 @@ export class AppComponent implements OnInit, AfterViewInit {
   title = 'AARC Email Manager';
 
   ngOnInit() {
-    this.refreshClubContacts();
-    this.refreshRaceRegContacts();
-    this.refreshEmails();
+    this.refreshDashboard();
   }
 
   ngAfterViewInit() {
   }
 
+  refreshDashboard() {
+    this.emailManagerService.getDashboard()
+    .subscribe((data: Dashboard) => {
+        this.clubContacts = data['club-contacts'];
+        this.raceRegContacts = data['race-reg-contacts'];
+        this.emails = data['emails'];
+      },
+      error => console.log('Error returned', error));
+  }
+
   refreshClubContacts() {
     this.emailManagerService.getClubContacts()
     .subscribe((data: ClubContacts) => this.clubContacts = data,
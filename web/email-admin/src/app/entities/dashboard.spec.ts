@@ -0,0 +1,7 @@
+import { Dashboard } from './dashboard';
+
+describe('Dashboard', () => {
+  it('should create an instance', () => {
+    expect(new Dashboard()).toBeTruthy();
+  });
+});
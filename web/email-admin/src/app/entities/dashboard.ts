@@ -0,0 +1,59 @@
+import { ClubContacts } from './club-contacts';
+import { RaceRegContacts } from './race-reg-contacts';
+import { Emails } from './emails';
+
+export class Dashboard {
+
+  constructor(
+    clubContacts: ClubContacts,
+    raceRegContacts: RaceRegContacts,
+    emails: Emails,
+    updated: string,
+  ) {
+    this._clubContacts = clubContacts;
+    this._raceRegContacts = raceRegContacts;
+    this._emails = emails;
+    this._updated = updated;
+  }
+
+  private _clubContacts: ClubContacts;
+
+  get clubContacts(): ClubContacts {
+    return this._clubContacts;
+  }
+
+  set clubContacts(clubContacts: ClubContacts) {
+    this._clubContacts = clubContacts;
+  }
+
+  private _raceRegContacts: RaceRegContacts;
+
+  get raceRegContacts(): RaceRegContacts {
+    return this._raceRegContacts;
+  }
+
+  set raceRegContacts(raceRegContacts: RaceRegContacts) {
+    this._raceRegContacts = raceRegContacts;
+  }
+
+  private _emails: Emails;
+
+  get emails(): Emails {
+    return this._emails;
+  }
+
+  set emails(emails: Emails) {
+    this._emails = emails;
+  }
+
+  private _updated: string;
+
+  get updated(): string {
+    return this._updated;
+  }
+
+  set updated(updated: string) {
+    this._updated = updated;
+  }
+
+}
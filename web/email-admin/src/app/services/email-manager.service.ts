@@ -1,6 +1,7 @@
 import { ClubContacts } from '../entities/club-contacts';
 import { RaceRegContacts } from '../entities/race-reg-contacts';
 import { Emails } from '../entities/emails';
+import { Dashboard } from '../entities/dashboard';
 import { Injectable } from '@angular/core';
 import { HttpClient, HttpErrorResponse } from '@angular/common/http';
 import { Observable, Observer, throwError } from 'rxjs';
@@ -20,6 +21,16 @@ export class EmailManagerService {
 
   constructor(private http: HttpClient) { }
 
+  // All three stats sections in one request.  The server sends an ETag with Cache-Control: no-cache, so the
+  // browser revalidates its cached copy and an unchanged dashboard comes back as a 304 without a body.
+  getDashboard(): Observable<Dashboard> {
+    return this.http.get<Dashboard>(`${URL_PREFIX}/dashboard`)
+    .pipe(
+      catchError( (error: HttpErrorResponse) => {
+        this.errorHandler.log('Error while getting dashboard', error);
+        return throwError('Error while getting dashboard');
+      }));
+  }
   getClubContacts(): Observable<ClubContacts> {
     return this.http.get<ClubContacts>(`${URL_PREFIX}/club-contacts`)
     .pipe(